@@ -4,3 +4,27 @@ BROKER_PORT = 1883
 
 # ---Firebase Configuration ---
 FIREBASE_CREDENTIALS_PATH = "/home/bee/Firebase/smart-microalgae-cultivation-firebase-adminsdk-fbsvc-9bbb9d4d62.json"
+
+# --- Local State ---
+# last_known_control / last_known_log as of the last change; the controller starts from this file
+# and reconciles with Firestore in the background, so tanks get their setpoints even when offline
+STATE_SNAPSHOT_PATH = "/home/bee/Actuator_control/last_known_state.json"
+
+# --- Control Updates ---
+# Control edits of one system are merged into a single UPDATE: it is sent once the system has had
+# no new edit for CONTROL_DEBOUNCE_SEC, and at most CONTROL_MAX_LATENCY_SEC after the first edit.
+# 0 sends every edit immediately.
+CONTROL_DEBOUNCE_SEC = 0.3
+CONTROL_MAX_LATENCY_SEC = 1.0
+
+# --- Logging Schedule ---
+# The next trigger of every system and log type is saved here on every change, so a restart
+# continues the schedule instead of waiting a full interval (12 h for the sampling tank)
+SCHEDULE_STATE_PATH = "/home/bee/Actuator_control/log_schedule.json"
+# What to do on boot with triggers that fell due while the Pi was down:
+#   "fire_once" - one trigger per missed timer, straight away
+#   "skip"      - none, wait for the next slot
+#   "fire_all"  - one per missed slot, up to SCHEDULE_CATCH_UP_MAX_MISSED per timer
+SCHEDULE_CATCH_UP = "fire_once"
+SCHEDULE_CATCH_UP_MAX_MISSED = 24
+SCHEDULE_CATCH_UP_PER_SEC = 2       # catch-up triggers sent per second at most, across all systems
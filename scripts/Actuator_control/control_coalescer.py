@@ -0,0 +1,100 @@
+import time
+import threading
+from config import CONTROL_DEBOUNCE_SEC, CONTROL_MAX_LATENCY_SEC
+
+class ControlCoalescer:
+    """
+    Merges the control changes of each system into one UPDATE.
+    Dragging a slider in the app produces a Firestore change every few hundred milliseconds; instead of
+    reconfiguring the ESP32 for each one, changes are held until the system has been quiet for `window`
+    seconds, but never longer than `max_latency` after the first one. The latest value of a field wins,
+    and a field that ends up back at the value it had before is not sent at all.
+    Thread-safe: add() is called from the Firestore listener thread, publishing happens on a flusher thread.
+    """
+
+    # Constructor for ControlCoalescer class
+    def __init__(self, publish, window=CONTROL_DEBOUNCE_SEC, max_latency=CONTROL_MAX_LATENCY_SEC):
+        # publish(system_id, fields, edits) sends one combined update
+        self.publish = publish
+        self.window = window
+        self.max_latency = max_latency
+        # system_id -> {'new': {field: latest value}, 'old': {field: value before the first change},
+        #               'first': time of the first change, 'last': time of the latest, 'edits': changes merged}
+        self._pending = {}
+        self._cond = threading.Condition()
+        self.running = True
+        self._thread = None
+
+    def start(self):
+        """Starts the flusher thread."""
+        self._thread = threading.Thread(target=self._loop, name="control-coalescer", daemon=True)
+        self._thread.start()
+
+    def add(self, system_id, new_values, old_values):
+        """Buffers changed fields of a system: new_values and old_values map each field to its new and previous value."""
+        if self.window <= 0:
+            self.publish(system_id, dict(new_values), 1)
+            return
+        with self._cond:
+            now = time.monotonic()
+            pending = self._pending.get(system_id)
+            if pending is None:
+                pending = self._pending[system_id] = {'new': {}, 'old': {}, 'first': now, 'last': now, 'edits': 0}
+            for field, value in new_values.items():
+                # The value before the first buffered change is what the ESP32 still has
+                pending['old'].setdefault(field, old_values.get(field))
+                pending['new'][field] = value
+            pending['last'] = now
+            pending['edits'] += 1
+            self._cond.notify()
+
+    def flush(self):
+        """Sends everything still buffered right away (on shutdown)."""
+        with self._cond:
+            ready, self._pending = self._pending, {}
+        self._send(ready)
+
+    def stop(self, timeout=10):
+        """Stops the flusher thread and sends what is still buffered."""
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        # Let a publish already in progress finish first, so the flush below can't overtake it
+        # and leave an older value on the ESP32
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def _deadline(self, pending):
+        return min(pending['last'] + self.window, pending['first'] + self.max_latency)
+
+    def _due(self):
+        """Waits until at least one system's buffer is due and takes the due buffers out."""
+        with self._cond:
+            while self.running:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                # Only systems being edited right now are pending, so a scan is cheap
+                now = time.monotonic()
+                next_deadline = min(self._deadline(pending) for pending in self._pending.values())
+                if next_deadline > now:
+                    self._cond.wait(next_deadline - now)
+                    continue
+                ready = {system_id: pending for system_id, pending in self._pending.items()
+                         if self._deadline(pending) <= now}
+                for system_id in ready:
+                    del self._pending[system_id]
+                return ready
+            return {}
+
+    def _loop(self):
+        while self.running:
+            # Publish outside the lock, so new changes can be buffered meanwhile
+            self._send(self._due())
+
+    def _send(self, ready):
+        for system_id, pending in ready.items():
+            fields = {field: value for field, value in pending['new'].items() if value != pending['old'][field]}
+            if fields:
+                self.publish(system_id, fields, pending['edits'])
@@ -1,53 +1,205 @@
 import time
 import json
+import math
+import heapq
+import zlib
+import argparse
 import threading
+from collections import Counter, deque
+from config import SCHEDULE_CATCH_UP, SCHEDULE_CATCH_UP_MAX_MISSED, SCHEDULE_CATCH_UP_PER_SEC
+from state_store import write_json_atomic, read_json
+
+# Log types the ESP32 understands -> (interval field in the log_interval document, fallback interval in seconds)
+LOG_TYPES = {
+    "GET_PRIMARY": ('primary_log_interval', 3600),
+    "GET_SAMPLING": ('sampling_log_interval', 43200),
+}
+
+# Catch-up policies for triggers missed while the scheduler wasn't running
+FIRE_ONCE = "fire_once"
+SKIP = "skip"
+FIRE_ALL = "fire_all"
+CATCH_UP_POLICIES = (FIRE_ONCE, SKIP, FIRE_ALL)
+
+def phase_offset(system_id, log_type, interval):
+    """
+    Deterministic offset in [0, interval) of a system's triggers within each interval.
+    crc32 spreads the systems evenly and gives the same offset on every boot and every Pi.
+    """
+    return zlib.crc32(f"{system_id}/{log_type}".encode('utf-8')) / 2**32 * interval
+
+def next_slot(now, interval, phase=0.0, anchor=0.0):
+    """
+    First trigger time after now on the fixed grid anchor + phase + k * interval.
+    The grid doesn't depend on when the last trigger actually ran, so late triggers never add up to drift.
+    """
+    start = anchor + phase
+    slot = start + (math.floor((now - start) / interval) + 1) * interval
+    # Float rounding can land on the slot that just ran
+    return slot if slot > now else slot + interval
+
+def _saved_timer(entry):
+    """Returns (run_at, interval) of a timer from the state file, or raises ValueError if it isn't two usable numbers."""
+    if not isinstance(entry, list) or len(entry) != 2:
+        raise ValueError(f"expected [run_at, interval], got {entry!r}")
+    for value in entry:
+        # bool is an int to Python, but not a time
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"{value!r} is not a number")
+    run_at, interval = entry
+    if interval <= 0:
+        raise ValueError(f"interval {interval!r} is not positive")
+    return run_at, interval
 
 class LoggingScheduler:
+    """
+    Sends the log_sensor triggers of every system when they fall due.
+    The next triggers are kept in a min-heap, so the thread sleeps until the earliest one
+    instead of checking every system each second; reschedule() and add_system() wake it up.
+    Thread-safe: the Firestore listener thread may call them while the timer thread runs.
+
+    Triggers sit on a fixed grid per system and log type (next_slot), shifted by phase_offset so
+    that systems started together don't all log in the same second. stagger=False puts every
+    system on the bare grid (anchor + k * interval).
+
+    With a state_path the timers are saved to that JSON file on every change and reloaded on the
+    next start; triggers that fell due in between are handled by the catch_up policy.
+    """
+
     # Constructor for LoggingScheduler class
-    def __init__(self, mqtt_client, shared_log):
+    def __init__(self, mqtt_client, shared_log, anchor=0.0, stagger=True, state_path=None,
+                 catch_up=SCHEDULE_CATCH_UP, catch_up_max=SCHEDULE_CATCH_UP_MAX_MISSED,
+                 catch_up_rate=SCHEDULE_CATCH_UP_PER_SEC):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"unknown catch-up policy {catch_up!r}, expected one of {', '.join(CATCH_UP_POLICIES)}")
         # Store MQTT client created in pi_controller.py
         self.client = mqtt_client
         self.shared_log = shared_log
-        # Store the 'next run time' for each system
-        self.next_primary = {}  # { 'system_1': timestamp }
-        self.next_sampling = {} 
+        # Epoch time the trigger grid counts from
+        self.anchor = anchor
+        self.stagger = stagger
+        self.state_path = state_path
+        self.catch_up = catch_up
+        self.catch_up_max = catch_up_max
+        self.catch_up_rate = catch_up_rate
+        # (system_id, log_type) -> next run time; the heap entries that don't match it are outdated
+        self._next = {}
+        # (system_id, log_type) -> interval the next run time was computed with (saved with it)
+        self._intervals = {}
+        self._heap = []  # [(next run time, system_id, log_type)]
+        # Missed triggers still to send, released at catch_up_rate per second
+        self._catch_up = deque()
+        self._catch_up_at = 0.0
+        self._cond = threading.Condition()
+        # Serializes writers of the state file, so an older snapshot never replaces a newer one
+        self._save_lock = threading.Lock()
         self.running = True # flag check to esnure pi finishes its process before thread dies
+        self._restore()
+        for system_id in list(shared_log):
+            self._add(system_id)
+        self._save()
 
     def start(self):
         """Starts the timer loop in a background thread."""
         # Execute _loop function, kill thread automatically if main program stops
-        thread = threading.Thread(target=self._loop, daemon=True)
+        thread = threading.Thread(target=self._loop, name="log-scheduler", daemon=True)
         thread.start()
 
+    def add_system(self, system_id):
+        """Starts the timers of a system that has none yet, at its next grid slot."""
+        if self._add(system_id):
+            self._save()
+
+    def reschedule(self, system_id):
+        """Moves a system's timers to the grid of its current intervals (after the intervals changed)."""
+        with self._cond:
+            now = time.time()
+            for log_type in LOG_TYPES:
+                self._schedule(system_id, log_type, self._next_time(system_id, log_type, now))
+            self._cond.notify()
+        self._save()
+
+    def next_run(self, system_id, log_type):
+        """Returns the time of the system's next log_type trigger, or None if it has no timer."""
+        with self._cond:
+            return self._next.get((system_id, log_type))
+
+    def _add(self, system_id):
+        added = False
+        with self._cond:
+            now = time.time()
+            for log_type in LOG_TYPES:
+                if (system_id, log_type) not in self._next:
+                    self._schedule(system_id, log_type, self._next_time(system_id, log_type, now))
+                    added = True
+            self._cond.notify()
+        return added
+
+    def _interval(self, system_id, log_type):
+        field, default = LOG_TYPES[log_type]
+        try:
+            interval = float(self.shared_log.get(system_id, {}).get(field, default))
+        except (TypeError, ValueError):
+            return default
+        # A missing or zero interval must not turn into a trigger every loop
+        return interval if interval > 0 else default
+
+    def _next_time(self, system_id, log_type, now):
+        interval = self._interval(system_id, log_type)
+        phase = phase_offset(system_id, log_type, interval) if self.stagger else 0.0
+        return next_slot(now, interval, phase, self.anchor)
+
+    def _schedule(self, system_id, log_type, run_at):
+        # Caller holds the lock. The old heap entry stays behind and is skipped when it surfaces;
+        # the heap is rebuilt once outdated entries outnumber the live ones
+        self._next[(system_id, log_type)] = run_at
+        self._intervals[(system_id, log_type)] = self._interval(system_id, log_type)
+        heapq.heappush(self._heap, (run_at, system_id, log_type))
+        if len(self._heap) > 2 * len(self._next) + 64:
+            self._heap = [(run_at, system_id, log_type) for (system_id, log_type), run_at in self._next.items()]
+            heapq.heapify(self._heap)
+
+    def _due(self):
+        """Waits until at least one trigger is due (or stop() is called) and returns the due triggers."""
+        with self._cond:
+            while self.running:
+                # Drop outdated entries at the top so the wait targets a live deadline
+                while self._heap and self._next.get(self._heap[0][1:]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                deadlines = [self._heap[0][0]] if self._heap else []
+                if self._catch_up:
+                    deadlines.append(self._catch_up_at)
+                if not deadlines:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                wait = min(deadlines) - now
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                due = []
+                if self._catch_up and self._catch_up_at <= now:
+                    due.append(self._catch_up.popleft())
+                    self._catch_up_at = now + 1.0 / self.catch_up_rate
+                while self._heap and self._heap[0][0] <= now:
+                    run_at, system_id, log_type = heapq.heappop(self._heap)
+                    if self._next.get((system_id, log_type)) != run_at:
+                        continue
+                    due.append((system_id, log_type))
+                    # Next slot on the grid, not now + interval: a late wake-up doesn't shift later triggers
+                    self._schedule(system_id, log_type, self._next_time(system_id, log_type, now))
+                return due
+            return []
+
     def _loop(self):
         while self.running:
-            now = time.time()  # grabs the current Unix timestamp
-                 
-            for system_id, config in self.shared_log.items():
-                # 3600 and 43200 are fallback defaults
-                p_interval = config.get('primary_log_interval', 3600)
-                s_interval = config.get('sampling_log_interval', 43200)
-
-                # --- Handle Primary Sensors ---
-                # Pi doesn't have a schedule for system_X yet
-                if system_id not in self.next_primary:
-                    self.next_primary[system_id] = now + p_interval
-                
-                # Check if current time past the scheduled logging time
-                if now >= self.next_primary[system_id]:
-                    self._trigger_log(system_id, "GET_PRIMARY")
-                    # Reset the clock
-                    self.next_primary[system_id] = now + p_interval
-
-                # --- Handle Sampling Sensors ---
-                if system_id not in self.next_sampling:
-                    self.next_sampling[system_id] = now + s_interval
-                
-                if now >= self.next_sampling[system_id]:
-                    self._trigger_log(system_id, "GET_SAMPLING")
-                    self.next_sampling[system_id] = now + s_interval
-
-            time.sleep(1) # Check every second
+            # Publish outside the lock, so a slow publish never holds up reschedule()
+            due = self._due()
+            for system_id, log_type in due:
+                self._trigger_log(system_id, log_type)
+            if due:
+                self._save()
 
     def _trigger_log(self, system_id, log_type):
         topic = f"{system_id}/log_sensor"
@@ -56,4 +208,113 @@ class LoggingScheduler:
         print(f"Timer reached for {system_id}: Sent {log_type} to {topic}")
 
     def stop(self):
-        self.running = False
\ No newline at end of file
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+
+    # --- Persistence ---
+    def _save(self):
+        """Writes every timer to state_path (atomically, see state_store)."""
+        if self.state_path is None:
+            return
+        with self._save_lock:
+            with self._cond:
+                timers = {}
+                for (system_id, log_type), run_at in self._next.items():
+                    timers.setdefault(system_id, {})[log_type] = [run_at, self._intervals[(system_id, log_type)]]
+            try:
+                write_json_atomic(self.state_path, {"saved_at": time.time(), "timers": timers})
+            except OSError as e:
+                print(f"Could not save the log schedule to {self.state_path}: {e}")
+
+    def _restore(self):
+        """Reloads the saved timers of the systems in shared_log and queues the missed triggers."""
+        if self.state_path is None:
+            return
+        try:
+            state = read_json(self.state_path)
+            if state is None:
+                return
+            timers = state["timers"]
+            if not isinstance(timers, dict):
+                raise TypeError("timers is not an object")
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring unreadable log schedule {self.state_path}: {e}")
+            return
+
+        missed_total = 0
+        with self._cond:
+            now = time.time()
+            for system_id, log_types in timers.items():
+                if system_id not in self.shared_log:
+                    continue
+                if not isinstance(log_types, dict):
+                    print(f"Ignoring unreadable log schedule {self.state_path} for {system_id}: not an object")
+                    continue
+                for log_type, entry in log_types.items():
+                    # A bad entry only loses its own timer; add_system starts it afresh
+                    try:
+                        run_at, interval = _saved_timer(entry)
+                    except ValueError as e:
+                        print(f"Ignoring unreadable log schedule {self.state_path} for {system_id}/{log_type}: {e}")
+                        continue
+                    # A changed interval starts on its new grid (add_system does that)
+                    if log_type not in LOG_TYPES or interval != self._interval(system_id, log_type):
+                        continue
+                    if run_at > now:
+                        self._schedule(system_id, log_type, run_at)
+                        continue
+                    missed = math.floor((now - run_at) / interval) + 1
+                    fires = {FIRE_ONCE: 1, SKIP: 0, FIRE_ALL: min(missed, self.catch_up_max)}[self.catch_up]
+                    self._catch_up.extend([(system_id, log_type)] * fires)
+                    missed_total += missed
+                    self._schedule(system_id, log_type, self._next_time(system_id, log_type, now))
+        if missed_total:
+            print(f"Restored log schedule: {missed_total} triggers missed while stopped, "
+                  f"{len(self._catch_up)} sent now ({self.catch_up})")
+
+# --- Simulation ---
+def simulate(shared_log, duration, start=None, stagger=True):
+    """
+    Counts the triggers the scheduler would send for the log_interval documents in shared_log
+    ({system_id: {'primary_log_interval': s, 'sampling_log_interval': s}}) over duration seconds.
+    Returns a Counter of triggers per whole second; nothing is published.
+    """
+    start = time.time() if start is None else start
+    end = start + duration
+    scheduler = LoggingScheduler(None, shared_log, stagger=stagger)
+    per_second = Counter()
+    for system_id in shared_log:
+        for log_type in LOG_TYPES:
+            run_at = scheduler._next_time(system_id, log_type, start)
+            while run_at < end:
+                per_second[int(run_at)] += 1
+                run_at = scheduler._next_time(system_id, log_type, run_at)
+    return per_second
+
+# Prints the peak load of a fleet, e.g.
+#   python3 log_scheduler.py --systems 500 --primary 600 --sampling 43200 --hours 24
+#   python3 log_scheduler.py --fleet log_intervals.json    (the log_interval documents as {system_id: {...}})
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the log triggers of a fleet and report the peak triggers per second.")
+    parser.add_argument('--systems', type=int, default=100, help="number of systems (system_1 ... system_N)")
+    parser.add_argument('--primary', type=float, default=LOG_TYPES["GET_PRIMARY"][1], help="primary log interval in seconds")
+    parser.add_argument('--sampling', type=float, default=LOG_TYPES["GET_SAMPLING"][1], help="sampling log interval in seconds")
+    parser.add_argument('--fleet', default=None, help="JSON file with per-system intervals instead of --systems/--primary/--sampling")
+    parser.add_argument('--hours', type=float, default=24, help="simulated time span")
+    args = parser.parse_args()
+
+    if args.fleet:
+        with open(args.fleet) as f:
+            fleet = json.load(f)
+    else:
+        fleet = {f"system_{n}": {'primary_log_interval': args.primary, 'sampling_log_interval': args.sampling}
+                 for n in range(1, args.systems + 1)}
+
+    print(f"{len(fleet)} systems over {args.hours:g} h")
+    for label, stagger in (("staggered", True), ("unstaggered", False)):
+        per_second = simulate(fleet, args.hours * 3600, stagger=stagger)
+        total = sum(per_second.values())
+        peak_second, peak = max(per_second.items(), key=lambda item: item[1], default=(0, 0))
+        print(f"  {label:<12} {total} triggers, peak {peak}/s at {time.strftime('%H:%M:%S', time.localtime(peak_second))}, "
+              f"{len(per_second)} busy seconds")
@@ -2,9 +2,11 @@ import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
 import firebase_admin
 from firebase_admin import credentials, firestore
-import json, time
+import json, time, threading
 from config import *
 from log_scheduler import LoggingScheduler
+from control_coalescer import ControlCoalescer
+from state_store import write_json_atomic, read_json
 
 # --- Initialization ---
 # Load the credentials file
@@ -21,6 +23,9 @@ client = mqtt.Client(CallbackAPIVersion.VERSION2)
 last_known_control = {}
 last_known_log = {}
 
+# Control parameters forwarded to the ESP32s
+CONTROL_FIELDS = ['target_light_duration', 'target_light_intensity', 'target_stirring_speed', 'target_water_level']
+
 # --- Connection Handlers ---
 # called when the client connects to the broker
 # Handles connection acceptance/rejection and sets up subscriptions
@@ -37,48 +42,67 @@ def on_connect_fail(client, userdata):
 client.on_connect = on_connect
 client.on_connect_fail = on_connect_fail
 
+# --- LOCAL SNAPSHOT ---
+# last_known_control and last_known_log are saved to STATE_SNAPSHOT_PATH whenever they change,
+# so the next boot can configure the tanks straight away, with or without internet
+# Both Firestore listener threads and the coalescer's flusher save; one at a time, so the
+# copies and the write happen in the same order and an older snapshot never replaces a newer one
+_snapshot_lock = threading.Lock()
+
+def save_snapshot():
+    with _snapshot_lock:
+        try:
+            # dict() copies are taken in one step, so a listener thread can't change them mid-write
+            write_json_atomic(STATE_SNAPSHOT_PATH, {
+                "saved_at": time.time(),
+                "control": dict(last_known_control),
+                "log": dict(last_known_log),
+            })
+        except OSError as e:
+            print(f"Could not save the state snapshot to {STATE_SNAPSHOT_PATH}: {e}")
+
+def load_snapshot():
+    """Fills last_known_control and last_known_log from the local snapshot, if there is one."""
+    try:
+        snapshot = read_json(STATE_SNAPSHOT_PATH)
+    except ValueError as e:
+        print(f"Ignoring unreadable state snapshot {STATE_SNAPSHOT_PATH}: {e}")
+        return
+    if snapshot is None:
+        print("No local state snapshot yet, waiting for Firestore.")
+        return
+    last_known_control.update(snapshot.get("control", {}))
+    last_known_log.update(snapshot.get("log", {}))
+    print(f"Loaded state snapshot from {time.ctime(snapshot.get('saved_at', 0))}: "
+          f"{len(last_known_control)} control, {len(last_known_log)} logging configs")
+
+def publish_full_sync(system_id, data):
+    """Sends every control parameter of a system as a retained FULL_SYNC message."""
+    payload = {"type": "FULL_SYNC"}  # Tells ESP32 to update all control parameters
+    for key in CONTROL_FIELDS:
+        payload[key] = data.get(key)
+
+    # Publish to system-specific topic
+    topic = f"{system_id}/control"
+    client.publish(topic, json.dumps(payload), qos=1, retain=True)
+
+    print(f"Initialized & Synced {system_id} to {topic}")
+    print(f"   Payload Sent: {payload}\n")
+
 # --- COLD START FUNCTION ---
 def sync_on_startup():
-    """Fetches control settings on boot."""
-    print("Performing Cold Start sync...")
-    
-    global last_known_control, last_known_log
-    
-    # 1. Sync actuator control
-    # Get all documents in the 'system_controls' collection
-    control_docs = db.collection("system_controls").stream()
-    for doc in control_docs:
-        system_id = doc.id
-        data = doc.to_dict() # Converts the NoSQL data to a Python dictionary
-        
-        # Fill 'memory' to prevent listener from double-sending
-        last_known_control[system_id] = data
-    
-        # Extract all control parameters 
-        payload = {
-            "type": "FULL_SYNC",  # Tells ESP32 to update all control parameters
-            "target_light_duration": data.get('target_light_duration'),
-            "target_light_intensity": data.get('target_light_intensity'),
-            "target_stirring_speed": data.get('target_stirring_speed'),
-            "target_water_level": data.get('target_water_level')
-        }
-        
-        # Publish to system-specific topic
-        topic = f"{system_id}/control"
-        client.publish(topic, json.dumps(payload), qos=1, retain=True)
-        
-        print(f"Initialized & Synced {system_id} to {topic}")
-        print(f"   Payload Sent: {payload}\n")
-        
-    # 1. Sync logging interval
-    log_docs = db.collection("log_interval").stream()
-    for doc in log_docs:
-        system_id = doc.id
-        data = doc.to_dict() # Converts the NoSQL data to a Python dictionary
-        
-        # Fill 'memory' to prevent listener from double-sending
-        last_known_log[system_id] = data
-        
+    """
+    Configures every known system from the local snapshot, without waiting for Firestore.
+    Reconciling with Firestore happens in the background: the listeners' first snapshot reports
+    every document as ADDED, and the change handlers publish only what differs from the snapshot.
+    """
+    print("Performing Cold Start sync from local snapshot...")
+    load_snapshot()
+
+    for system_id, data in last_known_control.items():
+        publish_full_sync(system_id, data)
+
+    for system_id, data in last_known_log.items():
         print(f"Synced Logging Config for {system_id}:")
         print(f"   - Primary Interval : {data.get('primary_log_interval')}s")
         print(f"   - Sampling Interval: {data.get('sampling_log_interval')}s\n")
@@ -88,35 +112,68 @@ def on_control_change(col_snapshot, changes, read_time):
     """Triggers if any control settings are modified."""
     global last_known_control
     for change in changes:
-        if change.type.name == 'MODIFIED':
+        # ADDED: the listener's first snapshot (reconciling the local snapshot) or a new system
+        if change.type.name in ('ADDED', 'MODIFIED'):
             system_id = change.document.id
             new_data = change.document.to_dict()
-            old_data = last_known_control.get(system_id, {})
+            
+            # A system the snapshot doesn't know yet gets all of its parameters
+            if system_id not in last_known_control:
+                last_known_control[system_id] = new_data
+                publish_full_sync(system_id, new_data)
+                save_snapshot()
+                continue
+            
+            old_data = last_known_control[system_id]
             
             # Find only the modified field
-            diff = {"type": "UPDATE"} # Tells ESP32 this is a single control parameter change
-            fields = ['target_light_duration','target_light_intensity','target_stirring_speed', 'target_water_level'] 
+            diff = {}
             
-            for key in fields:
+            for key in CONTROL_FIELDS:
                 if new_data.get(key) != old_data.get(key):
                     diff[key] = new_data.get(key)
             
-            # Only publish if something changed
-            if len(diff) > 1: 
-                last_known_control[system_id] = new_data
-                topic = f"{system_id}/control"
-                client.publish(topic, json.dumps(diff), qos=1)
-                print(f"[Control Update] sent for {system_id}: {diff}\n")
-            
+            if not diff:
+                continue
+            last_known_control[system_id] = new_data
+            if change.type.name == 'ADDED':
+                # The first snapshot differs from the local one: the cold start left a stale retained
+                # FULL_SYNC on the topic, so replace it rather than send an UPDATE on top of it
+                publish_full_sync(system_id, new_data)
+                save_snapshot()
+            else:
+                # Rapid edits (a slider being dragged) are merged into one UPDATE by the coalescer
+                coalescer.add(system_id, diff, {key: old_data.get(key) for key in diff})
+
+def publish_update(system_id, fields, edits):
+    """Sends the merged control changes of a system; called by the coalescer."""
+    diff = {"type": "UPDATE"} # Tells ESP32 this is a single control parameter change
+    diff.update(fields)
+    topic = f"{system_id}/control"
+    client.publish(topic, json.dumps(diff), qos=1)
+    print(f"[Control Update] sent for {system_id}: {diff} ({edits} edits merged)\n")
+    save_snapshot()
+
 # --- DETECT CHANGE IN LOGGING SETTINGS ---
 def on_log_change(col_snapshot, changes, read_time):
     """Triggers if any logging settings are modified."""
     global last_known_log
     for change in changes:
-        if change.type.name == 'MODIFIED':
+        # ADDED: the listener's first snapshot (reconciling the local snapshot) or a new system
+        if change.type.name in ('ADDED', 'MODIFIED'):
             system_id = change.document.id
             new_data = change.document.to_dict()
-            old_data = last_known_log.get(system_id, {})
+            
+            # A system the snapshot doesn't know yet gets its timers now
+            if system_id not in last_known_log:
+                last_known_log[system_id] = new_data
+                print(f"[Logging Update] new system {system_id}\n")
+                if 'scheduler' in globals():
+                    scheduler.add_system(system_id)
+                save_snapshot()
+                continue
+            
+            old_data = last_known_log[system_id]
             
             new_p = round(float(new_data.get('primary_log_interval', 0)), 1)
             new_s = round(float(new_data.get('sampling_log_interval', 0)), 1)
@@ -133,9 +190,10 @@ def on_log_change(col_snapshot, changes, read_time):
                 print(f"   - Sampling: {old_s}s -> {new_s}s\n")
                 
                 # Ensure the Pi is running before reset the timer to count up to new interval
+                # (reschedule() takes the scheduler's lock and wakes its thread)
                 if 'scheduler' in globals():
-                    scheduler.next_primary[system_id] = time.time() + new_p
-                    scheduler.next_sampling[system_id] = time.time() + new_s
+                    scheduler.reschedule(system_id)
+                save_snapshot()
             
             else:
                 # Still update the memory to keep the timestamp current for the next check, 
@@ -146,15 +204,21 @@ def on_log_change(col_snapshot, changes, read_time):
 client.connect(BROKER_ADDRESS, BROKER_PORT)
 client.loop_start()
 
-# Sync control parameters from before system shut down
+# Sync control parameters from before system shut down (local snapshot, no network needed)
 sync_on_startup()
 
-# Initialise scheduler
-scheduler = LoggingScheduler(client, last_known_log)
+# Initialise scheduler; it resumes the saved timers and sends the triggers missed while stopped
+scheduler = LoggingScheduler(client, last_known_log, state_path=SCHEDULE_STATE_PATH)
 # Start the background worker thread
 scheduler.start()
 
+# Merges rapid control edits per system (CONTROL_DEBOUNCE_SEC / CONTROL_MAX_LATENCY_SEC)
+coalescer = ControlCoalescer(publish_update)
+coalescer.start()
+
 # Watch for any changes in control/logging
+# The listeners connect in the background and keep retrying while offline; their first snapshot
+# reconciles the local snapshot with Firestore (see on_control_change / on_log_change)
 query_watch_control = db.collection("system_controls").on_snapshot(on_control_change)
 query_watch_log = db.collection("log_interval").on_snapshot(on_log_change)
 
@@ -164,5 +228,7 @@ try:
 except KeyboardInterrupt:
     query_watch_control.unsubscribe()
     query_watch_log.unsubscribe()
+    # Send control changes still waiting in the coalescer before the MQTT loop stops
+    coalescer.stop()
     client.loop_stop()
     print("System Shutdown.")
\ No newline at end of file
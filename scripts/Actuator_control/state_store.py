@@ -0,0 +1,36 @@
+import os
+import json
+import tempfile
+
+# --- Local State Files ---
+# Small JSON files the controller keeps next to its code so it can come up without Firestore.
+# Writes go to a temporary file that is fsynced and renamed over the old one, so a power cut
+# leaves either the previous state or the new one, never half a file.
+
+def write_json_atomic(path, data):
+    """Replaces path with data as JSON. Values JSON can't represent (e.g. Firestore timestamps) are stored as text."""
+    # A temporary file of its own: two threads saving at once must not write into the same one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, default=str)
+            f.flush()
+            # On disk before the rename
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def read_json(path):
+    """Returns the JSON stored at path, or None if there is none yet. Raises ValueError if it is unreadable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        raise ValueError(str(e))
@@ -0,0 +1,256 @@
+import os
+import logging
+import json
+import math
+import heapq
+import struct
+import zlib
+import sqlite3
+from array import array
+from datetime import datetime, timezone
+from config import ARCHIVE_DIR, RETENTION_DAYS, ARCHIVE_BATCH_SIZE, DEFAULT_SYSTEM_ID
+from sqlite_handler import get_manager, query_range, TANK_TABLES, TANK_SENSORS
+
+logger = logging.getLogger(__name__)
+
+# --- Segment File Format ---
+# One append-only file per table per UTC day: ARCHIVE_DIR/<table>/<YYYY-MM-DD>.seg
+# The file is a sequence of self-describing blocks, one per archive batch:
+#   header  : magic, format version, row count, column-list length, payload length
+#   columns : JSON list of [name, type] ("q" = int64, "d" = float64, "s" = UTF-8 text)
+#   payload : zlib-compressed columns, each stored contiguously (columnar) with a length prefix
+# Storing each column on its own lets zlib compress runs of similar values very well.
+SEGMENT_MAGIC = b'ALGS'
+SEGMENT_VERSION = 1
+BLOCK_HEADER = struct.Struct('<4sBIII')
+COLUMN_LENGTH = struct.Struct('<I')
+TEXT_SEPARATOR = '\x00'
+
+def _table_columns(tank):
+    """Returns the archived [name, type] columns for a tank table."""
+    # ts is the epoch time in seconds, kept so readers can range-filter without parsing text
+    return ([['id', 'q'], ['ts', 'd'], ['system_id', 's'], ['timestamp', 's']]
+            + [[sensor, 'd'] for sensor in TANK_SENSORS[tank]])
+
+def _segment_path(table, day):
+    return os.path.join(ARCHIVE_DIR, table, f"{day}.seg")
+
+def _utc_day(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%Y-%m-%d')
+
+def _encode_column(kind, values):
+    if kind == 's':
+        return TEXT_SEPARATOR.join('' if value is None else str(value) for value in values).encode('utf-8')
+    if kind == 'q':
+        return array('q', values).tobytes()
+    # Floats: NULL (or anything that isn't a number) is stored as NaN
+    return array('d', (
+        float(value) if isinstance(value, (int, float)) else math.nan for value in values
+    )).tobytes()
+
+def _decode_column(kind, data, row_count):
+    if kind == 's':
+        return data.decode('utf-8').split(TEXT_SEPARATOR) if row_count else []
+    values = array(kind)
+    values.frombytes(data)
+    if kind == 'd':
+        return [None if math.isnan(value) else value for value in values]
+    return values.tolist()
+
+def append_block(path, columns, rows):
+    """Appends one compressed columnar block of rows (tuples in `columns` order) to a segment file."""
+    column_data = b''.join(
+        COLUMN_LENGTH.pack(len(encoded)) + encoded
+        for encoded in (
+            _encode_column(kind, [row[index] for row in rows])
+            for index, (name, kind) in enumerate(columns)
+        )
+    )
+    payload = zlib.compress(column_data, 9)
+    column_json = json.dumps(columns).encode('utf-8')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Append-only: existing blocks are never rewritten
+    with open(path, 'ab') as f:
+        f.write(BLOCK_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(rows), len(column_json), len(payload)))
+        f.write(column_json)
+        f.write(payload)
+        f.flush()
+        # Make sure the block is on the SD card before the rows are deleted from SQLite
+        os.fsync(f.fileno())
+
+def read_segment(path):
+    """Yields every row of a segment file as a dictionary."""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                # End of file (or a block cut short by a power loss, which is ignored)
+                return
+            magic, version, row_count, column_length, payload_length = BLOCK_HEADER.unpack(header)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                logger.warning("Unreadable block in %s, skipping rest of file", path)
+                return
+            columns = json.loads(f.read(column_length))
+            payload = f.read(payload_length)
+            if len(payload) < payload_length:
+                return
+            data = zlib.decompress(payload)
+
+            offset = 0
+            values = []
+            for name, kind in columns:
+                (length,) = COLUMN_LENGTH.unpack_from(data, offset)
+                offset += COLUMN_LENGTH.size
+                values.append(_decode_column(kind, data[offset:offset + length], row_count))
+                offset += length
+
+            names = [name for name, kind in columns]
+            for row in zip(*values):
+                yield dict(zip(names, row))
+
+def enable_incremental_vacuum():
+    """
+    Switches the database to incremental auto-vacuum (one full VACUUM the first time only).
+    The VACUUM rewrites the whole file and blocks every writer meanwhile, so this is an offline step
+    (migrate_database.py) rather than something the gateway does on its own.
+    """
+    manager = get_manager()
+    with manager.writer() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        logger.info("Enabling incremental vacuum (one-time full VACUUM, this can take a while)...")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # The new mode only takes effect after a VACUUM, which must run outside a transaction
+        conn.commit()
+        conn.execute("VACUUM")
+
+def archive_old_rows(max_age_days=RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE, now=None):
+    """
+    Moves uploaded rows (and rows the upload policy kept local-only) older than max_age_days from SQLite
+    into the daily segment files, deletes them from SQLite and returns the freed pages to the file system
+    if incremental auto-vacuum is on (see enable_incremental_vacuum). Returns the number of rows archived.
+    """
+    now = datetime.now(timezone.utc).timestamp() if now is None else now
+    # Compared in SQL against the integer ts_ms column
+    cutoff_ms = int((now - max_age_days * 86400) * 1000)
+    manager = get_manager()
+    archived_total = 0
+
+    try:
+        # list(): tanks can be added at runtime while this runs
+        for tank, table in list(TANK_TABLES.items()):
+            columns = _table_columns(tank)
+            # Rows without a usable timestamp (ts_ms NULL) are kept in SQLite. Filtering them, and the rows
+            # that are still too new, in SQL means every batch is old rows only and the walk can't stall on them.
+            select_sql = (
+                f"SELECT id, ts_ms, system_id, timestamp, {', '.join(TANK_SENSORS[tank])} FROM {table} "
+                f"WHERE uploaded != 0 AND ts_ms IS NOT NULL AND ts_ms < ? AND id > ? ORDER BY id LIMIT ?"
+            )
+            last_id = 0
+
+            while True:
+                with manager.reader() as conn:
+                    rows = conn.execute(select_sql, (cutoff_ms, last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                # Group the old rows by UTC day
+                by_day = {}
+                for row in rows:
+                    ts = row[1] / 1000.0
+                    by_day.setdefault(_utc_day(ts), []).append((row[0], ts) + tuple(row[2:]))
+
+                # 1. Write the segments first...
+                for day, day_rows in by_day.items():
+                    append_block(_segment_path(table, day), columns, day_rows)
+
+                # 2. ...then delete from SQLite. A crash in between only leaves duplicates,
+                # which the reader drops by id.
+                archived_ids = [(row[0],) for day_rows in by_day.values() for row in day_rows]
+                with manager.writer() as conn:
+                    conn.executemany(f"DELETE FROM {table} WHERE id = ?", archived_ids)
+                archived_total += len(archived_ids)
+
+            # Hand the pages freed by the deletes back to the SD card. Without incremental auto-vacuum
+            # this does nothing and SQLite reuses the free pages for new rows instead.
+            with manager.writer() as conn:
+                conn.execute("PRAGMA incremental_vacuum")
+
+    except (sqlite3.Error, OSError) as e:
+        logger.error("Error archiving old rows: %s", e)
+
+    if archived_total:
+        logger.info("Archived %d rows older than %d days", archived_total, max_age_days)
+    return archived_total
+
+def _archived_rows(table, start, end, system_id):
+    """Yields archived rows of one system with start <= ts < end, in time order."""
+    folder = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(folder):
+        return
+    first_day, last_day = _utc_day(start), _utc_day(max(start, end - 1e-6))
+
+    # File names are ISO dates, so sorting them sorts the days
+    for name in sorted(os.listdir(folder)):
+        day = name[:-len('.seg')]
+        if not name.endswith('.seg') or day < first_day or day > last_day:
+            continue
+        seen_ids = set()
+        day_rows = []
+        for row in read_segment(os.path.join(folder, name)):
+            if row['id'] in seen_ids or not (start <= row['ts'] < end):
+                continue
+            # Blocks written before system ids existed belong to the default system
+            if row.setdefault('system_id', DEFAULT_SYSTEM_ID) != system_id:
+                continue
+            seen_ids.add(row['id'])
+            day_rows.append(row)
+        day_rows.sort(key=lambda row: row['ts'])
+        yield from day_rows
+
+def archived_rows(table):
+    """Yields every archived row of a table (all systems) as dictionaries, one day file at a time, without duplicates."""
+    folder = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(folder):
+        return
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.seg'):
+            continue
+        seen_ids = set()
+        for row in read_segment(os.path.join(folder, name)):
+            if row['id'] in seen_ids:
+                continue
+            seen_ids.add(row['id'])
+            # Blocks written before system ids existed belong to the default system
+            row.setdefault('system_id', DEFAULT_SYSTEM_ID)
+            yield row
+
+def _live_rows(tank, start, end, system_id):
+    """Yields rows of one system still in SQLite with start <= ts < end, in time order."""
+    # Index range seek on (system_id, ts_ms)
+    for row in query_range(tank, start, end, system_id):
+        row['ts'] = row.pop('ts_ms') / 1000.0
+        yield row
+
+def read_history(tank, start, end, system_id=DEFAULT_SYSTEM_ID):
+    """
+    Yields every reading of one system's tank between two epoch times as dictionaries, in time order,
+    combining the archive segments with the rows still in SQLite.
+    """
+    # A crash between writing a segment and deleting its rows leaves them in both places. Both copies
+    # have the same id and ts, so they come out of the merge next to each other: only the ids seen at
+    # the current ts need remembering, not every id of the range.
+    current_ts, ids_at_ts = None, set()
+    for row in heapq.merge(
+        _archived_rows(TANK_TABLES[tank], start, end, system_id),
+        _live_rows(tank, start, end, system_id),
+        key=lambda row: row['ts']
+    ):
+        if row['ts'] != current_ts:
+            current_ts, ids_at_ts = row['ts'], set()
+        elif row['id'] in ids_at_ts:
+            continue
+        ids_at_ts.add(row['id'])
+        yield row
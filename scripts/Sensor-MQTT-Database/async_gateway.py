@@ -0,0 +1,543 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import paho.mqtt.client as mqtt
+from config import (
+    INGEST_QUEUE_MAX_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL_SEC,
+    UPLOADER_QUEUE_MAX_SIZE, FIRESTORE_TIMEOUT_SEC, ASYNC_UPLOAD_CONCURRENCY,
+    HEALTH_PROBE_HOST, HEALTH_PROBE_PORT, HEALTH_PROBE_TIMEOUT_SEC
+)
+from sqlite_handler import (
+    insert_batch, write_summaries, mark_uploaded, make_record, pending_ids, pending_count,
+    QUARANTINE, SUMMARIES
+)
+from ingest_queue import reading_key
+from dedupe import RecentKeys
+from backlog_scheduler import BacklogScheduler, HALF_OPEN
+from subscriber import upload_batch_to_firestore, backlog_pass, TANK_COLLECTIONS, UPLOAD_STEP
+from metrics import DUPLICATES_IGNORED
+
+logger = logging.getLogger(__name__)
+
+# --- Asyncio Runtime ---
+# The pieces of the gateway pipeline for main_async.py, where one event loop replaces paho's network
+# thread, the SQLite writer thread, the uploader pool and the backlog thread. Blocking work still
+# needs threads, but only two kinds and on purpose: every SQLite call goes through one executor
+# thread (so the writer connection, the upload filter and the tank lookup tables are only ever
+# touched from there), and Firestore calls go through a pool sized to the upload semaphore.
+# Everything in this module runs on the event loop thread unless it is handed to an executor.
+
+def sqlite_executor():
+    """The single thread all SQLite work of the asyncio runtime runs on."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+class MqttSocketBridge:
+    """
+    Drives a paho client from the event loop instead of loop_start()'s thread, by watching its socket
+    (the pattern from paho's asyncio example). Callbacks such as on_message run on the loop thread.
+    """
+
+    # Constructor for MqttSocketBridge class
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self._sock = None
+        self._paused = False
+        self._misc = None
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def pause_reading(self):
+        """Backpressure: stop reading the socket, so the broker holds the messages (TCP flow control)."""
+        if not self._paused:
+            self._paused = True
+            if self._sock is not None:
+                self.loop.remove_reader(self._sock)
+            logger.warning("Ingest queue full, paused reading from the broker")
+
+    def resume_reading(self):
+        if self._paused:
+            self._paused = False
+            if self._sock is not None:
+                self.loop.add_reader(self._sock, self.client.loop_read)
+            logger.info("Resumed reading from the broker")
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._sock = sock
+        self.closed.clear()
+        if not self._paused:
+            self.loop.add_reader(sock, client.loop_read)
+        self._misc = self.loop.create_task(self._misc_loop(), name="mqtt-misc")
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        self._sock = None
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+        self.closed.set()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        # Keep-alive pings and QoS retries, which loop_start()'s thread would otherwise do
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+class AsyncIngestQueue:
+    """
+    Event loop version of IngestQueue: on_message only enqueues, a writer task collects batches and
+    commits each one in a single transaction on the SQLite executor (group commit).
+    """
+
+    # Constructor for AsyncIngestQueue class
+    def __init__(self, db_executor, on_commit=None, max_size=INGEST_QUEUE_MAX_SIZE,
+                 batch_size=INGEST_BATCH_SIZE, flush_interval=INGEST_FLUSH_INTERVAL_SEC,
+                 recent_keys=None, upload_filter=None, on_store=None, on_full=None, on_space=None):
+        self.db_executor = db_executor
+        # Bounded queue: memory use is capped at max_size messages (plus the few read before reading paused)
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._overflow = deque()
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Same callbacks as IngestQueue, called on the loop thread
+        self.on_commit = on_commit
+        self.on_store = on_store
+        self.recent_keys = recent_keys if recent_keys is not None else RecentKeys()
+        # Only ever used on the SQLite executor thread, like in IngestQueue's writer thread
+        self.upload_filter = upload_filter
+        # Backpressure hooks (MqttSocketBridge.pause_reading / resume_reading): a paho callback can't
+        # await a full queue, so reading from the broker stops until the writer has caught up
+        self.on_full = on_full
+        self.on_space = on_space
+        self._full = False
+        self._next_window_check = 0.0
+        self.running = False
+        self._task = None
+
+        # --- Counters (read with stats()) ---
+        self.enqueued = 0      # messages accepted by put()
+        self.paused = 0        # times the queue filled up and reading from the broker paused
+        self.duplicates = 0    # redelivered readings dropped (in memory or by the unique index)
+        self.written = 0       # rows committed to SQLite
+        self.failed = 0        # rows lost because their batch transaction failed
+        self.batches = 0       # number of group commits
+        self.max_depth = 0     # highest queue depth seen
+
+    def start(self):
+        """Starts the writer task."""
+        self.running = True
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="sqlite-writer")
+
+    def put(self, tank, row):
+        """
+        Queues one decoded message (an insert tuple) for writing; called by on_message on the loop thread.
+        Never drops a message: when the queue is full it is held aside and on_full() stops further reads.
+        """
+        key = None if tank == QUARANTINE else reading_key(tank, row)
+        if key is not None and self.recent_keys.seen(key):
+            self.duplicates += 1
+            DUPLICATES_IGNORED.inc(tank, 'memory')
+            return True
+        if self._full or self._queue.full():
+            self._overflow.append((tank, row))
+            if not self._full:
+                self._full = True
+                self.paused += 1
+                if self.on_full is not None:
+                    self.on_full()
+        else:
+            self._queue.put_nowait((tank, row))
+        self.enqueued += 1
+        depth = self._queue.qsize() + len(self._overflow)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    async def stop(self):
+        """Stops the writer task after flushing everything still queued."""
+        self.running = False
+        if self._task is not None:
+            await self._task
+
+    def stats(self):
+        """Returns a snapshot of the queue counters."""
+        return {
+            'depth': self._queue.qsize() + len(self._overflow),
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'paused': self.paused,
+            'duplicates': self.duplicates,
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        # Keep going until stop() was called AND the queue has been drained
+        while self.running or not self._queue.empty() or self._overflow:
+            batch = await self._collect()
+            if batch:
+                try:
+                    await self._flush(batch)
+                # The writer task must survive anything a callback throws
+                except Exception:
+                    logger.exception("Error in async ingest writer")
+            self._refill()
+            if self.upload_filter is not None and loop.time() >= self._next_window_check:
+                # Summary windows whose system went quiet are closed by time, about once a second
+                self._next_window_check = loop.time() + 1.0
+                await self._commit_summaries(self.upload_filter.due_windows)
+        if self.upload_filter is not None:
+            # Summarize the windows still open so far; readings after a restart update them
+            await self._commit_summaries(self.upload_filter.open_windows)
+
+    def _refill(self):
+        """Moves held-aside messages into the queue; resumes reading once the queue is half empty."""
+        while self._overflow and not self._queue.full():
+            self._queue.put_nowait(self._overflow.popleft())
+        if self._full and not self._overflow and self._queue.qsize() <= self.max_size // 2:
+            self._full = False
+            if self.on_space is not None:
+                self.on_space()
+
+    async def _collect(self):
+        """Waits for the first message, then gathers more until the batch is full or the interval expires."""
+        try:
+            first = await asyncio.wait_for(self._queue.get(), self.flush_interval)
+        except asyncio.TimeoutError:
+            return []
+
+        loop = asyncio.get_running_loop()
+        batch = [first]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            # Whatever is already queued costs no wait
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch):
+        """Writes one batch in a single transaction and hands the committed rows to on_commit."""
+        grouped = {}
+        for tank, row in batch:
+            grouped.setdefault(tank, []).append(row)
+
+        result = await asyncio.get_running_loop().run_in_executor(
+            self.db_executor, insert_batch, grouped, self.upload_filter
+        )
+
+        self.batches += 1
+        if result is None:
+            self.failed += len(batch)
+            for tank, row in batch:
+                if tank != QUARANTINE:
+                    self.recent_keys.forget(reading_key(tank, row))
+            logger.error("Batch of %d messages could not be saved", len(batch))
+            return
+
+        uploads, stored_rows = result
+        stored = sum(len(rows) for rows in stored_rows.values())
+        self.written += stored
+        # Copies older than the in-memory window, caught by the unique index
+        self.duplicates += len(batch) - stored
+
+        # Nested under one key: a tank named like a LogRecord attribute (e.g. 'name') would make logging raise
+        logger.info("Saved batch of %d messages", len(batch),
+                    extra={'batch_rows': {tank: len(rows) for tank, rows in grouped.items()}})
+
+        if self.on_store is not None:
+            for tank, rows in stored_rows.items():
+                if tank != QUARANTINE:
+                    self.on_store(tank, rows)
+        if self.on_commit is not None:
+            for tank, (ids, rows) in uploads.items():
+                self.on_commit(tank, ids, rows)
+
+    async def _commit_summaries(self, close_windows):
+        """Closes windows and writes their summaries on the SQLite executor, then hands them to on_commit."""
+        def summarize():
+            windows = close_windows()
+            return windows, write_summaries(windows) if windows else None
+
+        windows, result = await asyncio.get_running_loop().run_in_executor(self.db_executor, summarize)
+        if not windows:
+            return
+        if result is None:
+            logger.error("Summaries of %d windows could not be saved", len(windows))
+            return
+        ids, rows = result
+        if rows and self.on_commit is not None:
+            self.on_commit(SUMMARIES, ids, rows)
+
+class AsyncUploader:
+    """
+    Uploads freshly saved rows as tasks on the event loop. At most `concurrency` uploads (live and
+    backlog together) talk to Firestore at once; each runs the blocking SDK call on the upload pool.
+    """
+
+    # Constructor for AsyncUploader class
+    def __init__(self, db, db_executor, concurrency=ASYNC_UPLOAD_CONCURRENCY, max_pending=UPLOADER_QUEUE_MAX_SIZE,
+                 timeout=FIRESTORE_TIMEOUT_SEC, breaker=None, on_pending=None):
+        self.db = db
+        self.db_executor = db_executor
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # Shared with the backlog scheduler: while it is open, uploads are left to the backlog
+        self.breaker = breaker
+        # Called with no arguments whenever rows were left at uploaded = 0 for the backlog
+        self.on_pending = on_pending
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="cloud-upload")
+        self._tasks = set()
+
+        # --- Counters (read with stats()) ---
+        self.submitted = 0       # batches accepted by submit()
+        self.skipped = 0         # batches left to the backlog because too many were waiting
+        self.uploaded = 0        # rows confirmed in Firestore
+        self.failed = 0          # rows that failed and stay pending for the backlog
+        self.deferred = 0        # rows not attempted because the circuit was open
+        self.already_uploaded = 0  # rows skipped because the backlog confirmed them first
+        self.requests = 0        # upload calls made
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def submit(self, tank, ids, rows):
+        """
+        Starts the upload of committed insert tuples as a task. Never blocks: if max_pending batches are
+        already waiting, the rows simply stay at uploaded = 0 and the backlog picks them up later.
+        """
+        if not self.db:
+            return False
+        if len(self._tasks) >= self.max_pending:
+            self.skipped += 1
+            self._left_pending()
+            return False
+        # Same record shape as the backlog, so live and backlog uploads produce identical documents
+        records = [(row_id, make_record(tank, row_id, row)) for row_id, row in zip(ids, rows)]
+        task = asyncio.get_running_loop().create_task(self._upload(tank, records))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.submitted += 1
+        return True
+
+    async def upload_records(self, collection, records):
+        """Uploads (row id, record) pairs within the concurrency limit. Returns the confirmed row ids."""
+        async with self.semaphore:
+            start = time.monotonic()
+            uploaded_ids = await asyncio.get_running_loop().run_in_executor(
+                self._pool, partial(upload_batch_to_firestore, self.db, collection, records, timeout=self.timeout)
+            )
+            latency = time.monotonic() - start
+        self.requests += 1
+        self.total_latency += latency
+        self.last_latency = latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+        return uploaded_ids
+
+    async def stop(self, timeout=None):
+        """Waits for the uploads in flight (at most timeout seconds); the rest stays pending for the backlog."""
+        if self._tasks:
+            done, unfinished = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                logger.warning("%d uploads unfinished at shutdown, left to the backlog", len(unfinished))
+        # A Firestore call already running can't be interrupted; don't wait for it
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """Returns a snapshot of upload latency and the number of uploads waiting or in flight."""
+        return {
+            'queue_depth': len(self._tasks),
+            'submitted': self.submitted,
+            'skipped': self.skipped,
+            'uploaded': self.uploaded,
+            'failed': self.failed,
+            'already_uploaded': self.already_uploaded,
+            'deferred': self.deferred,
+            'avg_latency_sec': self.total_latency / self.requests if self.requests else 0.0,
+            'max_latency_sec': self.max_latency,
+            'last_latency_sec': self.last_latency,
+        }
+
+    async def _upload(self, tank, records):
+        try:
+            await self._upload_batch(tank, records)
+        except asyncio.CancelledError:
+            raise
+        # A failed upload must not surface as an unretrieved task exception; the backlog retries it
+        except Exception:
+            logger.exception("Error in cloud uploader for %s", tank)
+
+    async def _upload_batch(self, tank, records):
+        """Uploads one batch of (row id, record) pairs and flags the confirmed rows."""
+        loop = asyncio.get_running_loop()
+        # The backlog may have uploaded some of these while this task waited for the semaphore
+        waiting = set(await loop.run_in_executor(
+            self.db_executor, pending_ids, tank, [row_id for row_id, record in records]
+        ))
+        if len(waiting) < len(records):
+            skipped = len(records) - len(waiting)
+            records = [(row_id, record) for row_id, record in records if row_id in waiting]
+            self.already_uploaded += skipped
+            DUPLICATES_IGNORED.inc(tank, 'upload', amount=skipped)
+            if not records:
+                return
+        if self.breaker is not None and not self.breaker.allow():
+            # Firestore is down: don't wait out a timeout, the backlog uploads these once it is back
+            self.deferred += len(records)
+            self._left_pending()
+            return
+        uploaded_ids = await self.upload_records(TANK_COLLECTIONS[tank], records)
+
+        # Anything that failed stays at uploaded = 0 for the backlog
+        await loop.run_in_executor(self.db_executor, mark_uploaded, tank, uploaded_ids)
+        self.uploaded += len(uploaded_ids)
+        self.failed += len(records) - len(uploaded_ids)
+
+        if self.breaker is not None:
+            # Only a batch with no confirmed record at all counts as an outage, not a few bad documents
+            if uploaded_ids:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        if len(uploaded_ids) < len(records):
+            self._left_pending()
+
+    def _left_pending(self):
+        if self.on_pending is not None:
+            self.on_pending()
+
+async def async_tcp_probe(host=HEALTH_PROBE_HOST, port=HEALTH_PROBE_PORT, timeout=HEALTH_PROBE_TIMEOUT_SEC):
+    """tcp_probe() without blocking the event loop."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+class AsyncBacklogScheduler(BacklogScheduler):
+    """
+    BacklogScheduler as a task on the event loop: the same pacing, breaker handling and stats,
+    with the backlog pages read on the SQLite executor and uploaded through the AsyncUploader.
+    drain_now() and notify_pending() must be called on the loop thread.
+    """
+
+    # Constructor for AsyncBacklogScheduler class
+    def __init__(self, db, uploader, db_executor, breaker=None, probe=async_tcp_probe, **kwargs):
+        super().__init__(db, breaker, probe, **kwargs)
+        self.uploader = uploader
+        self.db_executor = db_executor
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """Starts the scheduler task; the first backlog run happens right away."""
+        self.running = True
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="backlog-scheduler")
+
+    async def stop(self, timeout=None):
+        """Stops the task after the current run, or cancels the run after timeout seconds."""
+        self.running = False
+        self._wake.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Backlog run unfinished at shutdown")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.running:
+            due = self._drain_requested or loop.time() >= self._next_run
+            self._drain_requested = False
+            if due:
+                try:
+                    delay = await self.run_once()
+                # The task must survive anything the Firestore client or SQLite throws
+                except Exception:
+                    logger.exception("Error in backlog scheduler")
+                    delay = self.interval
+                self._last_run = loop.time()
+                self._next_run = self._last_run + delay
+            wait = 0.0 if self._drain_requested else self._next_run - loop.time()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+
+    async def run_once(self):
+        """One scheduling step. Returns the number of seconds until the next step is due."""
+        if not self.breaker.allow():
+            return self.breaker.retry_after() or self.interval
+
+        if self.breaker.state == HALF_OPEN:
+            # Probe before spending a Firestore timeout on real documents
+            self.probes += 1
+            if not await self.probe():
+                self.probe_failures += 1
+                self.breaker.record_failure()
+                return self.breaker.retry_after()
+
+        if await self._run_db(pending_count) == 0:
+            if self.breaker.state == HALF_OPEN:
+                # Nothing to upload as the trial: the probe has to do
+                self.breaker.record_success()
+            return self.idle_interval
+
+        self.runs += 1
+        uploaded, failed = await self.upload_backlog()
+        self.uploaded += uploaded
+        if uploaded == 0 and failed > 0:
+            self.breaker.record_failure()
+            return self.breaker.retry_after() or self.interval
+        self.breaker.record_success()
+        return self.interval if await self._run_db(pending_count) > 0 else self.idle_interval
+
+    async def upload_backlog(self):
+        """
+        process_and_upload_backlog for the event loop: runs backlog_pass() with SQLite steps on the
+        executor and uploads through the AsyncUploader. Returns (records uploaded, records that failed).
+        """
+        steps = backlog_pass()
+        result = None
+        while True:
+            try:
+                step, target, args = steps.send(result)
+            except StopIteration as done:
+                return done.value
+            if step == UPLOAD_STEP:
+                result = await self.uploader.upload_records(target, args)
+            else:
+                result = await self._run_db(target, *args)
+
+    def _run_db(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.db_executor, func, *args)
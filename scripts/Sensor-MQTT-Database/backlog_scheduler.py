@@ -0,0 +1,233 @@
+import logging
+import random
+import socket
+import threading
+import time
+from config import (
+    BACKLOG_CHECK_INTERVAL_SEC, BACKLOG_IDLE_INTERVAL_SEC,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_DELAY_SEC, CIRCUIT_MAX_DELAY_SEC,
+    HEALTH_PROBE_HOST, HEALTH_PROBE_PORT, HEALTH_PROBE_TIMEOUT_SEC
+)
+from sqlite_handler import pending_count
+from subscriber import process_and_upload_backlog
+
+logger = logging.getLogger(__name__)
+
+# --- Backlog Scheduler ---
+# Replaces the fixed "upload the backlog every 20 seconds" loop. While Firestore is unreachable
+# the circuit breaker keeps every uploader away from it, so an outage costs one TCP probe per
+# backoff step instead of a timeout per pending record. The backlog drains straight away when
+# connectivity returns (probe success, MQTT reconnect, a live upload getting through), and the
+# scheduler thread sleeps while nothing is pending.
+
+CLOSED = 'closed'          # uploads go ahead
+OPEN = 'open'              # Firestore is considered down; nobody tries until the backoff has passed
+HALF_OPEN = 'half_open'    # backoff over: one trial (the probe, then an upload) decides
+
+class CircuitBreaker:
+    """
+    Counts consecutive upload failures shared by every uploader thread. Thread-safe.
+    Opens after failure_threshold failures; each reopening doubles the delay up to max_delay,
+    with "equal jitter" (half fixed, half random) so gateways don't all retry at the same moment.
+    """
+
+    # Constructor for CircuitBreaker class
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, base_delay=CIRCUIT_BASE_DELAY_SEC,
+                 max_delay=CIRCUIT_MAX_DELAY_SEC, on_close=None):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Called (outside the lock) whenever the circuit closes again after an outage
+        self.on_close = on_close
+        self.state = CLOSED
+        self.failures = 0          # consecutive failures
+        self.openings = 0          # times opened since the last success, drives the backoff
+        self.opened_total = 0
+        self._retry_at = 0.0
+        self._trial_taken = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if the caller may talk to Firestore now. In half-open state only the first caller may."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() >= self._retry_at:
+                self.state = HALF_OPEN
+                self._trial_taken = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial_taken:
+                self._trial_taken = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self.failures = 0
+            self.openings = 0
+        if recovered:
+            logger.info("Firestore reachable again, circuit closed")
+            if self.on_close is not None:
+                self.on_close()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CLOSED and self.failures < self.failure_threshold:
+                return
+            delay = self.backoff_delay(self.openings)
+            self.openings += 1
+            self.opened_total += 1
+            self.state = OPEN
+            self._retry_at = time.monotonic() + delay
+        logger.warning("Firestore unreachable, circuit open; next attempt in %.0f s", delay,
+                       extra={'failures': self.failures})
+
+    def backoff_delay(self, attempt):
+        """Delay before the trial after the attempt-th opening (0-based)."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def reset(self):
+        """Evidence that the link is back (e.g. MQTT reconnected): allow a trial now instead of after the backoff."""
+        with self._lock:
+            if self.state == OPEN:
+                self._retry_at = 0.0
+
+    def retry_after(self):
+        """Seconds until a trial is allowed (0 unless the circuit is open)."""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._retry_at - time.monotonic())
+
+def tcp_probe(host=HEALTH_PROBE_HOST, port=HEALTH_PROBE_PORT, timeout=HEALTH_PROBE_TIMEOUT_SEC):
+    """
+    Cheap connectivity check: DNS lookup plus a TCP handshake with the Firestore endpoint.
+    No request is sent, so it costs no Firestore reads and only a few packets.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+class BacklogScheduler:
+    """Runs process_and_upload_backlog on its own thread, paced by the circuit breaker and the backlog size."""
+
+    # Constructor for BacklogScheduler class
+    def __init__(self, db, breaker=None, probe=tcp_probe, interval=BACKLOG_CHECK_INTERVAL_SEC,
+                 idle_interval=BACKLOG_IDLE_INTERVAL_SEC):
+        self.db = db
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.breaker.on_close = self.drain_now
+        self.probe = probe
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.running = False
+        self._thread = None
+        self._wake = threading.Event()
+        self._drain_requested = False
+        self._next_run = 0.0
+        self._last_run = 0.0
+        self._lock = threading.Lock()
+
+        # --- Counters (read with stats()) ---
+        self.runs = 0
+        self.probes = 0
+        self.probe_failures = 0
+        self.uploaded = 0
+
+    def start(self):
+        """Starts the scheduler thread; the first backlog run happens right away."""
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name="backlog-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the thread after the current run (an upload in progress is not interrupted)."""
+        self.running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def drain_now(self):
+        """Connectivity is back: skip the remaining backoff and upload the backlog immediately."""
+        self.breaker.reset()
+        with self._lock:
+            self._drain_requested = True
+        self._wake.set()
+
+    def notify_pending(self):
+        """
+        Rows were left at uploaded = 0 (a live upload failed or was deferred). Cuts an idle sleep
+        short to the normal interval; it never runs the backlog sooner than that or during a backoff.
+        """
+        with self._lock:
+            self._next_run = min(self._next_run, self._last_run + self.interval)
+        self._wake.set()
+
+    def stats(self):
+        """Returns a snapshot of the scheduler and circuit breaker state."""
+        with self._lock:
+            next_run_in = max(0.0, self._next_run - time.monotonic())
+        return {
+            'circuit': self.breaker.state,
+            'failures': self.breaker.failures,
+            'circuit_opened': self.breaker.opened_total,
+            'next_run_in_sec': round(next_run_in, 1),
+            'runs': self.runs,
+            'probes': self.probes,
+            'probe_failures': self.probe_failures,
+            'uploaded': self.uploaded,
+        }
+
+    def _run(self):
+        while self.running:
+            with self._lock:
+                due = self._drain_requested or time.monotonic() >= self._next_run
+                self._drain_requested = False
+            if due:
+                try:
+                    delay = self.run_once()
+                # The thread must survive anything the Firestore client or SQLite throws
+                except Exception:
+                    logger.exception("Error in backlog scheduler")
+                    delay = self.interval
+                with self._lock:
+                    self._last_run = time.monotonic()
+                    self._next_run = self._last_run + delay
+            with self._lock:
+                wait = 0.0 if self._drain_requested else self._next_run - time.monotonic()
+            if wait > 0:
+                self._wake.wait(wait)
+            self._wake.clear()
+
+    def run_once(self):
+        """One scheduling step. Returns the number of seconds until the next step is due."""
+        if not self.breaker.allow():
+            return self.breaker.retry_after() or self.interval
+
+        if self.breaker.state == HALF_OPEN:
+            # Probe before spending a Firestore timeout on real documents
+            self.probes += 1
+            if not self.probe():
+                self.probe_failures += 1
+                self.breaker.record_failure()
+                return self.breaker.retry_after()
+
+        if pending_count() == 0:
+            if self.breaker.state == HALF_OPEN:
+                # Nothing to upload as the trial: the probe has to do
+                self.breaker.record_success()
+            return self.idle_interval
+
+        self.runs += 1
+        uploaded, failed = process_and_upload_backlog(self.db)
+        self.uploaded += uploaded
+        if uploaded == 0 and failed > 0:
+            self.breaker.record_failure()
+            return self.breaker.retry_after() or self.interval
+        self.breaker.record_success()
+        return self.interval if pending_count() > 0 else self.idle_interval
@@ -0,0 +1,316 @@
+# Micro-benchmarks for the gateway's hot paths: MQTT message handling, SQLite inserts,
+# backlog reads and the backlog upload. Every run uses a fresh temporary database filled to
+# each requested size, fake MQTT messages and an in-memory stand-in for Firestore, so it is
+# safe to run next to the live gateway. Results are printed and written to a JSON file so
+# runs can be compared before and after a change.
+#
+# Usage: python3 benchmark.py [--sizes 10000,1000000,10000000] [--ops 2000] [--output results.json]
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import resource
+import tracemalloc
+import contextlib
+from config import TOPIC_SUBSCRIBE_MAIN, INGEST_BATCH_SIZE, DEFAULT_SYSTEM_ID
+from sqlite_handler import (
+    init_db, close_db, get_manager, insert_main_data, insert_batch, main_row,
+    fetch_unuploaded_data, iter_pending, query_range, pending_count
+)
+from subscriber import on_message, process_and_upload_backlog
+from ingest_queue import IngestQueue
+from decoders import JSON_BACKEND
+from logging_setup import setup_logging
+
+FILL_CHUNK_ROWS = 100000
+FILL_INTERVAL_SEC = 10
+FILL_SQL = '''
+    INSERT INTO main_tank_logs (system_id, timestamp, ts_ms, temperature_C, light_intensity_lux,
+                                water_level_cm, pH_value, uploaded)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# --- Fakes ---
+class FakeMessage:
+    """Just the attributes of paho's MQTTMessage that on_message reads."""
+
+    # Constructor for FakeMessage class
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class MemoryDocument:
+    def __init__(self, store, collection, doc_id):
+        self._store = store
+        self._collection = collection
+        self.id = doc_id
+
+    def set(self, data, timeout=None):
+        self._store.write(self._collection, self.id, data)
+
+class MemoryCollection:
+    def __init__(self, store, name):
+        self._store = store
+        self._name = name
+
+    def document(self, doc_id=None):
+        return MemoryDocument(self._store, self._name, doc_id)
+
+class MemoryBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, reference, data):
+        self._writes.append((reference, data))
+
+    def commit(self, timeout=None):
+        self._store.round_trip()
+        for reference, data in self._writes:
+            self._store.documents[(reference._collection, reference.id)] = data
+
+class MemoryFirestore:
+    """
+    In-memory stand-in for the Firestore client: the collection/document/batch calls the
+    upload code makes, with an optional fixed delay per request to mimic the network.
+    """
+
+    # Constructor for MemoryFirestore class
+    def __init__(self, latency_sec=0.0):
+        self.latency_sec = latency_sec
+        self.documents = {}
+        self.requests = 0
+
+    def round_trip(self):
+        self.requests += 1
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+
+    def write(self, collection, doc_id, data):
+        self.round_trip()
+        self.documents[(collection, doc_id)] = data
+
+    def collection(self, name):
+        return MemoryCollection(self, name)
+
+    def batch(self):
+        return MemoryBatch(self)
+
+# --- Measurement ---
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def measure(operation, repeat, rows_per_op=1, setup=None):
+    """
+    Calls operation() `repeat` times and returns latency percentiles (ms), rows/s and the peak
+    Python memory of one extra call. setup(), if given, runs untimed before every call.
+    """
+    latencies = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter_ns()
+        operation()
+        latencies.append(time.perf_counter_ns() - start)
+
+    # Memory is traced in a separate call: tracemalloc would distort the timings above
+    if setup:
+        setup()
+    tracemalloc.start()
+    operation()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    total_sec = sum(latencies) / 1e9
+    return {
+        'ops': repeat,
+        'rows': repeat * rows_per_op,
+        'total_sec': round(total_sec, 4),
+        'rows_per_sec': round(repeat * rows_per_op / total_sec, 1) if total_sec else None,
+        'latency_ms': {
+            'mean': round(total_sec * 1000 / repeat, 4),
+            'p50': round(percentile(latencies, 0.50) / 1e6, 4),
+            'p90': round(percentile(latencies, 0.90) / 1e6, 4),
+            'p99': round(percentile(latencies, 0.99) / 1e6, 4),
+            'max': round(latencies[-1] / 1e6, 4),
+        },
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+# --- Data ---
+def sample_reading(n, ts):
+    return {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)),
+        'temperature_C': 20 + n % 50 / 10,
+        'light_intensity_lux': 1000.0 + n % 500,
+        'water_level_cm': 30 + n % 20 / 10,
+        'pH_value': 6.5 + n % 15 / 10,
+    }
+
+def fill_database(size, pending):
+    """Inserts `size` main tank rows, one every FILL_INTERVAL_SEC up to now; the newest `pending` are not uploaded."""
+    now = int(time.time())
+    first_ts = now - size * FILL_INTERVAL_SEC
+    manager = get_manager()
+    for chunk_start in range(0, size, FILL_CHUNK_ROWS):
+        rows = []
+        for n in range(chunk_start, min(size, chunk_start + FILL_CHUNK_ROWS)):
+            ts = first_ts + n * FILL_INTERVAL_SEC
+            row = main_row(sample_reading(n, ts), ts)
+            rows.append(row + (0 if n >= size - pending else 1,))
+        with manager.writer() as conn:
+            conn.executemany(FILL_SQL, rows)
+
+def reset_backlog(first_pending_id):
+    """Marks every row from first_pending_id on as not uploaded again and rewinds the watermark."""
+    if first_pending_id is None:
+        return
+    with get_manager().writer() as conn:
+        conn.execute("UPDATE main_tank_logs SET uploaded = 0 WHERE id >= ? AND uploaded != 0", (first_pending_id,))
+        conn.execute("UPDATE outbox_counts SET watermark = 0")
+
+# --- Benchmarks ---
+def run_size(size, ops, pending, firestore_latency):
+    """Runs every benchmark against a fresh database holding `size` rows."""
+    folder = tempfile.mkdtemp(prefix='gateway-benchmark-')
+    db_path = os.path.join(folder, 'benchmark.db')
+    # Keep the cost of anything the hot paths still print, but not the terminal output
+    quiet = open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stdout(quiet):
+            init_db(db_path)
+            start = time.monotonic()
+            fill_database(size, min(pending, size))
+        fill_sec = time.monotonic() - start
+        print(f"  filled {size} rows in {fill_sec:.1f}s")
+
+        results = {}
+        now = time.time()
+        payloads = [json.dumps(sample_reading(n, now + n)).encode('utf-8') for n in range(ops + 1)]
+        messages = iter([FakeMessage(TOPIC_SUBSCRIBE_MAIN, payload) for payload in payloads])
+
+        with contextlib.redirect_stdout(quiet):
+            # 1. MQTT callback: decode and enqueue only (the writer thread is not running yet)
+            # A tiny flush interval: the queue is already full when the writer starts, so batches still fill
+            # up, and the drain time isn't padded by the final wait for stragglers
+            ingest_queue = IngestQueue(max_size=ops * 2 + 1, flush_interval=0.001)
+            userdata = {'ingest_queue': ingest_queue}
+            results['on_message'] = measure(lambda: on_message(None, userdata, next(messages)), ops)
+
+            # 2. Writer thread draining what on_message queued (group commits)
+            queued = ingest_queue.stats()['enqueued']
+            start = time.perf_counter()
+            ingest_queue.start()
+            ingest_queue.stop(timeout=None)
+            drain_sec = time.perf_counter() - start
+            results['ingest_queue_drain'] = {
+                'rows': queued,
+                'total_sec': round(drain_sec, 4),
+                'rows_per_sec': round(queued / drain_sec, 1) if drain_sec else None,
+                'batches': ingest_queue.stats()['batches'],
+            }
+
+            # 3. Single-row insert, one transaction per message
+            # Every benchmark uses its own timestamps: a repeated (system_id, ts_ms) is ignored as a duplicate
+            readings = iter([sample_reading(n, now + ops + 1 + n) for n in range(ops + 1)])
+            results['insert_main_data'] = measure(lambda: insert_main_data(next(readings)), ops)
+
+            # 4. Group commit of one ingest batch
+            batch_ops = max(1, ops // INGEST_BATCH_SIZE)
+            batch_start = now + 2 * ops + 2
+            batches = iter([
+                [main_row(sample_reading(n, batch_start + n), batch_start + n) for n in range(first, first + INGEST_BATCH_SIZE)]
+                for first in range(0, (batch_ops + 1) * INGEST_BATCH_SIZE, INGEST_BATCH_SIZE)
+            ])
+            results['insert_batch'] = measure(
+                lambda: insert_batch({'main_tank': next(batches)}), batch_ops, rows_per_op=INGEST_BATCH_SIZE
+            )
+
+            backlog_rows = pending_count('main_tank')
+            read_ops = max(3, ops // 100)
+
+            # 5. Backlog reads
+            results['fetch_unuploaded_data'] = measure(fetch_unuploaded_data, read_ops, rows_per_op=backlog_rows)
+            results['iter_pending_first_page'] = measure(lambda: next(iter_pending('main_tank'), None), ops)
+
+            # 6. Indexed range read of the last hour
+            results['query_range_1h'] = measure(
+                lambda: query_range('main_tank', now - 3600, now, DEFAULT_SYSTEM_ID), read_ops
+            )
+
+            # 7. Backlog upload to the in-memory Firestore, restoring the backlog before each run
+            with get_manager().reader() as conn:
+                first_pending_id = conn.execute(
+                    "SELECT MIN(id) FROM main_tank_logs WHERE uploaded = 0"
+                ).fetchone()[0]
+            firestore = MemoryFirestore(firestore_latency)
+            results['process_and_upload_backlog'] = measure(
+                lambda: process_and_upload_backlog(firestore), 3, rows_per_op=backlog_rows,
+                setup=lambda: reset_backlog(first_pending_id)
+            )
+
+        return {
+            'rows': size,
+            'pending_rows': backlog_rows,
+            'fill_sec': round(fill_sec, 1),
+            'db_bytes': os.path.getsize(db_path),
+            'operations': results,
+        }
+    finally:
+        close_db()
+        quiet.close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+def print_results(size, result):
+    print(f"  {'operation':<28}{'rows/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>10}")
+    for name, stats in result['operations'].items():
+        latency = stats.get('latency_ms', {})
+        print(f"  {name:<28}{stats['rows_per_sec'] or 0:>12.0f}"
+              f"{latency.get('p50', 0):>10.3f}{latency.get('p99', 0):>10.3f}{stats.get('peak_memory_kb', 0):>10.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gateway's ingest, storage and backlog paths.")
+    parser.add_argument('--sizes', default='10000,1000000,10000000',
+                        help="comma-separated table sizes to test (default: 10k, 1M and 10M rows)")
+    parser.add_argument('--ops', type=int, default=2000, help="operations per latency measurement")
+    parser.add_argument('--pending', type=int, default=5000, help="rows left un-uploaded (backlog size)")
+    parser.add_argument('--firestore-latency-ms', type=float, default=0.0,
+                        help="simulated delay per Firestore request")
+    parser.add_argument('--output', default=None, help="JSON results file (default: benchmark-<time>.json)")
+    args = parser.parse_args()
+
+    # Same logging pipeline as the gateway (queue + background writer), writing to nowhere
+    log_output = open(os.devnull, 'w')
+    log_listener = setup_logging(stream=log_output)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    output = args.output or time.strftime('benchmark-%Y%m%d-%H%M%S.json')
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': platform.platform(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'json_backend': JSON_BACKEND,
+        'settings': vars(args),
+        'sizes': {},
+    }
+
+    for size in sizes:
+        print(f"\n=== {size} rows ===")
+        report['sizes'][str(size)] = run_size(size, args.ops, args.pending, args.firestore_latency_ms / 1000)
+        print_results(size, report['sizes'][str(size)])
+
+    # ru_maxrss is in kilobytes on Linux
+    report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    log_listener.stop()
+    log_output.close()
+    print(f"\nResults written to {output}")
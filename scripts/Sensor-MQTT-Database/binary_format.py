@@ -0,0 +1,38 @@
+import math
+import struct
+from sqlite_handler import TANK_SENSORS
+
+# --- Compact Binary Sensor Payload, version 1 ---
+# Little-endian, one fixed layout per tank, no key names on the wire:
+#   version   : uint8    BINARY_VERSION
+#   ts_ms     : uint64   epoch milliseconds from the ESP32, 0 if its clock isn't set yet
+#   sensors   : float32  one per sensor in TANK_SENSORS order, NaN = sensor missing
+#   system_id : optional UTF-8 bytes filling the rest of the payload
+#
+# The matching ESP32 struct for main_tank (packed, 25 bytes + system id):
+#   struct __attribute__((packed)) MainTankPayload {
+#       uint8_t version; uint64_t ts_ms;
+#       float temperature_C, light_intensity_lux, water_level_cm, pH_value;
+#   };
+# A tank opts in by publishing on the sibling topic (<tank>/data/bin, or {system_id}/<tank>/data/bin)
+# or by setting the MQTT v5 content type to BINARY_CONTENT_TYPE on its normal topic.
+BINARY_VERSION = 1
+
+def binary_layout(sensor_count):
+    """Returns the version 1 struct layout for a tank with this many sensors."""
+    return struct.Struct('<BQ' + 'f' * sensor_count)
+
+def encode_binary(tank, readings, ts_ms=0, system_id=None):
+    """
+    Reference encoder: packs a readings dictionary (sensor name -> value) into a version 1 payload.
+    This is what the ESP32 firmware sends; the gateway itself only decodes.
+    """
+    sensors = TANK_SENSORS[tank]
+    values = (readings.get(name) for name in sensors)
+    payload = binary_layout(len(sensors)).pack(
+        BINARY_VERSION, ts_ms,
+        *(math.nan if value is None else value for value in values)
+    )
+    if system_id:
+        payload += system_id.encode('utf-8')
+    return payload
@@ -0,0 +1,158 @@
+import queue
+import logging
+import threading
+import time
+from config import UPLOADER_THREADS, UPLOADER_QUEUE_MAX_SIZE, FIRESTORE_TIMEOUT_SEC
+from sqlite_handler import mark_uploaded, make_record, pending_ids
+from metrics import DUPLICATES_IGNORED
+from subscriber import upload_batch_to_firestore, TANK_COLLECTIONS
+
+logger = logging.getLogger(__name__)
+
+class CloudUploader:
+    """
+    Pool of worker threads that upload freshly saved rows to Firestore.
+    The ingest path only calls submit(); a slow or unreachable Firestore delays
+    these workers, never the MQTT callback or the SQLite writer.
+    """
+
+    # Constructor for CloudUploader class
+    def __init__(self, db, threads=UPLOADER_THREADS, max_size=UPLOADER_QUEUE_MAX_SIZE,
+                 timeout=FIRESTORE_TIMEOUT_SEC, breaker=None, on_pending=None):
+        self.db = db
+        # Shared with the backlog scheduler: while it is open, uploads are left to the backlog
+        self.breaker = breaker
+        # Called with no arguments whenever rows were left at uploaded = 0 for the backlog
+        self.on_pending = on_pending
+        self.threads = threads
+        # Per-request deadline handed to every Firestore write
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._workers = []
+        self.running = False
+
+        # --- Counters (read with stats()) ---
+        self._stats_lock = threading.Lock()
+        self.submitted = 0       # batches accepted by submit()
+        self.skipped = 0         # batches left to the backlog because the queue was full
+        self.uploaded = 0        # rows confirmed in Firestore
+        self.failed = 0          # rows that failed and stay pending for the backlog
+        self.deferred = 0        # rows not attempted because the circuit was open
+        self.already_uploaded = 0  # rows skipped because the backlog confirmed them first
+        self.requests = 0        # upload calls made
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def start(self):
+        """Starts the uploader threads."""
+        self.running = True
+        for number in range(self.threads):
+            worker = threading.Thread(target=self._run, name=f"cloud-uploader-{number}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, tank, ids, rows):
+        """
+        Queues committed insert tuples for upload. Never blocks: if the queue is full the rows simply
+        stay at uploaded = 0 and the backlog task picks them up later.
+        """
+        if not self.db:
+            return False
+        # Same record shape as the backlog, so live and backlog uploads produce identical documents
+        records = [(row_id, make_record(tank, row_id, row)) for row_id, row in zip(ids, rows)]
+        try:
+            self._queue.put_nowait((tank, records))
+        except queue.Full:
+            with self._stats_lock:
+                self.skipped += 1
+            self._left_pending()
+            return False
+        with self._stats_lock:
+            self.submitted += 1
+        return True
+
+    def stop(self, timeout=None):
+        """Stops the workers once the queued uploads are finished (or after timeout seconds)."""
+        self.running = False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        self._workers = []
+
+    def stats(self):
+        """Returns a snapshot of upload latency and queue depth."""
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'submitted': self.submitted,
+                'skipped': self.skipped,
+                'uploaded': self.uploaded,
+                'failed': self.failed,
+                'already_uploaded': self.already_uploaded,
+                'deferred': self.deferred,
+                'avg_latency_sec': self.total_latency / self.requests if self.requests else 0.0,
+                'max_latency_sec': self.max_latency,
+                'last_latency_sec': self.last_latency,
+            }
+
+    def _run(self):
+        # Keep going until stop() was called AND the queue has been drained
+        while self.running or not self._queue.empty():
+            try:
+                tank, records = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._upload(tank, records)
+            # The worker must survive anything the Firestore client throws
+            except Exception:
+                logger.exception("Error in cloud uploader for %s", tank)
+
+    def _upload(self, tank, records):
+        """Uploads one batch of (row id, record) pairs and flags the confirmed rows."""
+        # The backlog task may have uploaded some of these while they sat in the queue
+        waiting = set(pending_ids(tank, [row_id for row_id, record in records]))
+        if len(waiting) < len(records):
+            skipped = len(records) - len(waiting)
+            records = [(row_id, record) for row_id, record in records if row_id in waiting]
+            with self._stats_lock:
+                self.already_uploaded += skipped
+            DUPLICATES_IGNORED.inc(tank, 'upload', amount=skipped)
+            if not records:
+                return
+        if self.breaker is not None and not self.breaker.allow():
+            # Firestore is down: don't wait out a timeout, the backlog uploads these once it is back
+            with self._stats_lock:
+                self.deferred += len(records)
+            self._left_pending()
+            return
+        start = time.monotonic()
+        uploaded_ids = upload_batch_to_firestore(self.db, TANK_COLLECTIONS[tank], records, timeout=self.timeout)
+        latency = time.monotonic() - start
+
+        # Flag the confirmed rows by primary key in one transaction;
+        # anything that failed stays at uploaded = 0 for the backlog
+        mark_uploaded(tank, uploaded_ids)
+
+        with self._stats_lock:
+            self.requests += 1
+            self.total_latency += latency
+            self.last_latency = latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+            self.uploaded += len(uploaded_ids)
+            self.failed += len(records) - len(uploaded_ids)
+
+        if self.breaker is not None:
+            # Only a batch with no confirmed record at all counts as an outage, not a few bad documents
+            if uploaded_ids:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        if len(uploaded_ids) < len(records):
+            self._left_pending()
+
+    def _left_pending(self):
+        if self.on_pending is not None:
+            self.on_pending()
@@ -0,0 +1,57 @@
+# Compares the JSON sensor payload with the compact binary one (binary_format.py):
+# bytes on the wire and the CPU time the gateway spends decoding each message.
+# Nothing is written to the database or sent to the broker.
+#
+# Usage: python3 compare_payload_formats.py [messages]
+import sys
+import json
+import time
+import random
+from sqlite_handler import TANK_SENSORS
+from binary_format import encode_binary
+from decoders import TopicDecoder, BinaryTopicDecoder, JSON_BACKEND
+
+# Typical readings, varied a little per message so the decoders can't benefit from identical input
+SAMPLE_READINGS = {
+    'main_tank': {'temperature_C': 24.3, 'light_intensity_lux': 1520.0, 'water_level_cm': 31.7, 'pH_value': 7.12},
+    'sampling_tank': {'EC_value': 1430.0},
+}
+
+def make_messages(tank, count):
+    """Returns the same readings as (JSON payload, binary payload) pairs."""
+    messages = []
+    start = int(time.time())
+    for n in range(count):
+        readings = {name: round(value * random.uniform(0.95, 1.05), 2)
+                    for name, value in SAMPLE_READINGS[tank].items()}
+        ts = start + n
+        # The ESP32 JSON format: readings plus a local-time timestamp string
+        json_payload = json.dumps(dict(readings, timestamp=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)),
+                                       system_id='system_1')).encode('utf-8')
+        binary_payload = encode_binary(tank, readings, ts_ms=ts * 1000, system_id='system_1')
+        messages.append((json_payload, binary_payload))
+    return messages
+
+def time_decoder(decoder, payloads):
+    """Returns the average decode time in microseconds."""
+    received_at = time.time()
+    start = time.perf_counter()
+    for payload in payloads:
+        decoder.decode(payload, received_at)
+    return (time.perf_counter() - start) / len(payloads) * 1e6
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{count} messages per tank, JSON backend: {JSON_BACKEND}\n")
+    print(f"{'tank':<15}{'format':<8}{'bytes':>8}{'decode us':>12}")
+    for tank, sensors in TANK_SENSORS.items():
+        messages = make_messages(tank, count)
+        json_payloads = [json_payload for json_payload, binary_payload in messages]
+        binary_payloads = [binary_payload for json_payload, binary_payload in messages]
+        results = (
+            ('json', json_payloads, TopicDecoder(tank, sensors)),
+            ('binary', binary_payloads, BinaryTopicDecoder(tank, sensors)),
+        )
+        for name, payloads, decoder in results:
+            average_bytes = sum(len(payload) for payload in payloads) / count
+            print(f"{tank:<15}{name:<8}{average_bytes:>8.1f}{time_decoder(decoder, payloads):>12.2f}")
@@ -8,6 +8,36 @@ KEEP_ALIVE_SEC = 60          # keep-alive timeout of 60 seconds
 # --- SQLite Database Configuration ---
 DB_NAME = "/home/bee/Sensor_MQTT_Firebase/algae_project.db"
 BACKLOG_CHECK_INTERVAL_SEC = 20
+# Rows converted per transaction by schema migrations (see migrate_database.py)
+MIGRATION_BATCH_SIZE = 5000
+# System stored with readings whose payload doesn't name one (matches the actuator side's system ids)
+DEFAULT_SYSTEM_ID = "system_1"
+BACKLOG_PAGE_SIZE = 500             # pending rows read (and held in memory) per backlog page
+
+# --- Retention / Archive Configuration ---
+# Uploaded rows older than RETENTION_DAYS move out of SQLite into compressed daily segment files
+ARCHIVE_DIR = "/home/bee/Sensor_MQTT_Firebase/archive"
+RETENTION_DAYS = 30
+ARCHIVE_BATCH_SIZE = 5000           # rows read, compressed and deleted per step
+RETENTION_CHECK_INTERVAL_SEC = 3600
+
+# Connection layer tuning (see sqlite_handler.ConnectionManager)
+DB_READER_POOL_SIZE = 2             # reader connections kept open alongside the single writer
+DB_BUSY_TIMEOUT_SEC = 5.0           # how long a connection waits on a locked database before failing
+DB_CACHE_SIZE_KB = 8192             # page cache per connection (8 MB)
+DB_MMAP_SIZE_BYTES = 64 * 1024 * 1024  # memory-map the first 64 MB of the database file for reads
+DB_STATEMENT_CACHE_SIZE = 64        # prepared statements cached per connection
+
+# --- Ingest Queue Configuration ---
+# MQTT messages are queued in memory and written to SQLite in batches by a separate writer thread
+INGEST_QUEUE_MAX_SIZE = 10000       # messages held in memory before backpressure kicks in
+INGEST_BATCH_SIZE = 200             # flush once this many messages are waiting...
+INGEST_FLUSH_INTERVAL_SEC = 0.25    # ...or once the oldest waiting message is this old
+INGEST_PUT_TIMEOUT_SEC = 0.5        # how long the MQTT callback may wait on a full queue before dropping
+# QoS 1 redeliveries and ESP32 republishes after a reconnect are dropped before they reach SQLite
+# if their (tank, system_id, ts_ms) key is among the most recent keys seen; older copies are
+# still caught by the unique index on each log table
+DEDUPE_CACHE_SIZE = 50000           # reading keys remembered in memory (~100 bytes each)
 
 # ---Firebase Configuration ---
 # Path to Service Account JSON file (Used for authentication)
@@ -15,11 +45,104 @@ FIREBASE_CREDENTIALS_PATH = "/home/bee/Firebase/smart-microalgae-cultivation-fir
 # Firestore collection path where the data should be saved
 MAIN_TANK_COLLECTION = "main_tank_data"
 SAMPLING_TANK_COLLECTION = "sampling_tank_data"
+# Documents per Firestore WriteBatch commit (500 is the Firestore maximum)
+FIRESTORE_BATCH_SIZE = 500
+# Deadline for a single Firestore write or batch commit, so a dead link can't hang a thread
+FIRESTORE_TIMEOUT_SEC = 10
+
+# --- Cloud Uploader Configuration ---
+# Freshly saved rows are uploaded by a pool of worker threads fed from a queue
+UPLOADER_THREADS = 2
+UPLOADER_QUEUE_MAX_SIZE = 100       # batches waiting for upload; when full, rows are left to the backlog
+
+# --- Backlog Scheduler ---
+# The backlog runs every BACKLOG_CHECK_INTERVAL_SEC while rows are pending and sleeps when none are.
+# After CIRCUIT_FAILURE_THRESHOLD failed uploads in a row the circuit opens: no Firestore calls at all
+# until a backoff delay (doubling from CIRCUIT_BASE_DELAY_SEC up to CIRCUIT_MAX_DELAY_SEC, with jitter)
+# has passed and a cheap TCP probe of the Firestore endpoint succeeds.
+BACKLOG_IDLE_INTERVAL_SEC = 300     # longest sleep while nothing is pending (new failures wake it sooner)
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_BASE_DELAY_SEC = 30
+CIRCUIT_MAX_DELAY_SEC = 1800
+HEALTH_PROBE_HOST = "firestore.googleapis.com"
+HEALTH_PROBE_PORT = 443
+HEALTH_PROBE_TIMEOUT_SEC = 3
+
+# --- Cloud Upload Policy ---
+# Decides which readings are sent to Firestore; SQLite always keeps every reading at full resolution.
+#   'all'      : upload every reading (the default, and what tanks not listed here get)
+#   'deadband' : upload a reading only when a sensor moved more than its dead-band since the last uploaded
+#                reading of that system (sensors without a dead-band count any change), or when nothing
+#                was uploaded for heartbeat_sec
+#   'summary'  : upload one min/mean/max document per system and window_sec to SUMMARY_COLLECTION
+#                instead of the readings
+# 'deadband' and 'summary' are opt-in: they leave gaps in the Firestore data that apps reading it must expect.
+# e.g. 'main_tank': {'mode': 'deadband', 'heartbeat_sec': 600,
+#                    'deadband': {'temperature_C': 0.2, 'light_intensity_lux': 50.0, 'water_level_cm': 0.5, 'pH_value': 0.05}}
+#      'sampling_tank': {'mode': 'summary', 'window_sec': 300}
+UPLOAD_POLICIES = {
+    'main_tank': {'mode': 'all'},
+    'sampling_tank': {'mode': 'all'},
+}
+SUMMARY_COLLECTION = "sensor_summaries"
+# A summary window with no newer reading is closed this long after its end (covers late and slow messages)
+SUMMARY_CLOSE_DELAY_SEC = 60
+
+# --- Payload Validation ---
+# Readings outside these (inclusive) ranges are rejected into the quarantine table instead of being stored
+SENSOR_VALID_RANGES = {
+    'temperature_C': (-10.0, 60.0),
+    'light_intensity_lux': (0.0, 200000.0),
+    'water_level_cm': (0.0, 500.0),
+    'pH_value': (0.0, 14.0),
+    'EC_value': (0.0, 200000.0),
+}
+QUARANTINE_PAYLOAD_MAX_BYTES = 4096  # rejected payloads are kept up to this size for inspection
+
+# --- Logging ---
+# Log lines are written by a background thread (see logging_setup.py)
+LOG_LEVEL = "INFO"
+LOG_VERBOSE = False                 # True (or main.py --verbose): DEBUG detail for every message, no rate limiting
+LOG_QUEUE_MAX_SIZE = 10000          # records waiting for the writer thread; beyond this they are dropped
+LOG_RATE_LIMIT_BURST = 10           # per-message log lines let through per template...
+LOG_RATE_LIMIT_INTERVAL_SEC = 60    # ...in each window of this many seconds
+
+# --- Metrics ---
+# Local HTTP endpoint serving /metrics in Prometheus text format (port 0 turns it off)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# --- Local Read API ---
+# HTTP/JSON endpoints for dashboards on the LAN: /latest and /recent come from an in-memory ring buffer,
+# /history from SQLite (and the archive). Port 0 turns it off.
+READ_API_HOST = "0.0.0.0"
+READ_API_PORT = 8080
+READ_API_RING_SIZE = 720            # readings kept in memory per tank and system (1 h at one reading per 5 s)
+READ_API_RECENT_SEC = 600           # default span of /recent
+READ_API_MAX_ROWS = 10000           # raw readings returned by one /history request at most
+
+# --- Asyncio Runtime (main_async.py) ---
+# Alternative entry point that runs MQTT, ingest, uploads and the periodic jobs on one event loop.
+# SQLite runs on a single executor thread; Firestore calls (the SDK is blocking) on a small pool.
+ASYNC_UPLOAD_CONCURRENCY = 4        # Firestore uploads in flight at once, live and backlog together
+ASYNC_MQTT_RECONNECT_MAX_SEC = 60   # longest wait between broker reconnect attempts
+ASYNC_SHUTDOWN_TIMEOUT_SEC = 15     # how long shutdown waits for in-flight uploads before leaving them to the backlog
 
 # --- Topics ---
 # The Pi will subscribe to this topic to receive data from the ESP32.
 TOPIC_SUBSCRIBE_MAIN = "main_tank/data"
 TOPIC_SUBSCRIBE_SAMPLE = "sampling_tank/data"
+# Sibling topics for the compact binary payload (see binary_format.py)
+TOPIC_SUBSCRIBE_MAIN_BINARY = "main_tank/data/bin"
+TOPIC_SUBSCRIBE_SAMPLE_BINARY = "sampling_tank/data/bin"
+# MQTT v5 content type that marks a binary payload sent on the normal JSON topic
+BINARY_CONTENT_TYPE = "application/x-sensor-struct"
+# Per-system topics {system_id}/{tank}/data (JSON) and {system_id}/{tank}/data/bin (binary), matching
+# the actuator side's {system_id}/... addressing. One wildcard each covers every system and tank,
+# including tanks registered later (register_tank.py); unknown tanks end up in the quarantine table.
+TOPIC_SUBSCRIBE_SYSTEMS = "+/+/data"
+TOPIC_SUBSCRIBE_SYSTEMS_BINARY = "+/+/data/bin"
+TOPIC_CACHE_MAX_SIZE = 10000        # resolved per-system topics remembered by the decoder registry
 
 # The Pi will publish commands/data to this topic (not used in this combined file, 
 # but included for future modularity if the Pi became a dedicated publisher).
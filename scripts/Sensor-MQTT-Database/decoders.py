@@ -0,0 +1,282 @@
+import json
+import threading
+import time
+from config import (
+    TOPIC_SUBSCRIBE_MAIN, TOPIC_SUBSCRIBE_SAMPLE,
+    TOPIC_SUBSCRIBE_MAIN_BINARY, TOPIC_SUBSCRIBE_SAMPLE_BINARY, BINARY_CONTENT_TYPE,
+    TOPIC_CACHE_MAX_SIZE,
+    SENSOR_VALID_RANGES, DEFAULT_SYSTEM_ID, QUARANTINE_PAYLOAD_MAX_BYTES
+)
+from sqlite_handler import TANK_SENSORS
+from time_utils import parse_timestamp, MAX_EPOCH_MS
+from binary_format import BINARY_VERSION, binary_layout
+
+# orjson is several times faster than the standard library on small payloads;
+# it is optional, the gateway falls back to json when it isn't installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    json_loads = json.loads
+    JSON_BACKEND = 'json'
+
+class DecodeError(ValueError):
+    """Raised when a payload can't be turned into a valid insert row."""
+
+class TopicDecoder:
+    """
+    Precompiled decoder for one tank's JSON payload.
+    Produces the sqlite_handler insert tuple (system_id, timestamp, ts_ms, sensor values...) directly.
+    """
+
+    # Constructor for TopicDecoder class
+    def __init__(self, tank, sensors, valid_ranges=None):
+        self.tank = tank
+        # Tank-specific ranges (runtime tanks) take precedence over the global ones
+        ranges = dict(SENSOR_VALID_RANGES, **(valid_ranges or {}))
+        # (name, low, high) per sensor column, in insert order; looked up once here, not per message
+        self._fields = tuple(
+            (name,) + tuple(ranges.get(name, (float('-inf'), float('inf'))))
+            for name in sensors
+        )
+
+    def decode(self, payload, received_at, system_id=None):
+        """
+        Returns the insert tuple for a raw payload, or raises DecodeError.
+        A system_id taken from the topic wins over one in the payload.
+        """
+        try:
+            # Both backends accept bytes directly, so there's no separate .decode() step
+            data = json_loads(payload)
+        except ValueError as e:
+            raise DecodeError(f"invalid JSON: {e}")
+        if not isinstance(data, dict):
+            raise DecodeError("payload is not a JSON object")
+
+        values = self._validate(data.get(name) for name, low, high in self._fields)
+
+        timestamp = data.get('timestamp')
+        # Parse the ESP32 timestamp once; fall back to the Pi's receive time
+        ts = parse_timestamp(timestamp)
+        if ts is None:
+            ts = received_at
+        ts_ms = int(ts * 1000)
+        # SQLite stores ts_ms as int64; a value outside it would fail the whole insert batch
+        if not (0 <= ts_ms <= MAX_EPOCH_MS):
+            raise DecodeError(f"timestamp {ts_ms} ms outside valid range [0, {MAX_EPOCH_MS}]")
+
+        system_id = system_id or data.get('system_id') or DEFAULT_SYSTEM_ID
+        if not isinstance(system_id, str):
+            raise DecodeError("system_id is not a string")
+
+        return (
+            system_id,
+            None if timestamp is None else str(timestamp),
+            ts_ms,
+            *values
+        )
+
+    def _validate(self, raw_values):
+        """Returns the sensor values as floats (None where missing), or raises DecodeError if one is out of range."""
+        values = []
+        for (name, low, high), value in zip(self._fields, raw_values):
+            # A missing sensor is stored as NULL, like before
+            if value is not None:
+                if isinstance(value, bool):
+                    raise DecodeError(f"{name} is not a number")
+                if not isinstance(value, float):
+                    try:
+                        value = float(value)
+                    # OverflowError: an integer too large for a float
+                    except (TypeError, ValueError, OverflowError):
+                        raise DecodeError(f"{name} is not a number")
+                # value != value is only true for NaN
+                if value != value or not (low <= value <= high):
+                    raise DecodeError(f"{name}={value} outside valid range [{low}, {high}]")
+            values.append(value)
+        return values
+
+class BinaryTopicDecoder(TopicDecoder):
+    """
+    Decoder for the compact binary payload (binary_format.py).
+    Unpacks straight from the payload buffer into the insert tuple, without building a dictionary.
+    """
+
+    # Constructor for BinaryTopicDecoder class
+    def __init__(self, tank, sensors, valid_ranges=None):
+        super().__init__(tank, sensors, valid_ranges)
+        self._layout = binary_layout(len(self._fields))
+
+    def decode(self, payload, received_at, system_id=None):
+        """Returns the insert tuple for a raw binary payload, or raises DecodeError."""
+        view = memoryview(payload)
+        if len(view) < self._layout.size:
+            raise DecodeError(f"binary payload is {len(view)} bytes, expected at least {self._layout.size}")
+        if view[0] != BINARY_VERSION:
+            raise DecodeError(f"unsupported binary payload version {view[0]}")
+
+        version, ts_ms, *values = self._layout.unpack_from(view)
+        # Values are already floats, so only the range check is left; NaN marks a missing sensor
+        for index, (name, low, high) in enumerate(self._fields):
+            value = values[index]
+            if value != value:
+                values[index] = None
+            elif not (low <= value <= high):
+                raise DecodeError(f"{name}={value} outside valid range [{low}, {high}]")
+
+        # ts_ms is unsigned 64-bit on the wire: beyond int64 it would fail the whole insert batch,
+        # and localtime() can't format it either
+        if ts_ms > MAX_EPOCH_MS:
+            raise DecodeError(f"timestamp {ts_ms} ms outside valid range [0, {MAX_EPOCH_MS}]")
+        if ts_ms:
+            # Same text form the ESP32 uses in JSON, so document ids stay consistent across formats
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts_ms / 1000))
+        else:
+            timestamp = None
+            ts_ms = int(received_at * 1000)
+
+        if not system_id:
+            try:
+                system_id = bytes(view[self._layout.size:]).decode('utf-8')
+            except UnicodeDecodeError:
+                raise DecodeError("system id is not valid UTF-8")
+
+        return (system_id or DEFAULT_SYSTEM_ID, timestamp, ts_ms, *values)
+
+# Payload formats of the per-system topics
+JSON_FORMAT = 'json'
+BINARY_FORMAT = 'binary'
+
+class DecoderRegistry:
+    """
+    Maps topics to decoders and keeps accept/reject counters and decode timing.
+    Besides fixed topics it resolves the per-system topics {system_id}/{tank}/data and
+    {system_id}/{tank}/data/bin (subscribed with wildcards) through a (tank, format) table.
+    """
+
+    # Constructor for DecoderRegistry class
+    def __init__(self):
+        self._decoders = {}
+        # (topic, content type) -> decoder, for payloads that announce their format (MQTT v5)
+        self._typed_decoders = {}
+        # (tank, format) -> decoder for the per-system topics
+        self._tank_decoders = {}
+        # topic -> (decoder, system id) for per-system topics already resolved, so each topic is parsed once
+        self._topic_cache = {}
+        self._lock = threading.Lock()
+        self.accepted = {}        # topic -> messages decoded
+        self.rejected = {}        # topic -> messages sent to quarantine
+        self.decode_count = 0
+        self.decode_total_ns = 0
+        self.decode_max_ns = 0
+
+    def register(self, topic, decoder, content_type=None):
+        """
+        Registers the decoder used for messages on `topic`.
+        With a content_type it only applies to messages carrying that MQTT v5 content type.
+        """
+        if content_type is None:
+            self._decoders[topic] = decoder
+        else:
+            self._typed_decoders[(topic, content_type)] = decoder
+
+    def register_tank(self, tank, json_decoder, binary_decoder):
+        """Registers the decoders for a tank's per-system topics (replacing earlier ones)."""
+        self._tank_decoders[(tank, JSON_FORMAT)] = json_decoder
+        self._tank_decoders[(tank, BINARY_FORMAT)] = binary_decoder
+        # Resolved topics may point at the old decoders
+        self._topic_cache = {}
+
+    def resolve(self, topic, content_type=None):
+        """Returns (decoder, system id from the topic or None) for a topic, or (None, None) if none matches."""
+        if content_type is not None:
+            decoder = self._typed_decoders.get((topic, content_type))
+            if decoder is not None:
+                return decoder, None
+        decoder = self._decoders.get(topic)
+        if decoder is not None:
+            return decoder, None
+
+        binary = content_type == BINARY_CONTENT_TYPE
+        cached = self._topic_cache.get((topic, binary))
+        if cached is not None:
+            return cached
+
+        # {system_id}/{tank}/data[/bin]
+        parts = topic.split('/')
+        if len(parts) == 4 and parts[3] == 'bin':
+            binary = True
+        elif len(parts) != 3:
+            return None, None
+        if parts[2] != 'data' or not parts[0]:
+            return None, None
+        decoder = self._tank_decoders.get((parts[1], BINARY_FORMAT if binary else JSON_FORMAT))
+        if decoder is None:
+            return None, None
+
+        # Only topics of known tanks are cached, so junk topics can't grow the cache
+        if len(self._topic_cache) >= TOPIC_CACHE_MAX_SIZE:
+            self._topic_cache = {}
+        self._topic_cache[(topic, content_type == BINARY_CONTENT_TYPE)] = (decoder, parts[0])
+        return decoder, parts[0]
+
+    def decode(self, topic, payload, content_type=None):
+        """
+        Returns (tank, insert tuple) for a message. Raises DecodeError (after counting it)
+        if the topic is unknown or the payload is invalid.
+        """
+        start = time.perf_counter_ns()
+        try:
+            decoder, system_id = self.resolve(topic, content_type)
+            if decoder is None:
+                raise DecodeError(f"no decoder registered for topic {topic}")
+            row = decoder.decode(payload, time.time(), system_id)
+        except DecodeError:
+            self._count(self.rejected, topic, start)
+            raise
+        self._count(self.accepted, topic, start)
+        return decoder.tank, row
+
+    def _count(self, counters, topic, start):
+        elapsed = time.perf_counter_ns() - start
+        with self._lock:
+            counters[topic] = counters.get(topic, 0) + 1
+            self.decode_count += 1
+            self.decode_total_ns += elapsed
+            if elapsed > self.decode_max_ns:
+                self.decode_max_ns = elapsed
+
+    def stats(self):
+        """Returns a snapshot of the counters and the average/max decode cost in microseconds."""
+        with self._lock:
+            return {
+                'backend': JSON_BACKEND,
+                'accepted': dict(self.accepted),
+                'rejected': dict(self.rejected),
+                'avg_decode_us': self.decode_total_ns / self.decode_count / 1000 if self.decode_count else 0.0,
+                'max_decode_us': self.decode_max_ns / 1000,
+            }
+
+def quarantine_row(topic, payload, reason):
+    """Builds the insert tuple for a rejected message (payload truncated to QUARANTINE_PAYLOAD_MAX_BYTES)."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8', 'replace')
+    return (int(time.time() * 1000), topic, reason, bytes(payload[:QUARANTINE_PAYLOAD_MAX_BYTES]))
+
+# --- Default Registry ---
+# JSON on the two original tank topics; the binary format on their sibling topics,
+# or on the normal topic when the message carries BINARY_CONTENT_TYPE.
+# The same decoders serve the per-system topics; tanks added at runtime register theirs
+# through tank_registry.
+registry = DecoderRegistry()
+for _tank, _json_topic, _binary_topic in (
+    ('main_tank', TOPIC_SUBSCRIBE_MAIN, TOPIC_SUBSCRIBE_MAIN_BINARY),
+    ('sampling_tank', TOPIC_SUBSCRIBE_SAMPLE, TOPIC_SUBSCRIBE_SAMPLE_BINARY),
+):
+    _json_decoder = TopicDecoder(_tank, TANK_SENSORS[_tank])
+    _binary_decoder = BinaryTopicDecoder(_tank, TANK_SENSORS[_tank])
+    registry.register(_json_topic, _json_decoder)
+    registry.register(_binary_topic, _binary_decoder)
+    registry.register(_json_topic, _binary_decoder, content_type=BINARY_CONTENT_TYPE)
+    registry.register_tank(_tank, _json_decoder, _binary_decoder)
@@ -0,0 +1,38 @@
+import threading
+from collections import OrderedDict
+from config import DEDUPE_CACHE_SIZE
+
+# --- Duplicate Filter ---
+# With QoS 1 the broker redelivers any message it has no PUBACK for, and the ESP32s republish
+# their last readings after a reconnect. A reading is identified by (tank, system_id, ts_ms);
+# the most recent keys are kept in memory so the common duplicate, which arrives within seconds
+# of the original, is dropped in the MQTT callback without queueing or touching SQLite.
+# Anything older than the cache is still caught by the unique reading-key index on each table.
+
+class RecentKeys:
+    """Bounded LRU set of recently seen reading keys. Thread-safe."""
+
+    # Constructor for RecentKeys class
+    def __init__(self, max_size=DEDUPE_CACHE_SIZE):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """Records key and returns True if it was already among the recent keys."""
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+            self._keys[key] = None
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        """Removes key, e.g. when the message it belongs to could not be stored after all."""
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
@@ -0,0 +1,238 @@
+import queue
+import logging
+import threading
+import time
+from config import (
+    INGEST_QUEUE_MAX_SIZE, INGEST_BATCH_SIZE,
+    INGEST_FLUSH_INTERVAL_SEC, INGEST_PUT_TIMEOUT_SEC
+)
+from sqlite_handler import insert_batch, write_summaries, QUARANTINE, SUMMARIES
+from dedupe import RecentKeys
+from metrics import DUPLICATES_IGNORED
+from logging_setup import PER_MESSAGE
+
+logger = logging.getLogger(__name__)
+
+def reading_key(tank, row):
+    """Identifies a reading by tank, system_id and ts_ms, the same key as the unique index on its table."""
+    return (tank, row[0], row[2])
+
+class IngestQueue:
+    """
+    Write-behind buffer between the MQTT callback and SQLite.
+    on_message only enqueues; a dedicated writer thread drains the queue and
+    commits each batch in one transaction (group commit).
+    """
+
+    # Constructor for IngestQueue class
+    def __init__(self, on_commit=None, max_size=INGEST_QUEUE_MAX_SIZE,
+                 batch_size=INGEST_BATCH_SIZE, flush_interval=INGEST_FLUSH_INTERVAL_SEC,
+                 put_timeout=INGEST_PUT_TIMEOUT_SEC, recent_keys=None, upload_filter=None, on_store=None):
+        # Bounded queue: memory use is capped at max_size messages
+        self._queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        # Called from the writer thread as on_commit(tank, ids, rows) after each successful commit,
+        # with the rows still to be uploaded (and SUMMARIES for new window summaries)
+        self.on_commit = on_commit
+        # Reading keys seen recently, so redelivered messages are dropped before they are queued
+        self.recent_keys = recent_keys if recent_keys is not None else RecentKeys()
+        # Called from the writer thread as on_store(tank, rows) with every tank's newly stored readings,
+        # whether or not they are uploaded (feeds the read API's ring buffer)
+        self.on_store = on_store
+        # Upload policy (upload_filter.UploadFilter): only the readings it selects reach on_commit
+        self.upload_filter = upload_filter
+        self._next_window_check = 0.0
+        self.running = False
+        self._thread = None
+
+        # --- Counters (read with stats()) ---
+        self._stats_lock = threading.Lock()
+        self.enqueued = 0      # messages accepted by put()
+        self.waited = 0        # messages that had to wait for space (backpressure applied)
+        self.dropped = 0       # messages rejected because the queue stayed full (overflow)
+        self.duplicates = 0    # redelivered readings dropped (in memory or by the unique index)
+        self.written = 0       # rows committed to SQLite
+        self.failed = 0        # rows lost because their batch transaction failed
+        self.batches = 0       # number of group commits
+        self.max_depth = 0     # highest queue depth seen
+
+    def start(self):
+        """Starts the writer thread."""
+        self.running = True
+        # Not a daemon: stop() must be able to flush what is left before the program exits
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer")
+        self._thread.start()
+
+    def put(self, tank, row):
+        """
+        Queues one decoded message (an insert tuple) for writing. Returns False if it had to be dropped.
+        Safe to call from paho's network thread: it never touches SQLite.
+        A reading that was queued recently is a redelivery: it is dropped and counted, and put returns True.
+        """
+        key = None if tank == QUARANTINE else reading_key(tank, row)
+        if key is not None and self.recent_keys.seen(key):
+            with self._stats_lock:
+                self.duplicates += 1
+            DUPLICATES_IGNORED.inc(tank, 'memory')
+            return True
+        try:
+            self._queue.put_nowait((tank, row))
+        except queue.Full:
+            # Backpressure: briefly hold the network thread so the writer can catch up,
+            # then give up rather than stall keep-alives and acks for every topic
+            with self._stats_lock:
+                self.waited += 1
+            try:
+                self._queue.put((tank, row), timeout=self.put_timeout)
+            except queue.Full:
+                with self._stats_lock:
+                    self.dropped += 1
+                # Not stored, so a redelivery of it must not be mistaken for a duplicate
+                if key is not None:
+                    self.recent_keys.forget(key)
+                logger.warning("Ingest queue full, dropped %s message", tank, extra=dict(PER_MESSAGE, dropped_total=self.dropped))
+                return False
+
+        with self._stats_lock:
+            self.enqueued += 1
+            depth = self._queue.qsize()
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def stop(self, timeout=10):
+        """Stops the writer thread after flushing everything still queued."""
+        self.running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Returns a snapshot of the queue counters."""
+        with self._stats_lock:
+            return {
+                'depth': self._queue.qsize(),
+                'max_depth': self.max_depth,
+                'enqueued': self.enqueued,
+                'waited': self.waited,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates,
+                'written': self.written,
+                'failed': self.failed,
+                'batches': self.batches,
+            }
+
+    def _run(self):
+        # Keep going until stop() was called AND the queue has been drained
+        while self.running or not self._queue.empty():
+            batch = self._collect()
+            if batch:
+                # The writer thread must survive anything a batch throws; otherwise messages would keep
+                # being queued with nothing left to store them
+                try:
+                    self._flush(batch)
+                except Exception:
+                    logger.exception("Error in ingest writer")
+                    self._batch_failed(batch)
+            if self.upload_filter is not None and time.monotonic() >= self._next_window_check:
+                # Summary windows whose system went quiet are closed by time, about once a second
+                self._next_window_check = time.monotonic() + 1.0
+                self._safe_commit_summaries(self.upload_filter.due_windows)
+        if self.upload_filter is not None:
+            # Summarize the windows still open so far; readings after a restart update them
+            self._safe_commit_summaries(self.upload_filter.open_windows)
+
+    def _collect(self):
+        """Waits for the first message, then gathers more until the batch is full or the interval expires."""
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        """Writes one batch in a single transaction and hands the committed rows to on_commit."""
+        # Group the messages per tank so each table gets one executemany call
+        grouped = {}
+        for tank, row in batch:
+            grouped.setdefault(tank, []).append(row)
+
+        result = insert_batch(grouped, self.upload_filter)
+
+        if result is None:
+            self._batch_failed(batch)
+            return
+
+        uploads, stored_rows = result
+        stored = sum(len(rows) for rows in stored_rows.values())
+        with self._stats_lock:
+            self.batches += 1
+            self.written += stored
+            # Copies older than the in-memory window, caught by the unique index
+            self.duplicates += len(batch) - stored
+
+        # One summary line per group commit instead of one line per message
+        # Nested under one key: a tank named like a LogRecord attribute (e.g. 'name') would make logging raise
+        logger.info("Saved batch of %d messages", len(batch),
+                    extra={'batch_rows': {tank: len(rows) for tank, rows in grouped.items()}})
+
+        if self.on_store is not None:
+            for tank, rows in stored_rows.items():
+                if tank == QUARANTINE:
+                    continue
+                try:
+                    self.on_store(tank, rows)
+                except Exception:
+                    logger.exception("Error in ingest store callback for %s", tank)
+        for tank, (ids, rows) in uploads.items():
+            self._commit_callback(tank, ids, rows)
+
+    def _batch_failed(self, batch):
+        """Counts a batch that was not saved and forgets its keys, so a redelivery is stored after all."""
+        with self._stats_lock:
+            self.batches += 1
+            self.failed += len(batch)
+        for tank, row in batch:
+            if tank != QUARANTINE:
+                self.recent_keys.forget(reading_key(tank, row))
+        logger.error("Batch of %d messages could not be saved", len(batch))
+
+    def _safe_commit_summaries(self, get_windows):
+        """_commit_summaries(get_windows()) that logs instead of raising."""
+        try:
+            self._commit_summaries(get_windows())
+        except Exception:
+            logger.exception("Error writing summary windows")
+
+    def _commit_summaries(self, windows):
+        """Writes the summaries of closed windows and hands them to on_commit for upload."""
+        if not windows:
+            return
+        result = write_summaries(windows)
+        if result is None:
+            logger.error("Summaries of %d windows could not be saved", len(windows))
+            return
+        ids, rows = result
+        if rows:
+            self._commit_callback(SUMMARIES, ids, rows)
+
+    def _commit_callback(self, tank, ids, rows):
+        if self.on_commit is None:
+            return
+        try:
+            self.on_commit(tank, ids, rows)
+        # The writer thread must survive anything the callback does
+        except Exception:
+            logger.exception("Error in ingest commit callback for %s", tank)
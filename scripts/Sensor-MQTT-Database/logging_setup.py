@@ -0,0 +1,119 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from config import (
+    LOG_LEVEL, LOG_VERBOSE, LOG_QUEUE_MAX_SIZE,
+    LOG_RATE_LIMIT_BURST, LOG_RATE_LIMIT_INTERVAL_SEC
+)
+
+# --- Logging Layer ---
+# Modules log through logging.getLogger(__name__) as usual. setup_logging() puts a
+# queue in front of the real output: the calling thread (paho's network thread, the SQLite
+# writer, an uploader) only enqueues the record; one listener thread does the formatting
+# and the slow write to stdout/journald.
+#
+# Per-message records pass extra=PER_MESSAGE. In normal mode they are rate-limited per
+# message template; in verbose mode everything, including the DEBUG per-message detail,
+# is written like the old print output.
+PER_MESSAGE = {'per_message': True}
+
+# Attributes every LogRecord has; anything else on a record came from extra= and is printed as key=value
+_STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'per_message'}
+
+class KeyValueFormatter(logging.Formatter):
+    """Formats records as one line: time, level, logger, message, then any extra fields as key=value."""
+
+    def format(self, record):
+        parts = [
+            self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            record.levelname,
+            record.name,
+            record.getMessage(),
+        ]
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRIBUTES:
+                parts.append(f"{key}={value}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `burst` per-message records with the same logger and message template through
+    per `interval` seconds. The first record after a window reports how many were suppressed.
+    Records without the per_message flag are never limited.
+    """
+
+    # Constructor for RateLimitFilter class
+    def __init__(self, burst=LOG_RATE_LIMIT_BURST, interval=LOG_RATE_LIMIT_INTERVAL_SEC):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}     # (logger, template) -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not getattr(record, 'per_message', False):
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller: when the queue is full the record is dropped and counted."""
+
+    # Constructor for DroppingQueueHandler class
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The stock QueueHandler formats the message here, in the caller's thread.
+        # The queue never leaves the process, so the record can be handed over as it is.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(verbose=LOG_VERBOSE, level=LOG_LEVEL, stream=None):
+    """
+    Routes all logging through a bounded queue to a background listener thread.
+    Returns the listener; call its stop() on shutdown to flush what is still queued.
+    """
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    if not verbose:
+        # Filtering happens in the calling thread, so suppressed records never reach the queue
+        queue_handler.addFilter(RateLimitFilter())
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(KeyValueFormatter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.DEBUG if verbose else level)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
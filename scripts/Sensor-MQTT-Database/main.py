@@ -2,15 +2,35 @@
 import paho.mqtt.client as mqtt
 # necessary for compatibility with paho-mqtt version 2.0+
 from paho.mqtt.client import CallbackAPIVersion
+import sys
 import time
+import logging
 import firebase_admin
 from firebase_admin import credentials, firestore
 
 # Import configuration and handler functions
 from config import *
-from subscriber import on_message, process_and_upload_backlog
+from subscriber import on_message, SUBSCRIPTIONS
 from publisher import publish_status
-from sqlite_handler import init_db
+from sqlite_handler import init_db, close_db, pending_count, TANK_TABLES
+from ingest_queue import IngestQueue
+from upload_filter import UploadFilter
+from read_api import ReadingRing, start_read_api
+from cloud_uploader import CloudUploader
+from backlog_scheduler import BacklogScheduler, CircuitBreaker, CLOSED
+from archive import archive_old_rows
+from decoders import registry
+from tank_registry import load_tanks
+from metrics import (
+    start_metrics_server, MQTT_CONNECTS, MQTT_DISCONNECTS,
+    BACKLOG_ROWS, INGEST_QUEUE_DEPTH, UPLOAD_QUEUE_DEPTH, UPLOAD_CIRCUIT_OPEN
+)
+from logging_setup import setup_logging
+
+# --- Logging ---
+# All output goes through a queue to a background writer thread; --verbose restores per-message detail
+log_listener = setup_logging(verbose=LOG_VERBOSE or '--verbose' in sys.argv[1:])
+logger = logging.getLogger('gateway')
 
 # --- Firebase Initialization ---
 db = None
@@ -24,66 +44,114 @@ try:
         firebase_admin.initialize_app(cred)
     
     db = firestore.client()
-    print("Firebase Admin SDK initialized.")
+    logger.info("Firebase Admin SDK initialized.")
 except Exception as e:
-    print(f"Error initializing Firebase. Cloud upload will be skipped: {e}")
+    logger.error("Error initializing Firebase. Cloud upload will be skipped: %s", e)
 
 # --- Connection Handlers ---
 # called when the client connects to the broker
 # Handles connection acceptance/rejection and sets up subscriptions
 # reason_code is the status code from the broker
 def on_connect(client, userdata, flags, reason_code, properties):
-    print("Connecting to MQTT...")
+    logger.debug("Connecting to MQTT...")
     if reason_code == 0:      # reason_code: 0, client is successfully connected
-        print("MQTT connected!")
-        
-        # 1. Define a list of topics and their QoS level
-        # List format is: [(topic1, qos1), (topic2, qos2), ...]
-        
-        # Define QoS = 1 for both data streams to ensure delivery
-        subscription_list = [
-            (TOPIC_SUBSCRIBE_MAIN, 1),
-            (TOPIC_SUBSCRIBE_SAMPLE, 1)
-        ]
+        logger.info("MQTT connected!")
+        MQTT_CONNECTS.inc('success')
         
-        # 2. Subscribe to the topics the ESP32 publishes data to
-        client.subscribe(subscription_list)
+        # Subscribe to the topics the ESP32 publishes data to (SUBSCRIPTIONS in subscriber.py)
+        client.subscribe(SUBSCRIPTIONS)
         
-        print(f"\nSuccessfully subscribed to the following topics:")
-        for topic, qos in subscription_list:
-            print(f"- {topic} (QoS: {qos})")
+        logger.info("Successfully subscribed to the following topics: %s",
+                    ", ".join(f"{topic} (QoS: {qos})" for topic, qos in SUBSCRIPTIONS))
             
         # Pass the initialised Firestore client object via the userdata dictionary
         userdata['db_client'] = db 
         client.user_data_set(userdata)
         
+        # A reconnect usually means the network is back: skip the rest of the upload backoff
+        # (the scheduler probes Firestore first) and upload the backlog now
+        backlog_scheduler.drain_now()
+        
         
     else:                     # reason_code: 1, connection failure  
-        print(f"Failed to subscribe, reason code = {reason_code}")
+        logger.error("Failed to subscribe, reason code = %s", reason_code)
+        MQTT_CONNECTS.inc('failure')
         
 # Paho's internal error handling when client attempts to connect or reconnect to the MQTT broker
 # used when using background network loop functions like client.loop_start() / client.loop_forever()
 def on_connect_fail(client, userdata):
-    print("Connection failed, Paho will retry...")
+    logger.warning("Connection failed, Paho will retry...")
+    MQTT_CONNECTS.inc('failure')
+
+# Called when the connection to the broker is lost or closed; paho reconnects on its own
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+    logger.warning("MQTT disconnected, reason code = %s", reason_code)
+    MQTT_DISCONNECTS.inc()
     
 # --- Main Execution ---
 # Initialise local database
 init_db()
+# Activate the tank kinds registered at runtime (register_tank.py)
+load_tanks()
 
 # # Create a dictionary to hold user data (like the Firestore client)
 # # This ensures userdata is never None when passed to callbacks
 # client_userdata = {}
 
+# Uploads the backlog on its own thread: backs off while Firestore is down, sleeps while nothing is pending
+# The circuit breaker is shared with the live uploader, so an outage stops both
+breaker = CircuitBreaker()
+backlog_scheduler = BacklogScheduler(db, breaker)
+
+# Start the cloud upload workers; they take freshly committed rows off a queue
+# Rows they can't upload wake the backlog scheduler
+cloud_uploader = CloudUploader(db, breaker=breaker, on_pending=backlog_scheduler.notify_pending)
+cloud_uploader.start()
+
+# Start the SQLite writer thread; on_message only enqueues to it
+# After each group commit the new rows are handed to the cloud uploader (immediate upload attempt);
+# the upload policy (UPLOAD_POLICIES) decides which of them are worth a Firestore write.
+# Every stored reading also goes into the read API's in-memory ring buffer.
+reading_ring = ReadingRing()
+reading_ring.load()
+ingest_queue = IngestQueue(on_commit=cloud_uploader.submit, upload_filter=UploadFilter(), on_store=reading_ring.add)
+ingest_queue.start()
+
+# Expose counters, latencies and queue/backlog depths for Prometheus on a local port
+# The depth gauges are read when scraped, so they cost nothing in between
+for tank in TANK_TABLES:
+    BACKLOG_ROWS.set_function(lambda tank=tank: pending_count(tank), tank)
+INGEST_QUEUE_DEPTH.set_function(lambda: ingest_queue.stats()['depth'])
+UPLOAD_QUEUE_DEPTH.set_function(lambda: cloud_uploader.stats()['queue_depth'])
+UPLOAD_CIRCUIT_OPEN.set_function(lambda: 0 if breaker.state == CLOSED else 1)
+metrics_server = None
+if METRICS_PORT:
+    try:
+        metrics_server = start_metrics_server(METRICS_HOST, METRICS_PORT)
+        logger.info("Metrics available at http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        logger.error("Error starting metrics endpoint, continuing without it: %s", e)
+
+# Local HTTP/JSON read API for dashboards on the LAN; keeps working while the Pi is offline
+read_api_server = None
+if READ_API_PORT:
+    try:
+        read_api_server = start_read_api(reading_ring, READ_API_HOST, READ_API_PORT)
+        logger.info("Read API available at http://%s:%d/latest", READ_API_HOST, READ_API_PORT)
+    except OSError as e:
+        logger.error("Error starting read API, continuing without it: %s", e)
+
 # Create MQTT client instance (using V2 API)
-client = mqtt.Client(CallbackAPIVersion.VERSION2, CLIENT_ID, userdata={})
+client = mqtt.Client(CallbackAPIVersion.VERSION2, CLIENT_ID, userdata={'ingest_queue': ingest_queue})
 
 # Assign handlers
 client.on_connect = on_connect
 client.on_message = on_message
 client.on_connect_fail = on_connect_fail
+client.on_disconnect = on_disconnect
 
 # Connect to broker and start listening
-print("Connecting to broker...")
+logger.info("Connecting to broker...")
 client.connect(BROKER_ADDRESS, BROKER_PORT, KEEP_ALIVE_SEC)  # port 1883 (standard MQTT port)
                                                              # kepp-alive timeout of 60 seconds
 
@@ -91,14 +159,31 @@ client.connect(BROKER_ADDRESS, BROKER_PORT, KEEP_ALIVE_SEC)  # port 1883 (standa
 # This keeps the connection alive, sends keep-alives, and handles protocol tasks (Pub/Sub)
 client.loop_start()
 
-userdata = client.user_data_get()
+# Store-and-Forward: upload rows that are still unuploaded in SQLite (the first run starts immediately)
+if db:
+    backlog_scheduler.start()
+else:
+    logger.info("Skipping backlog upload: Firestore client is not initialized.")
 
 # 2. Main program loop for periodic publishing
 try:
 #     print(f"\nStarting continuous publishing every {PUBLISH_INTERVAL_SEC} seconds...")
+    last_retention_run = 0
     while True:
-        # Check and upload unuploaded data from SQLite to Firestore (Store-and-Forward)
-        process_and_upload_backlog(userdata.get('db_client'))
+        # Pick up tanks registered since the last pass
+        load_tanks()
+        # One summary line per interval instead of per message
+        logger.info("Status", extra={
+            'ingest': ingest_queue.stats(),
+            'uploader': cloud_uploader.stats(),
+            'backlog': backlog_scheduler.stats(),
+            'decoder': registry.stats(),
+        })
+        
+        # Move old, already uploaded rows into the compressed archive
+        if time.time() - last_retention_run >= RETENTION_CHECK_INTERVAL_SEC:
+            archive_old_rows()
+            last_retention_run = time.time()
         
         # Wait for the specified interval
         time.sleep(BACKLOG_CHECK_INTERVAL_SEC)
@@ -109,11 +194,27 @@ try:
 #         time.sleep(PUBLISH_INTERVAL_SEC)
 
 except KeyboardInterrupt:
-    print("\nScript stopped by user.")
+    logger.info("Script stopped by user.")
 
 # Guarantee cleanup code is executed before program terminates
 finally:
     # 3. Stop the loop and disconnect cleanly
     client.loop_stop()
     client.disconnect()  # <-- must run even if Ctrl+C is pressed
-    print("\nClean disconnect.")
\ No newline at end of file
+    # An upload in progress finishes; its rows are flagged before the database closes
+    backlog_scheduler.stop(timeout=FIRESTORE_TIMEOUT_SEC)
+    # Write out anything still waiting in the ingest queue
+    ingest_queue.stop()
+    logger.info("Ingest stats", extra={'ingest': ingest_queue.stats()})
+    # Give in-flight uploads a moment; whatever is left stays pending for the next backlog run
+    cloud_uploader.stop(timeout=FIRESTORE_TIMEOUT_SEC)
+    logger.info("Upload stats", extra={'uploader': cloud_uploader.stats()})
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if read_api_server is not None:
+        read_api_server.shutdown()
+    # Close the long-lived SQLite connections (checkpoints the WAL file)
+    close_db()
+    logger.info("Clean disconnect.")
+    # Flush the log queue last so every line above is written
+    log_listener.stop()
\ No newline at end of file
@@ -0,0 +1,218 @@
+# Alternative entry point: the same gateway as main.py on a single asyncio event loop.
+# MQTT is read from the loop (no paho thread), ingest, live uploads, the backlog and the periodic jobs
+# are tasks, SQLite runs on one executor thread and Firestore calls on a pool of ASYNC_UPLOAD_CONCURRENCY.
+# Ctrl+C or SIGTERM shuts down in order: stop reading MQTT, flush the ingest queue, close the
+# summary windows, let in-flight uploads finish, then close the database.
+#
+# Usage: python3 main_async.py [--verbose]
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+import sys
+import signal
+import asyncio
+import logging
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+from config import *
+from subscriber import on_message, SUBSCRIPTIONS
+from sqlite_handler import init_db, close_db, pending_count, TANK_TABLES
+from upload_filter import UploadFilter
+from read_api import ReadingRing, start_read_api
+from backlog_scheduler import CircuitBreaker, CLOSED
+from async_gateway import (
+    MqttSocketBridge, AsyncIngestQueue, AsyncUploader, AsyncBacklogScheduler, sqlite_executor
+)
+from archive import archive_old_rows
+from decoders import registry
+from tank_registry import load_tanks
+from metrics import (
+    start_metrics_server, MQTT_CONNECTS, MQTT_DISCONNECTS,
+    BACKLOG_ROWS, INGEST_QUEUE_DEPTH, UPLOAD_QUEUE_DEPTH, UPLOAD_CIRCUIT_OPEN
+)
+from logging_setup import setup_logging
+
+logger = logging.getLogger('gateway')
+
+def init_firestore():
+    """Returns the Firestore client, or None if Firebase can't be initialized (cloud upload is then skipped)."""
+    try:
+        cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+        logger.info("Firebase Admin SDK initialized.")
+        return firestore.client()
+    except Exception as e:
+        logger.error("Error initializing Firebase. Cloud upload will be skipped: %s", e)
+        return None
+
+# --- MQTT ---
+async def run_mqtt(client, bridge, stopping):
+    """Connects to the broker and reconnects with a doubling delay whenever the connection closes."""
+    delay = 1
+    while not stopping.is_set():
+        try:
+            # Blocks the loop for the TCP handshake; the broker runs on the Pi itself (BROKER_ADDRESS)
+            client.connect(BROKER_ADDRESS, BROKER_PORT, KEEP_ALIVE_SEC)
+        except OSError as e:
+            logger.warning("Connection to broker failed, retrying in %d s: %s", delay, e)
+            MQTT_CONNECTS.inc('failure')
+            await wait_or_stop(stopping, delay)
+            delay = min(delay * 2, ASYNC_MQTT_RECONNECT_MAX_SEC)
+            continue
+        delay = 1
+        await bridge.closed.wait()
+        if not stopping.is_set():
+            await wait_or_stop(stopping, delay)
+
+def make_on_connect(backlog_scheduler):
+    def on_connect(client, userdata, flags, reason_code, properties):
+        if reason_code == 0:
+            logger.info("MQTT connected!")
+            MQTT_CONNECTS.inc('success')
+            client.subscribe(SUBSCRIPTIONS)
+            logger.info("Successfully subscribed to the following topics: %s",
+                        ", ".join(f"{topic} (QoS: {qos})" for topic, qos in SUBSCRIPTIONS))
+            # A reconnect usually means the network is back: upload the backlog now
+            backlog_scheduler.drain_now()
+        else:
+            logger.error("Failed to subscribe, reason code = %s", reason_code)
+            MQTT_CONNECTS.inc('failure')
+    return on_connect
+
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+    logger.warning("MQTT disconnected, reason code = %s", reason_code)
+    MQTT_DISCONNECTS.inc()
+
+# --- Periodic Jobs ---
+async def wait_or_stop(stopping, timeout):
+    """Sleeps for timeout seconds, or less if shutdown starts."""
+    try:
+        await asyncio.wait_for(stopping.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+async def every(interval, job, stopping):
+    """Runs the coroutine function job every interval seconds until shutdown; an error skips one run."""
+    while not stopping.is_set():
+        try:
+            await job()
+        except Exception:
+            logger.exception("Error in periodic job %s", job.__name__)
+        await wait_or_stop(stopping, interval)
+
+# --- Main Execution ---
+async def main():
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    db = init_firestore()
+    db_executor = sqlite_executor()
+
+    def run_db(func, *args):
+        return loop.run_in_executor(db_executor, func, *args)
+
+    # Initialise local database and the tank kinds registered at runtime (register_tank.py)
+    await run_db(init_db)
+    await run_db(load_tanks)
+
+    # The circuit breaker is shared by live and backlog uploads, so an outage stops both
+    breaker = CircuitBreaker()
+    uploader = AsyncUploader(db, db_executor, breaker=breaker)
+    backlog_scheduler = AsyncBacklogScheduler(db, uploader, db_executor, breaker)
+    uploader.on_pending = backlog_scheduler.notify_pending
+
+    client = mqtt.Client(CallbackAPIVersion.VERSION2, CLIENT_ID)
+    bridge = MqttSocketBridge(loop, client)
+
+    reading_ring = ReadingRing()
+    await run_db(reading_ring.load)
+    ingest_queue = AsyncIngestQueue(
+        db_executor, on_commit=uploader.submit, upload_filter=UploadFilter(), on_store=reading_ring.add,
+        on_full=bridge.pause_reading, on_space=bridge.resume_reading
+    )
+    ingest_queue.start()
+
+    client.user_data_set({'ingest_queue': ingest_queue, 'db_client': db})
+    client.on_connect = make_on_connect(backlog_scheduler)
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+
+    for tank in TANK_TABLES:
+        BACKLOG_ROWS.set_function(lambda tank=tank: pending_count(tank), tank)
+    INGEST_QUEUE_DEPTH.set_function(lambda: ingest_queue.stats()['depth'])
+    UPLOAD_QUEUE_DEPTH.set_function(lambda: uploader.stats()['queue_depth'])
+    UPLOAD_CIRCUIT_OPEN.set_function(lambda: 0 if breaker.state == CLOSED else 1)
+    metrics_server = None
+    if METRICS_PORT:
+        try:
+            metrics_server = start_metrics_server(METRICS_HOST, METRICS_PORT)
+            logger.info("Metrics available at http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error("Error starting metrics endpoint, continuing without it: %s", e)
+    read_api_server = None
+    if READ_API_PORT:
+        try:
+            read_api_server = start_read_api(reading_ring, READ_API_HOST, READ_API_PORT)
+            logger.info("Read API available at http://%s:%d/latest", READ_API_HOST, READ_API_PORT)
+        except OSError as e:
+            logger.error("Error starting read API, continuing without it: %s", e)
+
+    if db:
+        backlog_scheduler.start()
+    else:
+        logger.info("Skipping backlog upload: Firestore client is not initialized.")
+
+    async def status():
+        # Pick up tanks registered since the last pass, then one summary line per interval
+        await run_db(load_tanks)
+        logger.info("Status", extra={
+            'ingest': ingest_queue.stats(),
+            'uploader': uploader.stats(),
+            'backlog': backlog_scheduler.stats(),
+            'decoder': registry.stats(),
+        })
+
+    async def retention():
+        # On the SQLite executor like every other database call. Inserts wait while a batch is archived;
+        # the ingest queue holds the messages meanwhile.
+        await run_db(archive_old_rows)
+
+    logger.info("Connecting to broker...")
+    tasks = [
+        loop.create_task(run_mqtt(client, bridge, stopping), name="mqtt"),
+        loop.create_task(every(BACKLOG_CHECK_INTERVAL_SEC, status, stopping), name="status"),
+        loop.create_task(every(RETENTION_CHECK_INTERVAL_SEC, retention, stopping), name="retention"),
+    ]
+
+    await stopping.wait()
+    logger.info("Shutting down...")
+    # 1. Stop receiving; paho writes the DISCONNECT packet straight away
+    client.disconnect()
+    await asyncio.wait(tasks, timeout=ASYNC_SHUTDOWN_TIMEOUT_SEC)
+    # 2. Write out everything still queued, plus the summary windows still open
+    await ingest_queue.stop()
+    logger.info("Ingest stats", extra={'ingest': ingest_queue.stats()})
+    # 3. Uploads in progress finish; whatever is left stays pending for the next backlog run
+    await backlog_scheduler.stop(timeout=ASYNC_SHUTDOWN_TIMEOUT_SEC)
+    await uploader.stop(timeout=ASYNC_SHUTDOWN_TIMEOUT_SEC)
+    logger.info("Upload stats", extra={'uploader': uploader.stats()})
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if read_api_server is not None:
+        read_api_server.shutdown()
+    # 4. Close the long-lived SQLite connections (checkpoints the WAL file) once the executor is idle
+    db_executor.shutdown(wait=True)
+    close_db()
+    logger.info("Clean disconnect.")
+
+if __name__ == "__main__":
+    # All output goes through a queue to a background writer thread; --verbose restores per-message detail
+    log_listener = setup_logging(verbose=LOG_VERBOSE or '--verbose' in sys.argv[1:])
+    try:
+        asyncio.run(main())
+    finally:
+        # Flush the log queue last so every line above is written
+        log_listener.stop()
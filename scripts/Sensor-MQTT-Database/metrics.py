@@ -0,0 +1,240 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Metrics Registry ---
+# A small, dependency-free subset of the Prometheus client: counters, gauges and histograms
+# with fixed label names, rendered in the Prometheus text exposition format.
+# Updating a metric is a dictionary lookup and an add under a lock, cheap enough for the
+# per-message path; all formatting happens only when /metrics is scraped.
+
+# Latency buckets in seconds, from sub-millisecond SQLite work up to Firestore timeouts
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Common part of every metric: name, help text, label names and the per-label-set values."""
+    kind = 'untyped'
+
+    # Constructor for Metric class
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Returns (suffix, label values, extra labels, value) tuples for rendering."""
+        with self._lock:
+            return [('', labels, (), value) for labels, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """A value that only goes up, e.g. messages received."""
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. a queue depth. Can also be read from a function at scrape time."""
+    kind = 'gauge'
+
+    # Constructor for Gauge class
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._functions = {}
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_function(self, function, *labels):
+        """Reads the value by calling function() on every scrape instead of storing it."""
+        with self._lock:
+            self._functions[labels] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for labels, function in functions.items():
+            try:
+                values[labels] = function()
+            # A failing callback must not break the whole scrape
+            except Exception:
+                continue
+        return [('', labels, (), value) for labels, value in values.items()]
+
+class Histogram(Metric):
+    """Distribution of observed values (latencies) over fixed buckets, plus their sum and count."""
+    kind = 'histogram'
+
+    # Constructor for Histogram class
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # Only the matching bucket is incremented here; the cumulative counts are built on render
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels):
+        """Context manager that observes the duration of its block in seconds."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        samples = []
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', labels, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', labels, (), total))
+            samples.append(('_count', labels, (), count))
+        return samples
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+class MetricsRegistry:
+    """Holds every metric of the process and renders them for a scrape."""
+
+    # Constructor for MetricsRegistry class
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+# --- Gateway Metrics ---
+registry = MetricsRegistry()
+
+MESSAGES_RECEIVED = registry.counter(
+    'gateway_mqtt_messages_received_total', 'MQTT messages received, per topic.', ('topic',))
+DECODE_FAILURES = registry.counter(
+    'gateway_decode_failures_total', 'Messages that failed decoding or validation and went to quarantine, per topic.',
+    ('topic',))
+MQTT_CONNECTS = registry.counter(
+    'gateway_mqtt_connects_total', 'MQTT connection attempts by result (success / failure).', ('result',))
+MQTT_DISCONNECTS = registry.counter(
+    'gateway_mqtt_disconnects_total', 'Connections to the MQTT broker that were lost or closed.')
+
+SQLITE_INSERT_SECONDS = registry.histogram(
+    'gateway_sqlite_insert_seconds', 'Time spent executing the INSERTs of one batch, per table.', ('tank',))
+SQLITE_COMMIT_SECONDS = registry.histogram(
+    'gateway_sqlite_commit_seconds', 'Time spent committing one write transaction.')
+SQLITE_ROWS_INSERTED = registry.counter(
+    'gateway_sqlite_rows_inserted_total', 'Rows written to SQLite, per table.', ('tank',))
+SQLITE_ERRORS = registry.counter(
+    'gateway_sqlite_errors_total', 'Write transactions that failed and were rolled back.')
+DUPLICATES_IGNORED = registry.counter(
+    'gateway_duplicates_ignored_total',
+    'Redelivered readings that were not stored again, per table and where they were caught (memory / sqlite / upload).',
+    ('tank', 'stage'))
+
+UPLOADS_SUPPRESSED = registry.counter(
+    'gateway_uploads_suppressed_total', 'Readings stored locally only because the upload policy skipped them, per table.',
+    ('tank',))
+BACKLOG_ROWS = registry.gauge(
+    'gateway_backlog_rows', 'Rows saved locally but not yet uploaded to Firestore, per table.', ('tank',))
+INGEST_QUEUE_DEPTH = registry.gauge(
+    'gateway_ingest_queue_depth', 'Messages waiting for the SQLite writer thread.')
+UPLOAD_QUEUE_DEPTH = registry.gauge(
+    'gateway_upload_queue_depth', 'Committed batches waiting for a cloud uploader thread.')
+UPLOAD_CIRCUIT_OPEN = registry.gauge(
+    'gateway_upload_circuit_open', '1 while Firestore uploads are paused by the circuit breaker, else 0.')
+
+FIRESTORE_REQUEST_SECONDS = registry.histogram(
+    'gateway_firestore_request_seconds', 'Firestore write latency by request kind (batch / document).', ('kind',))
+FIRESTORE_DOCUMENTS = registry.counter(
+    'gateway_firestore_documents_total', 'Documents sent to Firestore by result (ok / error).', ('result',))
+FIRESTORE_ERRORS = registry.counter(
+    'gateway_firestore_errors_total', 'Failed Firestore requests by request kind (batch / document).', ('kind',))
+
+# --- HTTP Endpoint ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would otherwise flood the output
+        pass
+
+def start_metrics_server(host, port):
+    """Serves /metrics on host:port from a daemon thread. Returns the server (call shutdown() to stop it)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
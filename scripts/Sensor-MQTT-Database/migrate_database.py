@@ -0,0 +1,36 @@
+# Upgrades an existing algae_project.db to the current schema in place.
+# The gateway does this automatically on start-up (init_db); this script lets it be run
+# ahead of time, e.g. on a copy of the database or while the gateway is stopped.
+# It also switches the file to incremental auto-vacuum, so the pages freed by the archive job
+# are given back to the SD card. That takes one full VACUUM, which rewrites the whole file
+# and is why it only happens here, never while the gateway is running.
+#
+# Usage: python3 migrate_database.py [path/to/algae_project.db]
+import sys
+import time
+import sqlite3
+from config import DB_NAME
+from sqlite_handler import init_db, close_db
+from archive import enable_incremental_vacuum
+from logging_setup import setup_logging
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else DB_NAME
+    # Show the per-migration progress lines
+    log_listener = setup_logging()
+    print(f"Migrating '{db_path}'...")
+    start = time.monotonic()
+    # Conversions run in batches of MIGRATION_BATCH_SIZE rows, so memory use stays flat
+    # and an interrupted run continues where it stopped the next time it is started
+    ok = init_db(db_path)
+    if ok:
+        try:
+            # Does nothing if the file already uses incremental auto-vacuum
+            enable_incremental_vacuum()
+        except sqlite3.Error as e:
+            print(f"Error enabling incremental vacuum: {e}")
+            ok = False
+    close_db()
+    log_listener.stop()
+    print(f"Migration {'finished' if ok else 'FAILED'} in {time.monotonic() - start:.1f}s")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,192 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from config import READ_API_RING_SIZE, READ_API_RECENT_SEC, READ_API_MAX_ROWS, DEFAULT_SYSTEM_ID
+from sqlite_handler import (
+    TANK_SENSORS, TANK_TABLES, ROW_KEY_COLUMNS, QUARANTINE, query_range, query_history, newest_rows
+)
+from archive import read_history
+
+logger = logging.getLogger(__name__)
+
+# --- Local Read API ---
+# A small HTTP/JSON service so dashboards on the LAN can read tank status from the Pi itself,
+# with or without internet, instead of going through Firestore or opening the SQLite file:
+#   GET /latest[?tank=&system_id=]                                latest value of every sensor (ring buffer)
+#   GET /recent?tank=[&system_id=&seconds=]                       readings of the last few minutes (ring buffer)
+#   GET /history?tank=&start=&end=[&system_id=&limit=]            raw readings between two epoch times (SQLite + archive)
+#   GET /history?tank=&sensor=&start=&end=[&system_id=&points=]   min/mean/max buckets of one sensor (rollups)
+# The SQLite writer thread feeds the ring as it commits, so the first two never touch the database.
+
+class ReadingRing:
+    """The last `size` stored readings of every tank and system, plus the latest value of each sensor. Thread-safe."""
+
+    # Constructor for ReadingRing class
+    def __init__(self, size=READ_API_RING_SIZE):
+        self.size = size
+        self._readings = {}    # (tank, system_id) -> deque of (ts_ms, timestamp text, sensor values)
+        self._latest = {}      # (tank, system_id) -> {sensor: (value, ts_ms)}
+        self._lock = threading.Lock()
+
+    def add(self, tank, rows):
+        """Adds committed insert tuples of one tank; IngestQueue calls this as its on_store callback."""
+        if tank == QUARANTINE:
+            return
+        sensors = TANK_SENSORS[tank]
+        with self._lock:
+            for row in rows:
+                key = (tank, row[0])
+                ring = self._readings.get(key)
+                if ring is None:
+                    ring = self._readings[key] = deque(maxlen=self.size)
+                    self._latest[key] = {}
+                values = row[ROW_KEY_COLUMNS:]
+                ring.append((row[2], row[1], values))
+                # Missing sensors keep their previous value; late readings don't overwrite newer ones
+                latest = self._latest[key]
+                for sensor, value in zip(sensors, values):
+                    if value is not None and (sensor not in latest or row[2] >= latest[sensor][1]):
+                        latest[sensor] = (value, row[2])
+
+    def load(self):
+        """Fills the ring from SQLite at startup, so /latest answers before the first new message arrives."""
+        for tank in list(TANK_TABLES):
+            self.add(tank, newest_rows(tank, self.size))
+
+    def latest(self, tank=None, system_id=None):
+        """Returns {tank: {system_id: {sensor: {'value', 'ts_ms'}}}}, optionally narrowed to one tank / system."""
+        result = {}
+        with self._lock:
+            for (key_tank, key_system), sensors in self._latest.items():
+                if (tank is None or key_tank == tank) and (system_id is None or key_system == system_id):
+                    result.setdefault(key_tank, {})[key_system] = {
+                        sensor: {'value': value, 'ts_ms': ts_ms} for sensor, (value, ts_ms) in sensors.items()
+                    }
+        return result
+
+    def recent(self, tank, system_id, since_ms):
+        """
+        Returns the readings of one tank and system with ts_ms >= since_ms in time order,
+        or None if the ring doesn't reach back that far (the caller then asks SQLite).
+        """
+        sensors = TANK_SENSORS[tank]
+        with self._lock:
+            ring = self._readings.get((tank, system_id))
+            if not ring or ring[0][0] > since_ms:
+                return None
+            readings = [reading for reading in ring if reading[0] >= since_ms]
+        readings.sort(key=lambda reading: reading[0])
+        return [
+            dict(zip(sensors, values), system_id=system_id, timestamp=timestamp, ts_ms=ts_ms)
+            for ts_ms, timestamp, values in readings
+        ]
+
+class ReadApiError(Exception):
+    """A request the API can't serve; carries the HTTP status."""
+
+    # Constructor for ReadApiError class
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _param(query, name, convert=str, default=None):
+    values = query.get(name)
+    if not values:
+        if default is None:
+            raise ReadApiError(400, f"missing parameter {name}")
+        return default
+    try:
+        return convert(values[0])
+    except ValueError:
+        raise ReadApiError(400, f"invalid value for {name}: {values[0]!r}")
+
+def _tank_param(query):
+    tank = _param(query, 'tank')
+    if tank not in TANK_TABLES:
+        raise ReadApiError(404, f"unknown tank {tank}")
+    return tank
+
+def get_latest(ring, query):
+    tank = query.get('tank', [None])[0]
+    return ring.latest(tank, query.get('system_id', [None])[0])
+
+def get_recent(ring, query):
+    tank = _tank_param(query)
+    system_id = _param(query, 'system_id', default=DEFAULT_SYSTEM_ID)
+    seconds = _param(query, 'seconds', float, READ_API_RECENT_SEC)
+    now = time.time()
+    readings = ring.recent(tank, system_id, int((now - seconds) * 1000))
+    if readings is not None:
+        return {'tank': tank, 'system_id': system_id, 'source': 'ring', 'readings': readings}
+    # Longer than the ring holds (or just after a restart): indexed range query instead
+    readings = query_range(tank, now - seconds, now + 1, system_id)
+    return {'tank': tank, 'system_id': system_id, 'source': 'sqlite', 'readings': readings}
+
+def get_history(ring, query):
+    start = _param(query, 'start', float)
+    end = _param(query, 'end', float)
+    tank = _tank_param(query)
+    system_id = _param(query, 'system_id', default=DEFAULT_SYSTEM_ID)
+    if 'sensor' in query:
+        sensor = _param(query, 'sensor')
+        if sensor not in TANK_SENSORS[tank]:
+            raise ReadApiError(404, f"unknown sensor {sensor} for tank {tank}")
+        points = _param(query, 'points', int, 200)
+        return dict(query_history(tank, sensor, start, end, points, system_id),
+                    tank=tank, system_id=system_id, sensor=sensor)
+    limit = min(_param(query, 'limit', int, READ_API_MAX_ROWS), READ_API_MAX_ROWS)
+    if limit < 0:
+        raise ReadApiError(400, f"invalid value for limit: {limit}")
+    readings = list(islice(read_history(tank, start, end, system_id), limit))
+    return {'tank': tank, 'system_id': system_id, 'source': 'sqlite', 'truncated': len(readings) == limit,
+            'readings': readings}
+
+ROUTES = {
+    '/latest': get_latest,
+    '/recent': get_recent,
+    '/history': get_history,
+}
+
+class _ReadApiHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = ROUTES.get(url.path.rstrip('/') or '/latest')
+        if route is None:
+            self._send(404, {'error': f"no endpoint {url.path}; try {', '.join(ROUTES)}"})
+            return
+        try:
+            self._send(200, route(self.server.ring, parse_qs(url.query)))
+        except ReadApiError as e:
+            self._send(e.status, {'error': str(e)})
+        # A broken request must not take the server thread down
+        except Exception:
+            logger.exception("Error serving %s", self.path)
+            self._send(500, {'error': 'internal error'})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        # Dashboards served from another host on the LAN may read it from the browser
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Dashboards poll every few seconds; the requests would flood the output
+        pass
+
+def start_read_api(ring, host, port):
+    """Serves the read API for ring on host:port from a daemon thread. Returns the server (call shutdown() to stop it)."""
+    server = ThreadingHTTPServer((host, port), _ReadApiHandler)
+    server.daemon_threads = True
+    server.ring = ring
+    thread = threading.Thread(target=server.serve_forever, name="read-api-http", daemon=True)
+    thread.start()
+    return server
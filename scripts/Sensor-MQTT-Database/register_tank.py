@@ -0,0 +1,42 @@
+# Adds a new tank kind to the gateway database without touching config.py or the code.
+# The running gateway picks it up within BACKLOG_CHECK_INTERVAL_SEC; from then on readings published on
+# {system_id}/<tank>/data (JSON) or {system_id}/<tank>/data/bin (binary) are stored and uploaded.
+#
+# Usage: python3 register_tank.py <tank> <sensor>[:<min>:<max>] [<sensor>...] [--collection NAME] [--db PATH]
+# Example: python3 register_tank.py harvest_tank turbidity_NTU:0:4000 temperature_C --collection harvest_tank_data
+import sys
+import argparse
+from config import DB_NAME
+from sqlite_handler import init_db, close_db, create_tank_schema
+from logging_setup import setup_logging
+
+def parse_sensor(text):
+    """Splits 'name' or 'name:min:max' into the name and an optional valid range."""
+    parts = text.split(':')
+    if len(parts) == 1:
+        return parts[0], None
+    if len(parts) == 3:
+        return parts[0], (float(parts[1]), float(parts[2]))
+    raise argparse.ArgumentTypeError(f"expected NAME or NAME:MIN:MAX, got {text!r}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register a new tank kind with the sensor gateway.")
+    parser.add_argument('tank', help="tank name used in topics and table names, e.g. harvest_tank")
+    parser.add_argument('sensors', nargs='+', type=parse_sensor, help="sensor columns, optionally with a valid range")
+    parser.add_argument('--collection', default=None, help="Firestore collection (default: <tank>_data)")
+    parser.add_argument('--db', default=DB_NAME, help="database file")
+    args = parser.parse_args()
+
+    log_listener = setup_logging()
+    ok = init_db(args.db)
+    if ok:
+        sensors = [name for name, bounds in args.sensors]
+        valid_ranges = {name: bounds for name, bounds in args.sensors if bounds is not None}
+        try:
+            ok = create_tank_schema(args.tank, sensors, args.collection, valid_ranges)
+        except ValueError as e:
+            print(f"Error: {e}")
+            ok = False
+    close_db()
+    log_listener.stop()
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,122 @@
+import math
+
+# --- Rollup Resolutions ---
+# (name, bucket width in seconds), finest first. Each has its own table, e.g. rollup_1h.
+# Buckets are aligned to the Unix epoch, so daily buckets start at 00:00 UTC.
+RESOLUTIONS = [
+    ('1m', 60),
+    ('1h', 3600),
+    ('1d', 86400),
+]
+
+# Per-bucket upsert: new samples are folded into the existing row instead of recomputing it.
+# sum_value and sample_count are stored (not the mean) so buckets can keep growing; mean = sum / count.
+UPSERT_SQL = {
+    name: f'''
+        INSERT INTO rollup_{name} (tank, system_id, sensor, bucket, min_value, max_value, sum_value, sample_count, last_value, last_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(tank, system_id, sensor, bucket) DO UPDATE SET
+            min_value = MIN(min_value, excluded.min_value),
+            max_value = MAX(max_value, excluded.max_value),
+            sum_value = sum_value + excluded.sum_value,
+            sample_count = sample_count + excluded.sample_count,
+            last_value = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last_value ELSE last_value END,
+            last_ts = MAX(last_ts, excluded.last_ts)
+    '''
+    for name, width in RESOLUTIONS
+}
+
+SELECT_RANGE_SQL = {
+    name: f'''
+        SELECT bucket, min_value, max_value, sum_value, sample_count, last_value
+        FROM rollup_{name}
+        WHERE tank = ? AND system_id = ? AND sensor = ? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+    '''
+    for name, width in RESOLUTIONS
+}
+
+def create_rollup_tables(conn):
+    """Creates the rollup tables (one per resolution) if they don't exist."""
+    for name, width in RESOLUTIONS:
+        # WITHOUT ROWID: rows are stored in (tank, system_id, sensor, bucket) order, so a range query is one index seek.
+        # Systems and tanks may share sensor names, so each keeps its own buckets.
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS rollup_{name} (
+                tank TEXT NOT NULL,
+                system_id TEXT NOT NULL,
+                sensor TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                min_value REAL NOT NULL,
+                max_value REAL NOT NULL,
+                sum_value REAL NOT NULL,
+                sample_count INTEGER NOT NULL,
+                last_value REAL NOT NULL,
+                last_ts REAL NOT NULL,
+                PRIMARY KEY (tank, system_id, sensor, bucket)
+            ) WITHOUT ROWID
+        ''')
+
+def update_rollups(conn, samples):
+    """
+    Folds (tank, system_id, sensor, epoch seconds, value) samples into every rollup table.
+    Runs inside the caller's insert transaction, so rollups and raw rows always commit together.
+    """
+    for name, width in RESOLUTIONS:
+        # Pre-aggregate in Python first: a batch of 200 readings usually lands in one or two buckets,
+        # so this is a handful of upserts instead of one per reading
+        buckets = {}
+        for tank, system_id, sensor, ts, value in samples:
+            if value is None or ts is None:
+                continue
+            key = (tank, system_id, sensor, int(ts // width) * width)
+            entry = buckets.get(key)
+            if entry is None:
+                buckets[key] = [value, value, value, 1, value, ts]
+            else:
+                if value < entry[0]:
+                    entry[0] = value
+                if value > entry[1]:
+                    entry[1] = value
+                entry[2] += value
+                entry[3] += 1
+                if ts >= entry[5]:
+                    entry[4] = value
+                    entry[5] = ts
+
+        if buckets:
+            conn.executemany(UPSERT_SQL[name], [
+                (*key, *entry) for key, entry in buckets.items()
+            ])
+
+def choose_resolution(start, end, points):
+    """
+    Picks the coarsest resolution that still gives at least `points` buckets over [start, end).
+    Falls back to the finest resolution when even that gives fewer.
+    """
+    span = max(0.0, end - start)
+    for name, width in reversed(RESOLUTIONS):
+        if span / width >= points:
+            return name, width
+    return RESOLUTIONS[0]
+
+def query_rollups(conn, tank, system_id, sensor, start, end, points):
+    """Returns one dictionary per bucket (min, max, mean, count, last) for one sensor of a tank and system over [start, end)."""
+    name, width = choose_resolution(start, end, points)
+    # Include the bucket that contains `start`
+    first_bucket = int(math.floor(start / width)) * width
+    rows = conn.execute(SELECT_RANGE_SQL[name], (tank, system_id, sensor, first_bucket, end)).fetchall()
+    return {
+        'resolution': name,
+        'points': [
+            {
+                'bucket': bucket,
+                'min': min_value,
+                'max': max_value,
+                'mean': sum_value / sample_count,
+                'count': sample_count,
+                'last': last_value,
+            }
+            for bucket, min_value, max_value, sum_value, sample_count, last_value in rows
+        ],
+    }
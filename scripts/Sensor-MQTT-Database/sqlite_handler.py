@@ -1,14 +1,523 @@
+import re
+import json
 import sqlite3
-from config import DB_NAME
+import logging
+import threading
+import queue
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from config import (
+    DB_NAME, DB_READER_POOL_SIZE, DB_BUSY_TIMEOUT_SEC,
+    DB_CACHE_SIZE_KB, DB_MMAP_SIZE_BYTES, DB_STATEMENT_CACHE_SIZE,
+    BACKLOG_PAGE_SIZE, MIGRATION_BATCH_SIZE, DEFAULT_SYSTEM_ID
+)
+from rollups import RESOLUTIONS, create_rollup_tables, update_rollups, query_rollups
+from time_utils import parse_timestamp
+from metrics import (
+    SQLITE_INSERT_SECONDS, SQLITE_COMMIT_SECONDS, SQLITE_ROWS_INSERTED, SQLITE_ERRORS, DUPLICATES_IGNORED
+)
+from logging_setup import PER_MESSAGE
 
-def init_db():
-    """Creates the tables if they don't exist."""
+logger = logging.getLogger(__name__)
+
+# --- SQL Statements ---
+# Kept as module constants so every call passes the exact same string to sqlite3,
+# which lets each connection reuse its cached prepared statement instead of re-parsing the SQL.
+# OR IGNORE: a reading whose (system_id, ts_ms) key is already stored (a QoS 1 redelivery or an
+# ESP32 republish) is skipped by the unique reading-key index instead of being stored twice
+INSERT_MAIN_SQL = '''
+    INSERT OR IGNORE INTO main_tank_logs (system_id, timestamp, ts_ms, temperature_C, light_intensity_lux, water_level_cm, pH_value)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+INSERT_SAMPLING_SQL = '''
+    INSERT OR IGNORE INTO sampling_tank_logs (system_id, timestamp, ts_ms, EC_value)
+    VALUES (?, ?, ?, ?)
+'''
+INSERT_QUARANTINE_SQL = '''
+    INSERT INTO quarantine (received_ms, topic, reason, payload)
+    VALUES (?, ?, ?, ?)
+'''
+# Pseudo tank name for rejected messages; insert_batch stores them without rollups or upload
+QUARANTINE = 'quarantine'
+# Pseudo tank name for the windowed summaries of tanks with the 'summary' upload policy (upload_filter.py).
+# They have an outbox like the tank tables, so the live uploader and the backlog send them the same way.
+SUMMARIES = 'summaries'
+SUMMARY_TABLE = 'upload_summaries'
+# A window is summarized again when late readings arrive: the old summary is deleted and the new one inserted,
+# so it gets a new id above the backlog watermark and is re-uploaded even if its live upload fails.
+# (An in-place update would keep the old id, which the watermark may already have passed.)
+DELETE_SUMMARY_SQL = "DELETE FROM upload_summaries WHERE tank = ? AND system_id = ? AND ts_ms = ?"
+INSERT_SUMMARY_SQL = '''
+    INSERT INTO upload_summaries (system_id, timestamp, ts_ms, tank, window_sec, summary)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+# Values of the uploaded column: waiting (the outbox), confirmed in Firestore, or kept local-only by the upload policy
+PENDING, UPLOADED, SUPPRESSED = 0, 1, 2
+# Number of leading columns (system_id, timestamp, ts_ms) in the insert tuples before the sensor values
+ROW_KEY_COLUMNS = 3
+SELECT_PENDING_COUNT_SQL = "SELECT pending FROM outbox_counts WHERE table_name = ?"
+SELECT_TOTAL_PENDING_SQL = "SELECT COALESCE(SUM(pending), 0) FROM outbox_counts"
+SELECT_WATERMARK_SQL = "SELECT watermark FROM outbox_counts WHERE table_name = ?"
+UPDATE_WATERMARK_SQL = "UPDATE outbox_counts SET watermark = MAX(watermark, ?) WHERE table_name = ?"
+
+# Tank name -> SQLite table
+TANK_TABLES = {
+    'main_tank': 'main_tank_logs',
+    'sampling_tank': 'sampling_tank_logs',
+}
+# The two original tables; the schema migrations only ever touch these.
+# Tanks added at runtime (register_tank) are created directly at the current schema.
+BUILTIN_TANK_TABLES = dict(TANK_TABLES)
+# Everything uploaded through an outbox: the tank tables plus the summaries
+OUTBOX_TABLES = dict(TANK_TABLES, **{SUMMARIES: SUMMARY_TABLE})
+
+# --- Backlog Records ---
+# Pending rows are handed out as namedtuples: plain tuples in memory (no per-row dict),
+# with field access by name for the upload code. Every record starts with RECORD_KEY_FIELDS.
+RECORD_KEY_FIELDS = ('id', 'system_id', 'timestamp')
+MainRecord = namedtuple('MainRecord', RECORD_KEY_FIELDS + ('temperature_C', 'light_intensity_lux', 'water_level_cm', 'pH_value'))
+SamplingRecord = namedtuple('SamplingRecord', RECORD_KEY_FIELDS + ('EC_value',))
+
+RECORD_TYPES = {
+    'main_tank': MainRecord,
+    'sampling_tank': SamplingRecord,
+}
+
+# Tank name -> sensor columns (everything after the key fields), used for the rollup tables
+TANK_SENSORS = {
+    tank: record_type._fields[len(RECORD_KEY_FIELDS):]
+    for tank, record_type in RECORD_TYPES.items()
+}
+
+class SummaryRecord(namedtuple('SummaryRecord', ['id', 'timestamp', 'tank', 'window_sec', 'summary'])):
+    """A pending window summary. summary is the JSON text stored in SQLite; _asdict() expands it for Firestore."""
+    __slots__ = ()
+
+    def _asdict(self):
+        document = {'id': self.id, 'timestamp': self.timestamp, 'tank': self.tank, 'window_sec': self.window_sec}
+        document.update(json.loads(self.summary))
+        # One document per tank, system and window: a re-summarized window overwrites its document
+        document['document_id'] = f"{self.tank}_{document['system_id']}_{self.timestamp}"
+        return document
+
+RECORD_TYPES[SUMMARIES] = SummaryRecord
+
+# Per-tank statements, filled in by _add_tank_sql for the built-in tanks and for every tank added at runtime
+SELECT_PENDING_PAGE_SQL = {}
+SELECT_RANGE_SQL = {}
+MARK_UPLOADED_SQL = {}
+SELECT_MAX_ID_SQL = {}
+SELECT_NEW_KEYS_SQL = {}
+SELECT_PENDING_IDS_SQL = {}
+MARK_SUPPRESSED_SQL = {}
+SELECT_WINDOW_STATS_SQL = {}
+SELECT_NEWEST_SQL = {}
+SELECT_PENDING_BY_TIMESTAMP_SQL = {}
+
+def _add_outbox_sql(tank, table):
+    """Builds the statements the uploaders need for one outbox table (a tank table or the summaries)."""
+    # Keyset pagination: "id > last seen id" + LIMIT, walking the partial pending index in id order,
+    # so every page is an index seek no matter how deep into the backlog it is
+    SELECT_PENDING_PAGE_SQL[tank] = (
+        f"SELECT {', '.join(RECORD_TYPES[tank]._fields)} FROM {table} WHERE uploaded = 0 AND id > ? ORDER BY id LIMIT ?"
+    )
+    # The flag update is keyed on the primary key; "AND uploaded = 0" keeps the outbox counter exact
+    # if the same row is confirmed twice
+    MARK_UPLOADED_SQL[tank] = f"UPDATE {table} SET uploaded = 1 WHERE id = ? AND uploaded = 0"
+    # Walks the partial pending index, so it only touches rows that are still waiting
+    SELECT_PENDING_IDS_SQL[tank] = f"SELECT id FROM {table} WHERE uploaded = 0 AND id BETWEEN ? AND ?"
+
+def _add_tank_sql(tank, table):
+    """Builds the per-tank SELECT/UPDATE statements from the tank's record type and sensor columns."""
+    _add_outbox_sql(tank, table)
+    SELECT_RANGE_SQL[tank] = (
+        f"SELECT id, system_id, timestamp, ts_ms, {', '.join(TANK_SENSORS[tank])} FROM {table} "
+        f"WHERE system_id = ? AND ts_ms >= ? AND ts_ms < ? ORDER BY ts_ms"
+    )
+    # Used by insert_batch to find which rows of an INSERT OR IGNORE batch were really stored
+    SELECT_MAX_ID_SQL[tank] = f"SELECT COALESCE(MAX(id), 0) FROM {table}"
+    SELECT_NEW_KEYS_SQL[tank] = f"SELECT id, system_id, ts_ms FROM {table} WHERE id > ? ORDER BY id"
+    # Readings the upload policy keeps local-only leave the outbox without being uploaded
+    MARK_SUPPRESSED_SQL[tank] = f"UPDATE {table} SET uploaded = 2 WHERE id = ? AND uploaded = 0"
+    # Newest rows as insert tuples, walking the primary key backwards
+    SELECT_NEWEST_SQL[tank] = (
+        f"SELECT system_id, timestamp, ts_ms, {', '.join(TANK_SENSORS[tank])} FROM {table} ORDER BY id DESC LIMIT ?"
+    )
+    # Min/mean/max of every sensor over one system's window, a range seek on the reading-key index
+    SELECT_WINDOW_STATS_SQL[tank] = (
+        f"SELECT COUNT(*), {', '.join(f'MIN({name}), AVG({name}), MAX({name})' for name in TANK_SENSORS[tank])} "
+        f"FROM {table} WHERE system_id = ? AND ts_ms >= ? AND ts_ms < ?"
+    )
+    # Only for update_upload_flag: timestamp is not indexed, but the partial pending index narrows the scan
+    SELECT_PENDING_BY_TIMESTAMP_SQL[tank] = f"SELECT id FROM {table} WHERE uploaded = 0 AND timestamp = ?"
+
+for _tank, _table in BUILTIN_TANK_TABLES.items():
+    _add_tank_sql(_tank, _table)
+_add_outbox_sql(SUMMARIES, SUMMARY_TABLE)
+
+
+class ConnectionManager:
+    """Keeps one writer connection and a small pool of reader connections open for the whole process."""
+
+    # Constructor for ConnectionManager class
+    def __init__(self, db_path, reader_pool_size=DB_READER_POOL_SIZE):
+        self.db_path = db_path
+        # SQLite only allows one writer at a time, so all writes share one connection behind a lock
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        # Switch the journal to WAL once (the setting is stored in the database file)
+        # WAL lets readers keep reading while the writer commits, and a commit only appends to the -wal file
+        self._writer.execute("PRAGMA journal_mode=WAL")
+
+        # Readers are handed out from a queue; LIFO keeps the most recently used (warmest cache) connection in use
+        self._readers = queue.LifoQueue()
+        for _ in range(max(1, reader_pool_size)):
+            self._readers.put(self._connect())
+
+    def _connect(self):
+        """Opens a connection and applies the per-connection tuning pragmas."""
+        # check_same_thread=False: connections are shared between paho's network thread and the main loop,
+        # access is serialised by the write lock / reader queue instead
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_SEC,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        # synchronous=NORMAL is safe with WAL: a power cut can lose the last few commits but never corrupts the file,
+        # and it removes the fsync on every commit (only checkpoints fsync)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Negative value = size in KiB rather than number of pages
+        conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE_BYTES)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Yields the writer connection; commits on success and rolls back on error."""
+        with self._write_lock:
+            try:
+                yield self._writer
+                with SQLITE_COMMIT_SECONDS.time():
+                    self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                SQLITE_ERRORS.inc()
+                raise
+
+    @contextmanager
+    def reader(self):
+        """Borrows a reader connection from the pool and returns it afterwards."""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def close(self):
+        """Closes every connection held by the manager."""
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+
+# --- Module-level Connection Manager ---
+# Created on first use so importing this module never touches the database file
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_manager():
+    """Returns the shared ConnectionManager, creating it for DB_NAME on first use."""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ConnectionManager(DB_NAME)
+    return _manager
+
+def close_db():
+    """Closes the shared connections (call once on shutdown)."""
+    global _manager
+    with _manager_lock:
+        if _manager is not None:
+            _manager.close()
+            _manager = None
+
+# --- Schema Migrations ---
+# PRAGMA user_version stores how many migrations a database file has had applied.
+# Each migration runs once, in order, inside its own transaction (long data conversions
+# commit in batches instead and are safe to re-run), so existing algae_project.db files
+# are upgraded in place the next time init_db() runs.
+
+def _migrate_outbox(conn):
+    """v1: partial indexes on pending rows plus trigger-maintained pending counters (the outbox)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox_counts (
+            table_name TEXT PRIMARY KEY,
+            pending INTEGER NOT NULL
+        )
+    ''')
+    for table in BUILTIN_TANK_TABLES.values():
+        _create_outbox(conn, table)
+
+def _create_outbox(conn, table):
+    """Creates the pending index, the outbox counter row and the triggers that keep it current for one table."""
+    # Partial index: only rows with uploaded = 0 are in it, so it stays tiny once the backlog is drained
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_pending ON {table}(id) WHERE uploaded = 0")
+
+    # Seed the counter once from the existing rows (uses the new index)
+    conn.execute(f"""
+        INSERT OR IGNORE INTO outbox_counts (table_name, pending)
+        SELECT '{table}', COUNT(*) FROM {table} WHERE uploaded = 0
+    """)
+
+    # Keep the counter in step with every insert, flag change and delete,
+    # so the pending count is a single-row lookup instead of a COUNT(*)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_outbox_insert AFTER INSERT ON {table}
+        WHEN NEW.uploaded = 0
+        BEGIN
+            UPDATE outbox_counts SET pending = pending + 1 WHERE table_name = '{table}';
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_outbox_update AFTER UPDATE OF uploaded ON {table}
+        WHEN (OLD.uploaded = 0) != (NEW.uploaded = 0)
+        BEGIN
+            UPDATE outbox_counts
+            SET pending = pending + (CASE WHEN NEW.uploaded = 0 THEN 1 ELSE -1 END)
+            WHERE table_name = '{table}';
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_outbox_delete AFTER DELETE ON {table}
+        WHEN OLD.uploaded = 0
+        BEGIN
+            UPDATE outbox_counts SET pending = pending - 1 WHERE table_name = '{table}';
+        END
+    """)
+
+def _migrate_watermark(conn):
+    """v2: per-table backlog watermark (every row with id <= watermark is known to be uploaded)."""
+    conn.execute("ALTER TABLE outbox_counts ADD COLUMN watermark INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_rollups(conn):
+    """v3: minute/hour/day rollup tables (filled from the existing rows by v9, once readings carry a system id)."""
+    create_rollup_tables(conn)
+
+def _migrate_epoch_timestamps(conn, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    v4: integer epoch-millisecond timestamps (ts_ms) and a system identifier on both log tables,
+    indexed for range queries. The backfill commits every batch, so it never holds the table in
+    memory or in one huge transaction. Unlike the other migrations v4 is therefore not atomic: it is
+    resumable instead. Every step is idempotent (column checks, "ts_ms IS NULL", IF NOT EXISTS) and
+    user_version only becomes 4 at the end, so an interrupted run simply picks up where it stopped.
+    """
+    for table in BUILTIN_TANK_TABLES.values():
+        # ALTER TABLE has no IF NOT EXISTS, so check the columns (a resumed run already has them)
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if 'ts_ms' not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN ts_ms INTEGER")
+        if 'system_id' not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN system_id TEXT NOT NULL DEFAULT '{DEFAULT_SYSTEM_ID}'")
+    conn.commit()
+
+    for table in BUILTIN_TANK_TABLES.values():
+        # Parse each old TEXT timestamp once; rows whose text can't be parsed keep ts_ms = NULL
+        last_id = 0
+        converted = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT id, timestamp FROM {table} WHERE id > ? AND ts_ms IS NULL ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row_id, text in rows:
+                # parse_timestamp returns None outside [0, MAX_EPOCH_SEC] (e.g. a legacy "1e300"),
+                # so int(ts * 1000) always fits SQLite's int64
+                ts = parse_timestamp(text)
+                if ts is not None:
+                    updates.append((int(ts * 1000), row_id))
+            conn.executemany(f"UPDATE {table} SET ts_ms = ? WHERE id = ?", updates)
+            conn.commit()
+            converted += len(updates)
+            last_id = rows[-1][0]
+        if converted:
+            logger.info("Converted %d %s timestamps to epoch milliseconds", converted, table)
+
+        # Built after the backfill: one index build is much cheaper than updating it row by row
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_system_ts ON {table}(system_id, ts_ms)")
+
+def _migrate_quarantine(conn):
+    """v5: quarantine table for payloads that failed decoding or validation."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS quarantine (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            received_ms INTEGER NOT NULL,
+            topic TEXT,
+            reason TEXT,
+            payload BLOB
+        )
+    """)
+
+def _migrate_tank_schemas(conn):
+    """v6: registry of tank kinds added at runtime (see register_tank)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tank_schemas (
+            tank TEXT PRIMARY KEY,
+            sensors TEXT NOT NULL,
+            collection TEXT NOT NULL,
+            valid_ranges TEXT NOT NULL DEFAULT '{}'
+        )
+    """)
+
+def _migrate_reading_keys(conn):
+    """v7: one row per reading. Removes stored duplicates and makes (system_id, ts_ms) unique."""
+    tables = list(BUILTIN_TANK_TABLES.values())
+    tables += [f"{tank}_logs" for (tank,) in conn.execute("SELECT tank FROM tank_schemas")]
+    for table in tables:
+        # If any copy of a reading was uploaded, the reading was: carry the flag over to the
+        # copies so the one that survives below is not uploaded again
+        conn.execute(f"""
+            UPDATE {table} SET uploaded = 1
+            WHERE uploaded = 0 AND ts_ms IS NOT NULL AND EXISTS (
+                SELECT 1 FROM {table} AS copy
+                WHERE copy.system_id = {table}.system_id AND copy.ts_ms = {table}.ts_ms
+                  AND copy.id != {table}.id AND copy.uploaded != 0
+            )
+        """)
+        # Keep the oldest copy of every reading (the outbox triggers adjust the pending counters)
+        removed = conn.execute(f"""
+            DELETE FROM {table}
+            WHERE ts_ms IS NOT NULL AND EXISTS (
+                SELECT 1 FROM {table} AS older
+                WHERE older.system_id = {table}.system_id AND older.ts_ms = {table}.ts_ms
+                  AND older.id < {table}.id
+            )
+        """).rowcount
+        if removed:
+            logger.info("Removed %d duplicate readings from %s", removed, table)
+
+        # The unique index replaces the plain (system_id, ts_ms) index for range queries as well
+        conn.execute(f"DROP INDEX IF EXISTS idx_{table}_system_ts")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_reading_key ON {table}(system_id, ts_ms)")
+
+def _migrate_upload_summaries(conn):
+    """v8: outbox table for the windowed summaries uploaded instead of raw readings (upload_filter.py)."""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            system_id TEXT NOT NULL,
+            timestamp TEXT,
+            ts_ms INTEGER NOT NULL,
+            tank TEXT NOT NULL,
+            window_sec INTEGER NOT NULL,
+            summary TEXT NOT NULL,
+            uploaded INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{SUMMARY_TABLE}_window ON {SUMMARY_TABLE}(tank, system_id, ts_ms)")
+    _create_outbox(conn, SUMMARY_TABLE)
+
+def _migrate_rollup_keys(conn, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    v9: rollups keyed by (tank, system_id, sensor, bucket) instead of (sensor, bucket), which mixed systems
+    and tanks that share a sensor name. The old buckets can't be split, so the tables are rebuilt from the
+    archive segments and the rows still in SQLite, in fixed-size batches.
+    """
+    # Imported here: archive imports this module
+    from archive import archived_rows
+
+    for name, width in RESOLUTIONS:
+        conn.execute(f"DROP TABLE IF EXISTS rollup_{name}")
+    create_rollup_tables(conn)
+
+    tanks = {tank: TANK_SENSORS[tank] for tank in BUILTIN_TANK_TABLES}
+    for tank, sensors in conn.execute("SELECT tank, sensors FROM tank_schemas").fetchall():
+        tanks[tank] = tuple(json.loads(sensors))
+    for tank, sensors in tanks.items():
+        table = f"{tank}_logs"
+        columns = ', '.join(('id', 'system_id', 'timestamp', 'ts_ms') + sensors)
+        first_ms = conn.execute(f"SELECT MIN(ts_ms) FROM {table}").fetchone()[0]
+
+        # Archived rows first. A crash between writing a segment and deleting its rows leaves some of them
+        # in SQLite too; those are no older than the oldest row still there, so only their ids are remembered.
+        overlap = set()
+        samples = []
+        for row in archived_rows(table):
+            ts_ms = int(row['ts'] * 1000)
+            if first_ms is not None and ts_ms >= first_ms:
+                overlap.add(row['id'])
+            values = tuple(row.get(sensor) for sensor in sensors)
+            samples.extend(rollup_samples(tank, [(row['system_id'], row['timestamp'], ts_ms) + values], sensors))
+            if len(samples) >= batch_size:
+                update_rollups(conn, samples)
+                samples = []
+        update_rollups(conn, samples)
+
+        # Then the rows still in SQLite, walked by id so the rebuild never holds the whole table in memory
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT {columns} FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            update_rollups(conn, rollup_samples(tank, [
+                row[1:] for row in rows if row[0] not in overlap and row[3] is not None
+            ], sensors))
+            last_id = rows[-1][0]
+
+# Index i holds the migration that takes a database from user_version i to i + 1
+MIGRATIONS = [
+    _migrate_outbox,
+    _migrate_watermark,
+    _migrate_rollups,
+    _migrate_epoch_timestamps,
+    _migrate_quarantine,
+    _migrate_tank_schemas,
+    _migrate_reading_keys,
+    _migrate_upload_summaries,
+    _migrate_rollup_keys,
+]
+
+def migrate_db(conn):
+    """Applies any migrations the database file has not had yet."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target_version in range(version + 1, len(MIGRATIONS) + 1):
+        # Explicit BEGIN so the DDL and the version bump commit (or roll back) together
+        # (v4 commits its backfill batch by batch and is resumable rather than atomic)
+        conn.execute("BEGIN")
+        try:
+            MIGRATIONS[target_version - 1](conn)
+            conn.execute(f"PRAGMA user_version = {target_version}")
+            conn.commit()
+        # Any error, not only sqlite3.Error: the migration must not be left half applied in an open transaction
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info("Database migrated to schema version %d", target_version)
+
+def init_db(db_path=DB_NAME):
+    """Creates the tables if they don't exist and opens the shared connections for db_path."""
+    global _manager
     try:
-        # Conect with the database file, SQLite creates the file if it does not exist
-        with sqlite3.connect(DB_NAME) as conn:
+        # Replace any previously opened manager so the whole module points at db_path
+        with _manager_lock:
+            if _manager is not None:
+                _manager.close()
+            # SQLite creates the file if it does not exist
+            _manager = ConnectionManager(db_path)
+
+        with _manager.writer() as conn:
             # Cursor object as a pointer to execute SQL commands and retrieve results from database
             cursor = conn.cursor()
-            
+
             # --- Main Tank Table ---
             # id INTEGER PRIMARY KEY AUTOINCREMENT: define a unique id for each row
             # TEXT: store the data as string
@@ -18,7 +527,7 @@ def init_db():
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS main_tank_logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT, 
+                    timestamp TEXT,
                     temperature_C REAL,
                     light_intensity_lux REAL,
                     water_level_cm REAL,
@@ -36,111 +545,487 @@ def init_db():
                     uploaded INTEGER DEFAULT 0
                 )
             ''')
-            
-            # Finalise the table changes/creations and make them permanent in database file
-            conn.commit()
-            print(f"Database '{DB_NAME}' initialized successfully.")
-            return True
-           
+
+            # Bring older database files up to the current schema
+            migrate_db(conn)
+
+        # Leaving the writer block commits the table changes/creations to the database file
+        logger.info("Database '%s' initialized successfully.", db_path)
+        return True
+
     # Only handle errors that are related to SQLite database operations
     except sqlite3.Error as e:
-        print(f"Database error during init: {e}")
+        logger.error("Database error during init: %s", e)
+        return False
+
+def row_key(data_dict, received_at):
+    """
+    Returns the (system_id, timestamp text, ts_ms) columns shared by both log tables.
+    The ESP32 timestamp is parsed once here; if it can't be parsed, the Pi's receive time is used.
+    """
+    ts = parse_timestamp(data_dict.get('timestamp'))
+    if ts is None:
+        ts = received_at
+    return (
+        data_dict.get('system_id') or DEFAULT_SYSTEM_ID,
+        data_dict.get('timestamp'),
+        int(ts * 1000)
+    )
+
+def main_row(data_dict, received_at):
+    """Builds the main_tank_logs insert tuple from a decoded JSON message."""
+    # Use data_dict.get() to safely retrieve values
+    # If a key is missing in the JSON, it inserts None (NULL)
+    return row_key(data_dict, received_at) + (
+        data_dict.get('temperature_C'),
+        data_dict.get('light_intensity_lux'),
+        data_dict.get('water_level_cm'),
+        data_dict.get('pH_value')
+    )
+
+def sampling_row(data_dict, received_at):
+    """Builds the sampling_tank_logs insert tuple from a decoded JSON message."""
+    return row_key(data_dict, received_at) + (
+        data_dict.get('EC_value'),
+    )
+
+# Tank name -> (insert statement, row builder), used by insert_batch
+INSERT_TARGETS = {
+    'main_tank': (INSERT_MAIN_SQL, main_row),
+    'sampling_tank': (INSERT_SAMPLING_SQL, sampling_row),
+}
+
+# --- Runtime Tank Schemas ---
+# New tank kinds need no code or config change: create_tank_schema() stores the sensor list in
+# tank_schemas and creates a <tank>_logs table laid out like the built-in ones (system_id, timestamp,
+# ts_ms, one REAL column per sensor, uploaded) with its own outbox and unique (system_id, ts_ms) index.
+# define_tank() then adds it to the lookup tables above, so every function in this module handles it.
+IDENTIFIER_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+SELECT_TANK_SCHEMAS_SQL = "SELECT tank, sensors, collection, valid_ranges FROM tank_schemas ORDER BY tank"
+UPSERT_TANK_SCHEMA_SQL = '''
+    INSERT INTO tank_schemas (tank, sensors, collection, valid_ranges) VALUES (?, ?, ?, ?)
+    ON CONFLICT(tank) DO UPDATE SET
+        sensors = excluded.sensors, collection = excluded.collection, valid_ranges = excluded.valid_ranges
+'''
+
+def _check_tank_schema(tank, sensors):
+    """Raises ValueError unless the names are safe to use as SQL identifiers and the tank isn't built in."""
+    if tank in BUILTIN_TANK_TABLES or tank in (QUARANTINE, SUMMARIES):
+        raise ValueError(f"{tank} is a built-in tank")
+    if not sensors:
+        raise ValueError(f"{tank} needs at least one sensor")
+    for name in (tank,) + tuple(sensors):
+        if not IDENTIFIER_PATTERN.match(name):
+            raise ValueError(f"invalid name {name!r}: use letters, digits and underscores")
+
+def row_builder(sensors):
+    """Returns a builder (like main_row) for a tank with the given sensor columns."""
+    def build(data_dict, received_at):
+        return row_key(data_dict, received_at) + tuple(data_dict.get(name) for name in sensors)
+    return build
+
+def define_tank(tank, sensors):
+    """Adds a runtime tank kind to the in-memory lookup tables. Its table must already exist."""
+    _check_tank_schema(tank, sensors)
+    sensors = tuple(sensors)
+    table = f"{tank}_logs"
+    RECORD_TYPES[tank] = namedtuple(
+        ''.join(part.capitalize() for part in tank.split('_')) + 'Record', RECORD_KEY_FIELDS + sensors
+    )
+    TANK_SENSORS[tank] = sensors
+    _add_tank_sql(tank, table)
+    placeholders = ', '.join('?' * (ROW_KEY_COLUMNS + len(sensors)))
+    INSERT_TARGETS[tank] = (
+        f"INSERT OR IGNORE INTO {table} (system_id, timestamp, ts_ms, {', '.join(sensors)}) VALUES ({placeholders})",
+        row_builder(sensors)
+    )
+    OUTBOX_TABLES[tank] = table
+    # Added last: the rest of the gateway treats a tank as existing once it is in TANK_TABLES
+    TANK_TABLES[tank] = table
+    return table
+
+def create_tank_table(conn, tank, sensors):
+    """Creates (or extends with new sensor columns) the log table of a runtime tank, with its outbox and indexes."""
+    table = f"{tank}_logs"
+    sensor_columns = ''.join(f", {name} REAL" for name in sensors)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            system_id TEXT NOT NULL DEFAULT '{DEFAULT_SYSTEM_ID}',
+            timestamp TEXT,
+            ts_ms INTEGER{sensor_columns},
+            uploaded INTEGER DEFAULT 0
+        )
+    """)
+    # Re-registering a tank with extra sensors adds their columns; existing rows read them as NULL
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name in sensors:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} REAL")
+    _create_outbox(conn, table)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_reading_key ON {table}(system_id, ts_ms)")
+
+def create_tank_schema(tank, sensors, collection=None, valid_ranges=None):
+    """
+    Registers a new tank kind in the database: creates its table and stores the schema in tank_schemas,
+    where a running gateway picks it up (tank_registry.load_tanks). Returns True on success.
+    """
+    _check_tank_schema(tank, sensors)
+    try:
+        with get_manager().writer() as conn:
+            create_tank_table(conn, tank, sensors)
+            conn.execute(UPSERT_TANK_SCHEMA_SQL, (
+                tank, json.dumps(list(sensors)), collection or f"{tank}_data", json.dumps(valid_ranges or {})
+            ))
+        logger.info("Registered tank %s with sensors %s", tank, ', '.join(sensors))
+        return True
+
+    except sqlite3.Error as e:
+        logger.error("Error registering tank %s: %s", tank, e)
         return False
 
+def load_tank_schemas():
+    """Returns the runtime tank schemas stored in the database as dictionaries."""
+    try:
+        with get_manager().reader() as conn:
+            rows = conn.execute(SELECT_TANK_SCHEMAS_SQL).fetchall()
+    except sqlite3.Error as e:
+        logger.error("Error reading tank schemas: %s", e)
+        return []
+    return [
+        {
+            'tank': tank,
+            'sensors': tuple(json.loads(sensors)),
+            'collection': collection,
+            'valid_ranges': {name: tuple(bounds) for name, bounds in json.loads(valid_ranges).items()},
+        }
+        for tank, sensors, collection, valid_ranges in rows
+    ]
+
+def rollup_samples(tank, rows, sensors=None):
+    """Turns insert tuples into (tank, system_id, sensor, epoch seconds, value) samples for update_rollups."""
+    samples = []
+    if sensors is None:
+        sensors = TANK_SENSORS[tank]
+    for row in rows:
+        ts = row[2] / 1000.0
+        for sensor, value in zip(sensors, row[ROW_KEY_COLUMNS:]):
+            # Only numbers can be aggregated; anything else is still stored in the raw table
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                samples.append((tank, row[0], sensor, ts, value))
+    return samples
+
 def insert_main_data(data_dict):
     """Inserts data into main_tank_logs using specific JSON keys."""
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            
-            # Use data_dict.get() to safely retrieve values
-            # If a key is missing in the JSON, it inserts None (NULL)
+        with get_manager().writer() as conn:
             # ? : parameter placeholders, indicate the actual values for insertion
             #     will be provided separately when SQL statement is executed
-            cursor.execute('''
-                INSERT INTO main_tank_logs (timestamp, temperature_C, light_intensity_lux, water_level_cm, pH_value)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                data_dict.get('timestamp'), 
-                data_dict.get('temperature_C'), 
-                data_dict.get('light_intensity_lux'), 
-                data_dict.get('water_level_cm'),
-                data_dict.get('pH_value')
-            ))
-            conn.commit()
-            print(f">> Saved Main Tank data: {data_dict.get('timestamp')}")
-            return True
-        
+            row = main_row(data_dict, time.time())
+            # An already stored reading is ignored by the insert and must not be counted in the rollups again
+            if conn.execute(INSERT_MAIN_SQL, row).rowcount == 1:
+                update_rollups(conn, rollup_samples('main_tank', [row]))
+        logger.debug("Saved Main Tank data: %s", data_dict.get('timestamp'), extra=PER_MESSAGE)
+        return True
+
     except sqlite3.Error as e:
-        print(f"Error inserting main data: {e}")
+        logger.error("Error inserting main data: %s", e, extra=PER_MESSAGE)
         return False
 
 def insert_sampling_data(data_dict):
     """Inserts data into sampling_tank_logs using specific JSON keys."""
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO sampling_tank_logs (timestamp, EC_value)
-                VALUES (?, ?)
-            ''', (
-                data_dict.get('timestamp'), 
-                data_dict.get('EC_value')
-            ))
-            conn.commit()
-            print(f">> Saved Sampling Tank data: {data_dict.get('timestamp')}")
-            return True
-        
+        with get_manager().writer() as conn:
+            row = sampling_row(data_dict, time.time())
+            if conn.execute(INSERT_SAMPLING_SQL, row).rowcount == 1:
+                update_rollups(conn, rollup_samples('sampling_tank', [row]))
+        logger.debug("Saved Sampling Tank data: %s", data_dict.get('timestamp'), extra=PER_MESSAGE)
+        return True
+
     except sqlite3.Error as e:
-        print(f"Error inserting sampling data: {e}")
+        logger.error("Error inserting sampling data: %s", e, extra=PER_MESSAGE)
         return False
-    
+
+def make_record(tank, row_id, row):
+    """Turns an insert tuple plus its new row id into the tank's backlog record (namedtuple)."""
+    return RECORD_TYPES[tank](row_id, row[0], row[1], *row[ROW_KEY_COLUMNS:])
+
+def insert_batch(batch, upload_filter=None):
+    """
+    Inserts many messages in a single transaction (group commit).
+    batch maps a tank name ('main_tank' / 'sampling_tank' / QUARANTINE) to a list of insert tuples,
+    as built by main_row / sampling_row / the decoders.
+    Readings that are already stored (same system_id and ts_ms) are ignored.
+    upload_filter (an upload_filter.UploadFilter) decides which stored readings go to Firestore; the others
+    are flagged SUPPRESSED, and the window summaries it closes are written in the same transaction.
+    Returns (uploads, stored), or None if the transaction failed: uploads maps each tank (and SUMMARIES)
+    to (row ids, insert tuples) still to be uploaded, stored maps each tank (and QUARANTINE) to the
+    insert tuples written.
+    """
+    uploads = {}
+    stored_rows = {}
+    closed_windows = []
+    try:
+        with get_manager().writer() as conn:
+            for tank, rows in batch.items():
+                if not rows:
+                    continue
+                if tank == QUARANTINE:
+                    conn.executemany(INSERT_QUARANTINE_SQL, rows)
+                    stored_rows[tank] = rows
+                    continue
+                insert_sql = INSERT_TARGETS[tank][0]
+                with SQLITE_INSERT_SECONDS.time(tank):
+                    last_id = conn.execute(SELECT_MAX_ID_SQL[tank]).fetchone()[0]
+                    # executemany reuses the one prepared statement for every row
+                    stored = conn.executemany(insert_sql, rows).rowcount
+                    new_keys = conn.execute(SELECT_NEW_KEYS_SQL[tank], (last_id,)).fetchall()
+                if stored == len(rows):
+                    # Nothing was ignored: the new ids are in insert order
+                    ids, new_rows = [row_id for row_id, _, _ in new_keys], rows
+                else:
+                    # Match the stored rows back by key; within the batch the first copy is the one stored
+                    by_key = {}
+                    for row in rows:
+                        by_key.setdefault((row[0], row[2]), row)
+                    ids = [row_id for row_id, _, _ in new_keys]
+                    new_rows = [by_key[(system_id, ts_ms)] for _, system_id, ts_ms in new_keys]
+                    DUPLICATES_IGNORED.inc(tank, 'sqlite', amount=len(rows) - stored)
+                if not new_rows:
+                    continue
+                stored_rows[tank] = new_rows
+                # Fold the new readings into the minute/hour/day rollups in the same transaction
+                update_rollups(conn, rollup_samples(tank, new_rows))
+
+                if upload_filter is not None:
+                    upload, windows = upload_filter.select(tank, new_rows)
+                    closed_windows.extend(windows)
+                    conn.executemany(MARK_SUPPRESSED_SQL[tank], [
+                        (row_id,) for row_id, keep in zip(ids, upload) if not keep
+                    ])
+                    ids = [row_id for row_id, keep in zip(ids, upload) if keep]
+                    new_rows = [row for row, keep in zip(new_rows, upload) if keep]
+                if new_rows:
+                    uploads[tank] = (ids, new_rows)
+
+            if closed_windows:
+                summary_ids, summary_rows = _write_summaries(conn, closed_windows)
+                if summary_rows:
+                    uploads[SUMMARIES] = (summary_ids, summary_rows)
+        # Counted once the transaction has committed
+        for tank, rows in stored_rows.items():
+            SQLITE_ROWS_INSERTED.inc(tank, amount=len(rows))
+        return uploads, stored_rows
+
+    except sqlite3.Error as e:
+        logger.error("Error inserting batch: %s", e)
+        return None
+    # Anything else (a value sqlite3 can't bind, an int beyond int64, a bug in the upload filter) has
+    # rolled the transaction back just the same; report it like a failed batch so the writer keeps going
+    except Exception:
+        logger.exception("Unexpected error inserting batch")
+        return None
+
+def _write_summaries(conn, windows):
+    """
+    Computes each (tank, system_id, window start ms, window_sec) window from the stored readings and writes
+    its summary (replacing an older one), inside the caller's transaction. Returns (summary row ids, insert tuples).
+    """
+    ids, rows = [], []
+    for tank, system_id, start_ms, window_sec in dict.fromkeys(windows):
+        stats = conn.execute(
+            SELECT_WINDOW_STATS_SQL[tank], (system_id, start_ms, start_ms + window_sec * 1000)
+        ).fetchone()
+        if not stats[0]:
+            continue
+        summary = {'system_id': system_id, 'count': stats[0]}
+        for index, sensor in enumerate(TANK_SENSORS[tank]):
+            low, mean, high = stats[1 + 3 * index:4 + 3 * index]
+            summary[f"{sensor}_min"] = low
+            summary[f"{sensor}_mean"] = mean
+            summary[f"{sensor}_max"] = high
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_ms / 1000))
+        row = (system_id, timestamp, start_ms, tank, window_sec, json.dumps(summary))
+        conn.execute(DELETE_SUMMARY_SQL, (tank, system_id, start_ms))
+        ids.append(conn.execute(INSERT_SUMMARY_SQL, row).lastrowid)
+        rows.append(row)
+    return ids, rows
+
+def write_summaries(windows):
+    """
+    Writes the summaries of windows that closed by time rather than by a newer reading, in one transaction.
+    Returns (summary row ids, insert tuples), or None if the transaction failed.
+    """
+    try:
+        with get_manager().writer() as conn:
+            return _write_summaries(conn, windows)
+
+    except sqlite3.Error as e:
+        logger.error("Error writing upload summaries: %s", e)
+        return None
+    except Exception:
+        logger.exception("Unexpected error writing upload summaries")
+        return None
+
+def mark_uploaded(tank, row_ids, watermark=None):
+    """
+    Sets the uploaded flag to 1 for the given primary keys of one tank table, in one transaction.
+    If watermark is given, the tank's backlog watermark is moved up to it in the same transaction.
+    """
+    if not row_ids and watermark is None:
+        return 0
+    try:
+        with get_manager().writer() as conn:
+            cursor = conn.executemany(MARK_UPLOADED_SQL[tank], [(row_id,) for row_id in row_ids])
+            updated = cursor.rowcount
+            if watermark is not None:
+                conn.execute(UPDATE_WATERMARK_SQL, (watermark, OUTBOX_TABLES[tank]))
+
+        if updated > 0:
+            logger.debug("Local upload flag set to 1 for %d %s record(s)", updated, tank)
+        return updated
+
+    except sqlite3.Error as e:
+        logger.error("Error updating upload flag: %s", e)
+        return 0
+
 def update_upload_flag(timestamp):
-    """Updates the uploaded flag to 1 for a given record."""
+    """
+    Sets the uploaded flag to 1 for the pending rows stored with this timestamp, in every tank table.
+    Kept for callers of the old timestamp-based API; new code marks rows by id with mark_uploaded().
+    """
+    updated = 0
+    for tank in list(TANK_TABLES):
+        try:
+            with get_manager().reader() as conn:
+                row_ids = [row_id for (row_id,) in conn.execute(SELECT_PENDING_BY_TIMESTAMP_SQL[tank], (timestamp,))]
+        except sqlite3.Error as e:
+            logger.error("Error reading upload flags: %s", e)
+            continue
+        updated += mark_uploaded(tank, row_ids)
+    return updated
+
+def pending_ids(tank, row_ids):
+    """
+    Returns the subset of row_ids that is still waiting for upload (uploaded = 0), in the given order.
+    Lets the live uploader skip rows the backlog already confirmed in the meantime.
+    On a read error every id is returned, so nothing is lost; the upload itself is idempotent.
+    """
+    if not row_ids:
+        return []
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            
-            # Since the timestamp should be unique across both logs, we update both tables
-            cursor.execute("UPDATE main_tank_logs SET uploaded = 1 WHERE timestamp = ?", (timestamp,))
-            cursor.execute("UPDATE sampling_tank_logs SET uploaded = 1 WHERE timestamp = ?", (timestamp,))
-            
-            conn.commit()
-            if cursor.rowcount > 0:
-                print(f"-> Local upload flag set to 1 for timestamp: {timestamp}")
+        with get_manager().reader() as conn:
+            waiting = {row_id for (row_id,) in conn.execute(
+                SELECT_PENDING_IDS_SQL[tank], (min(row_ids), max(row_ids))
+            )}
+    except sqlite3.Error as e:
+        logger.error("Error reading upload flags: %s", e)
+        return list(row_ids)
+    return [row_id for row_id in row_ids if row_id in waiting]
+
+def get_watermark(tank):
+    """Returns the id below which every row of the tank table is known to be uploaded."""
+    try:
+        with get_manager().reader() as conn:
+            row = conn.execute(SELECT_WATERMARK_SQL, (OUTBOX_TABLES[tank],)).fetchone()
+            return row[0] if row else 0
 
     except sqlite3.Error as e:
-        print(f"Error updating upload flag: {e}")
-        
-def fetch_unuploaded_data():
-    """Fetches all records from both logs where the 'uploaded' flag is 0."""
-    unuploaded_records = {
-        'main_tank': [],
-        'sampling_tank': []
-    }
-    
+        logger.error("Error reading backlog watermark: %s", e)
+        return 0
+
+def pending_count(tank=None):
+    """Returns the number of rows waiting for upload (one tank, or all tanks) from the outbox counters."""
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            
-            # Fetch unuploaded main tank data
-            cursor.execute("SELECT timestamp, temperature_C, light_intensity_lux, water_level_cm, pH_value FROM main_tank_logs WHERE uploaded = 0")
-            # cursor.description contains column names with their desciption (display size, type code...)
-            # Get column names to create dictionaries for easy use
-            main_columns = [col[0] for col in cursor.description]
-            # cursor.fetchall contains data values belonging to the column names
-            for row in cursor.fetchall():
-                # Convert the tuple row into a dictionary
-                unuploaded_records['main_tank'].append(dict(zip(main_columns, row)))
-            
-            # Fetch unuploaded sampling tank data
-            cursor.execute("SELECT timestamp, EC_value FROM sampling_tank_logs WHERE uploaded = 0")
-            sampling_columns = [col[0] for col in cursor.description]
-            for row in cursor.fetchall():
-                unuploaded_records['sampling_tank'].append(dict(zip(sampling_columns, row)))
+        with get_manager().reader() as conn:
+            if tank is None:
+                return conn.execute(SELECT_TOTAL_PENDING_SQL).fetchone()[0]
+            row = conn.execute(SELECT_PENDING_COUNT_SQL, (OUTBOX_TABLES[tank],)).fetchone()
+            return row[0] if row else 0
+
+    except sqlite3.Error as e:
+        logger.error("Error reading pending count: %s", e)
+        return 0
+
+def query_range(tank, start, end, system_id=DEFAULT_SYSTEM_ID):
+    """
+    Returns the raw rows of one tank table with start <= time < end (epoch seconds), in time order,
+    as dictionaries. Served by the (system_id, ts_ms) index: a range seek, not a table scan.
+    """
+    columns = ('id', 'system_id', 'timestamp', 'ts_ms') + TANK_SENSORS[tank]
+    try:
+        with get_manager().reader() as conn:
+            cursor = conn.execute(
+                SELECT_RANGE_SQL[tank], (system_id, int(start * 1000), int(end * 1000))
+            )
+            return [dict(zip(columns, row)) for row in cursor]
+
+    except sqlite3.Error as e:
+        logger.error("Error querying %s range: %s", tank, e)
+        return []
+
+def newest_rows(tank, limit):
+    """Returns the last `limit` stored rows of a tank table as insert tuples, oldest first."""
+    try:
+        with get_manager().reader() as conn:
+            rows = conn.execute(SELECT_NEWEST_SQL[tank], (limit,)).fetchall()
+    except sqlite3.Error as e:
+        logger.error("Error reading newest %s rows: %s", tank, e)
+        return []
+    rows.reverse()
+    return rows
+
+def query_history(tank, sensor, start, end, points=200, system_id=DEFAULT_SYSTEM_ID):
+    """
+    Returns aggregated history for one sensor column (e.g. 'pH_value') of a tank and system between two epoch times.
+    Served from the coarsest rollup table that still gives at least `points` buckets.
+    """
+    try:
+        with get_manager().reader() as conn:
+            return query_rollups(conn, tank, system_id, sensor, start, end, points)
 
     except sqlite3.Error as e:
-        print(f"Error fetching unuploaded data: {e}")
-        
-    return unuploaded_records
\ No newline at end of file
+        logger.error("Error querying history: %s", e)
+        return {'resolution': None, 'points': []}
+
+def iter_pending(tank, page_size=BACKLOG_PAGE_SIZE, after_id=None):
+    """
+    Yields the tank's unuploaded records as lists of at most page_size namedtuples, in id order.
+    Starts after the stored watermark unless after_id is given; only one page is in memory at a time.
+    """
+    if after_id is None:
+        after_id = get_watermark(tank)
+    record_type = RECORD_TYPES[tank]
+
+    while True:
+        try:
+            # Borrow a reader per page only, so a slow upload never pins a connection
+            with get_manager().reader() as conn:
+                rows = conn.execute(SELECT_PENDING_PAGE_SQL[tank], (after_id, page_size)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error fetching unuploaded data: %s", e)
+            return
+
+        if not rows:
+            return
+        page = list(map(record_type._make, rows))
+        yield page
+
+        # Next page starts after the last id of this one (keyset pagination)
+        after_id = page[-1].id
+        if len(rows) < page_size:
+            return
+
+def fetch_unuploaded_data():
+    """
+    Fetches all records from both logs where the 'uploaded' flag is 0, as dictionaries.
+    Holds the whole backlog in memory; the backlog upload uses iter_pending() instead.
+    """
+    unuploaded_records = {}
+    for tank in list(TANK_TABLES):
+        unuploaded_records[tank] = []
+        for page in iter_pending(tank, after_id=0):
+            # Convert each record into a dictionary
+            unuploaded_records[tank].extend(record._asdict() for record in page)
+
+    return unuploaded_records
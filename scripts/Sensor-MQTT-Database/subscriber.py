@@ -1,113 +1,244 @@
 # Paho PQTT library implements a client class that can be used to add MQTT to support Python program
 import paho.mqtt.client as mqtt
+import logging
 # Importing config for topics
 from config import (
-    TOPIC_SUBSCRIBE_MAIN, TOPIC_SUBSCRIBE_SAMPLE,
-    MAIN_TANK_COLLECTION, SAMPLING_TANK_COLLECTION
+    MAIN_TANK_COLLECTION, SAMPLING_TANK_COLLECTION, SUMMARY_COLLECTION,
+    FIRESTORE_BATCH_SIZE, FIRESTORE_TIMEOUT_SEC,
+    TOPIC_SUBSCRIBE_MAIN, TOPIC_SUBSCRIBE_SAMPLE, TOPIC_SUBSCRIBE_MAIN_BINARY, TOPIC_SUBSCRIBE_SAMPLE_BINARY,
+    TOPIC_SUBSCRIBE_SYSTEMS, TOPIC_SUBSCRIBE_SYSTEMS_BINARY, DEFAULT_SYSTEM_ID
 )
-import json
-from sqlite_handler import insert_main_data, insert_sampling_data, update_upload_flag, fetch_unuploaded_data
+from sqlite_handler import mark_uploaded, iter_pending, QUARANTINE, SUMMARIES
+from decoders import registry, DecodeError, quarantine_row
+from metrics import (
+    MESSAGES_RECEIVED, DECODE_FAILURES,
+    FIRESTORE_REQUEST_SECONDS, FIRESTORE_DOCUMENTS, FIRESTORE_ERRORS
+)
+from logging_setup import PER_MESSAGE
 
-def upload_to_firestore(db, collection_name, data):
-    """Attempts to upload a single record to Firestore."""
-    try:
-        doc_id = data.get('timestamp') 
+logger = logging.getLogger(__name__)
 
+def firestore_document(data):
+    """Returns (document ID, document body) for a sensor record (a dictionary or a backlog namedtuple)."""
+    if hasattr(data, '_asdict'):
+        # Backlog records from sqlite_handler.iter_pending are namedtuples
+        upload_data = data._asdict()
+    else:
         # Creates copy of original sensor dictionary to prevent unintentionally altering the original dictionary
         upload_data = data.copy()
-        
-        # Remove redundant 'uploaded' field when uploading to cloud database
-        upload_data.pop('uploaded', None)
+    # Window summaries carry their own document ID; readings are keyed by system and timestamp,
+    # so two systems reporting in the same second don't overwrite each other's document
+    doc_id = upload_data.pop('document_id', None)
+    if doc_id is None and upload_data.get('timestamp') is not None:
+        doc_id = f"{upload_data.get('system_id') or DEFAULT_SYSTEM_ID}_{upload_data['timestamp']}"
+
+    # Remove the local-only 'id' and 'uploaded' fields when uploading to cloud database
+    upload_data.pop('id', None)
+    upload_data.pop('uploaded', None)
+    return doc_id, upload_data
 
-        # Upload using the timestamp as the document ID
-        db.collection(collection_name).document(doc_id).set(upload_data)
+# Individual retries after a failed batch stop after this many failures in a row:
+# at that point the link is down, not the documents
+MAX_CONSECUTIVE_RETRY_FAILURES = 3
+
+def upload_to_firestore(db, collection_name, data, timeout=FIRESTORE_TIMEOUT_SEC):
+    """Attempts to upload a single record to Firestore."""
+    try:
+        doc_id, upload_data = firestore_document(data)
+
+        # Upload using the system and timestamp as the document ID
+        # timeout: give up after this many seconds instead of waiting out the client's default retries
+        with FIRESTORE_REQUEST_SECONDS.time('document'):
+            db.collection(collection_name).document(doc_id).set(upload_data, timeout=timeout)
+        FIRESTORE_DOCUMENTS.inc('ok')
         
-        print(f"-> Successfully uploaded record {doc_id} to Firestore collection {collection_name}")
+        logger.debug("Uploaded record %s to Firestore collection %s", doc_id, collection_name, extra=PER_MESSAGE)
         return True
 
     except Exception as e:
-        print(f"Error uploading to Firestore collection {collection_name}: {e}")
+        FIRESTORE_DOCUMENTS.inc('error')
+        FIRESTORE_ERRORS.inc('document')
+        logger.warning("Error uploading to Firestore collection %s: %s", collection_name, e, extra=PER_MESSAGE)
         return False
 
+def upload_batch_to_firestore(db, collection_name, records, timeout=FIRESTORE_TIMEOUT_SEC):
+    """
+    Uploads (row id, record) pairs in Firestore WriteBatches of up to FIRESTORE_BATCH_SIZE documents.
+    Returns the row ids of the records that are confirmed in Firestore.
+    """
+    uploaded = []
+    collection = db.collection(collection_name)
+
+    for start in range(0, len(records), FIRESTORE_BATCH_SIZE):
+        chunk = records[start:start + FIRESTORE_BATCH_SIZE]
+        try:
+            # One round trip for the whole chunk instead of one per document
+            batch = db.batch()
+            for row_id, record in chunk:
+                doc_id, upload_data = firestore_document(record)
+                batch.set(collection.document(doc_id), upload_data)
+            with FIRESTORE_REQUEST_SECONDS.time('batch'):
+                batch.commit(timeout=timeout)
+            uploaded.extend(row_id for row_id, record in chunk)
+            FIRESTORE_DOCUMENTS.inc('ok', amount=len(chunk))
+            logger.info("Uploaded batch of %d records to Firestore collection %s", len(chunk), collection_name)
+
+        except Exception as e:
+            # A WriteBatch is all-or-nothing, so one bad document fails the whole chunk.
+            # Retry each document on its own to find (and report) the ones that really fail.
+            FIRESTORE_ERRORS.inc('batch')
+            logger.warning("Error uploading batch to Firestore collection %s: %s; retrying %d records individually",
+                           collection_name, e, len(chunk))
+            confirmed = 0
+            consecutive_failures = 0
+            for row_id, record in chunk:
+                if upload_to_firestore(db, collection_name, record, timeout=timeout):
+                    uploaded.append(row_id)
+                    confirmed += 1
+                    consecutive_failures = 0
+                else:
+                    consecutive_failures += 1
+                    if consecutive_failures >= MAX_CONSECUTIVE_RETRY_FAILURES:
+                        logger.warning("Firestore looks unreachable, stopping individual retries")
+                        break
+            if confirmed < len(chunk):
+                logger.warning("%d of %d records still failed and stay in the backlog", len(chunk) - confirmed, len(chunk))
+
+    return uploaded
+
+# Tank name -> Firestore collection
+TANK_COLLECTIONS = {
+    'main_tank': MAIN_TANK_COLLECTION,
+    'sampling_tank': SAMPLING_TANK_COLLECTION,
+    # Windowed summaries of the tanks with the 'summary' upload policy
+    SUMMARIES: SUMMARY_COLLECTION,
+}
+
+# Topics the gateway subscribes to on every (re)connect, as [(topic, qos), ...]
+# QoS = 1 for every data stream to ensure delivery
+SUBSCRIPTIONS = [
+    (TOPIC_SUBSCRIBE_MAIN, 1),
+    (TOPIC_SUBSCRIBE_SAMPLE, 1),
+    # Compact binary payloads (binary_format.py)
+    (TOPIC_SUBSCRIBE_MAIN_BINARY, 1),
+    (TOPIC_SUBSCRIBE_SAMPLE_BINARY, 1),
+    # {system_id}/{tank}/data[/bin] for every system and tank kind
+    (TOPIC_SUBSCRIBE_SYSTEMS, 1),
+    (TOPIC_SUBSCRIBE_SYSTEMS_BINARY, 1)
+]
+
+def printable_payload(payload):
+    """Returns a JSON payload as text and a binary payload as hex."""
+    try:
+        return payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return payload.hex()
+
 # Called when a message is received from the broker
 # msg is the object containing the message details
 def on_message(client, userdata, msg):
-    """Processes incoming MQTT messages."""
-    
-    # Retrieve the initialised Firestore client object
-    db = userdata.get('db_client')
-    
-    # MQTT Payload (message content) is bytes, decode to a string for printing
-    payload_str = msg.payload.decode()
-    
-    print(f"\n>>> Message received from ESP32 >>>")
-    # topic attribute within msg.topic is the default variable name used by
-    # Paho-MQTT library to store topic string associated with the received message
-    print(f"Topic: {msg.topic}")               
-    print(f"Payload: {payload_str}")
-    
-    # Parse the JSON string into a Python Dictionary
-    # Allow access of any specific sensor reading using its key (sensor name)
-    data = json.loads(payload_str)
-    
-    local_success = False
-    collection = None
-    
-    # --- ACTIONS BASED ON TOPIC ---
-    if msg.topic == TOPIC_SUBSCRIBE_MAIN:
-        print("-> Actions to log main tank data...")
-        local_success = insert_main_data(data)
-        collection = MAIN_TANK_COLLECTION
-        
-        
-    elif msg.topic == TOPIC_SUBSCRIBE_SAMPLE:
-        print("-> Actions to log sample tank data...")
-        local_success = insert_sampling_data(data)
-        collection = SAMPLING_TANK_COLLECTION
-        
-    # --- IMMEDIATE CLOUD UPLOAD ATTEMPT  ---
-    # if initialisation of db is successful, and local database upload is successful
-    if db and local_success:
-        cloud_success = upload_to_firestore(db, collection, data)
-        
-        if cloud_success:
-            update_upload_flag(data.get('timestamp'))
-            
+    """Processes incoming MQTT messages. Never raises: an exception here would kill paho's network loop."""
+    try:
+        # topic attribute within msg.topic is the default variable name used by
+        # Paho-MQTT library to store topic string associated with the received message
+        # Per-message detail is DEBUG (verbose mode only); the isEnabledFor check skips
+        # printable_payload() entirely otherwise
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Message received from ESP32 on %s: %s", msg.topic, printable_payload(msg.payload),
+                         extra=PER_MESSAGE)
+        MESSAGES_RECEIVED.inc(msg.topic)
+
+        ingest_queue = userdata['ingest_queue']
+        try:
+            # Parse and validate straight from the payload bytes into the SQLite insert tuple
+            # MQTT v5 publishers can announce the binary format with a content type
+            content_type = getattr(getattr(msg, 'properties', None), 'ContentType', None)
+            tank, row = registry.decode(msg.topic, msg.payload, content_type)
+        except DecodeError as e:
+            # Keep the bad message for inspection instead of losing it
+            logger.warning("Rejected message on %s: %s", msg.topic, e, extra=PER_MESSAGE)
+            DECODE_FAILURES.inc(msg.topic)
+            ingest_queue.put(QUARANTINE, quarantine_row(msg.topic, msg.payload, str(e)))
+            return
+
+        # Hand the message to the write-behind queue and return straight away:
+        # this runs on paho's network thread, so SQLite and Firestore work happens on the writer thread
+        ingest_queue.put(tank, row)
+    except Exception:
+        logger.exception("Error handling message on %s", getattr(msg, 'topic', '?'), extra=PER_MESSAGE)
+
+# Blocking steps of a backlog pass (see backlog_pass)
+DB_STEP = 'db'
+UPLOAD_STEP = 'upload'
+
+def backlog_pass():
+    """
+    One pass over the backlog, shared by the threaded and the asyncio gateway. Yields the blocking steps
+    instead of running them, so each runtime runs them its own way:
+      (DB_STEP, func, args)               run func(*args) against SQLite and send() back its result
+      (UPLOAD_STEP, collection, records)  upload the (row id, record) pairs and send() back the confirmed ids
+    Returns (records uploaded, records that failed) through StopIteration. A page that fails completely
+    ends the pass: Firestore is unreachable, and the remaining pages would only fail the same way.
+    """
+    uploaded_count = 0
+    failed_count = 0
+
+    # list(): tanks can be added at runtime (tank_registry) while the backlog runs
+    for tank, collection in list(TANK_COLLECTIONS.items()):
+        # The watermark may only advance while every earlier page was fully uploaded
+        no_failures = True
+        pages = iter_pending(tank)
+
+        while True:
+            # 1. Stream records with uploaded = 0, one page at a time (constant memory)
+            page = yield DB_STEP, next, (pages, None)
+            if page is None:
+                break
+
+            # 2. Upload the page in Firestore batches
+            uploaded_ids = yield UPLOAD_STEP, collection, [(record.id, record) for record in page]
+
+            if len(uploaded_ids) < len(page):
+                no_failures = False
+                failed_count += len(page) - len(uploaded_ids)
+
+            # 3. Flag every confirmed record of the page in one SQLite transaction
+            # The row id (primary key) is the key to update the flag;
+            # the stored watermark lets the next pass resume after this page
+            yield DB_STEP, mark_uploaded, (tank, uploaded_ids, page[-1].id if no_failures else None)
+            uploaded_count += len(uploaded_ids)
+
+            if not uploaded_ids:
+                logger.warning("Backlog upload stopped: no record of the last page could be uploaded.")
+                return uploaded_count, failed_count
+
+    if uploaded_count > 0:
+        logger.info("Backlog upload complete: %d records sent.", uploaded_count)
+    else:
+        logger.debug("Backlog check complete: No unuploaded records found.")
+    return uploaded_count, failed_count
+
 def process_and_upload_backlog(db_client):
     """
     Checks the local database for unuploaded records and attempts to upload them.
-    Implements the 'Store-and-Forward' pattern.
+    Implements the 'Store-and-Forward' pattern: runs backlog_pass() with every step inline.
+    Returns (records uploaded, records that failed).
     """
     # Use the initialised Firestore client object
     if not db_client:
-        print("Skipping backlog upload: Firestore client is not initialized.")
-        return
-        
-    print("\n--- Checking for unuploaded data (backlog) ---")
-    
-    # 1. Fetch all records with uploaded = 0
-    backlog = fetch_unuploaded_data()
-    
-    uploaded_count = 0
-    
-    # 2. Iterate through main tank backlog
-    for record in backlog['main_tank']:
-        # Attempt to upload to Firestore
-        if upload_to_firestore(db_client, MAIN_TANK_COLLECTION, record):
-            # If successful, update the local database flag to 1
-            # The timestamp is the key to update the flag
-            update_upload_flag(record.get('timestamp'))
-            uploaded_count += 1
-            
-    # 3. Iterate through sampling tank backlog
-    for record in backlog['sampling_tank']:
-        # Attempt to upload to Firestore
-        if upload_to_firestore(db_client, SAMPLING_TANK_COLLECTION, record):
-            # If successful, update the local database flag to 1
-            update_upload_flag(record.get('timestamp'))
-            uploaded_count += 1
-            
-    if uploaded_count > 0:
-        print(f"--- Backlog upload complete: {uploaded_count} records sent. ---")
-    else:
-        print("--- Backlog check complete: No unuploaded records found. ---")
\ No newline at end of file
+        logger.info("Skipping backlog upload: Firestore client is not initialized.")
+        return 0, 0
+
+    logger.debug("Checking for unuploaded data (backlog)")
+
+    steps = backlog_pass()
+    result = None
+    while True:
+        try:
+            step, target, args = steps.send(result)
+        except StopIteration as done:
+            return done.value
+        if step == UPLOAD_STEP:
+            result = upload_batch_to_firestore(db_client, target, args)
+        else:
+            result = target(*args)
@@ -0,0 +1,55 @@
+import logging
+from sqlite_handler import define_tank, create_tank_schema, load_tank_schemas, pending_count, TANK_SENSORS
+from decoders import registry, TopicDecoder, BinaryTopicDecoder
+from subscriber import TANK_COLLECTIONS
+from metrics import BACKLOG_ROWS
+
+logger = logging.getLogger(__name__)
+
+# --- Runtime Tank Registry ---
+# Ties a tank schema stored in the database to everything the gateway needs to ingest it:
+# the SQLite lookup tables, the topic decoders, the Firestore collection and the backlog gauge.
+# Messages on {system_id}/{tank}/data start being stored as soon as the tank is activated;
+# the wildcard subscriptions already deliver them.
+
+# tank -> schema dictionary of the runtime tanks active in this process
+_active = {}
+
+def activate_tank(schema):
+    """Makes a stored tank schema live in this process (or updates it if its sensors changed)."""
+    tank = schema['tank']
+    sensors = schema['sensors']
+    define_tank(tank, sensors)
+    TANK_COLLECTIONS[tank] = schema['collection']
+    registry.register_tank(
+        tank,
+        TopicDecoder(tank, sensors, schema['valid_ranges']),
+        BinaryTopicDecoder(tank, sensors, schema['valid_ranges'])
+    )
+    BACKLOG_ROWS.set_function(lambda: pending_count(tank), tank)
+    _active[tank] = schema
+    logger.info("Tank %s active with sensors %s", tank, ', '.join(sensors))
+
+def load_tanks():
+    """
+    Activates every runtime tank stored in the database that is new or changed since the last call.
+    Cheap enough to call from the main loop, so tanks registered by register_tank.py go live without a restart.
+    Returns the names of the tanks activated.
+    """
+    activated = []
+    for schema in load_tank_schemas():
+        if _active.get(schema['tank']) == schema:
+            continue
+        try:
+            activate_tank(schema)
+            activated.append(schema['tank'])
+        except ValueError as e:
+            logger.error("Skipping tank schema %s: %s", schema['tank'], e)
+    return activated
+
+def add_tank(tank, sensors, collection=None, valid_ranges=None):
+    """Registers a new tank kind in the database and activates it right away. Returns True on success."""
+    if not create_tank_schema(tank, sensors, collection, valid_ranges):
+        return False
+    load_tanks()
+    return tank in TANK_SENSORS
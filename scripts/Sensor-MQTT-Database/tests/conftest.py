@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The gateway modules are flat scripts next to this folder, imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlite_handler
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Path of a fresh database file; the shared connections are closed again after the test."""
+    yield str(tmp_path / 'algae_project.db')
+    sqlite_handler.close_db()
+
+@pytest.fixture
+def db(db_path):
+    """A database initialized at the current schema."""
+    assert sqlite_handler.init_db(db_path)
+    return db_path
@@ -0,0 +1,194 @@
+import json
+import sqlite3
+import struct
+import time
+
+import pytest
+
+import sqlite_handler
+from sqlite_handler import init_db, insert_batch, get_manager, pending_count, main_row, MIGRATIONS, QUARANTINE
+from ingest_queue import IngestQueue
+from decoders import TopicDecoder, BinaryTopicDecoder, DecoderRegistry, DecodeError, quarantine_row
+from binary_format import encode_binary
+from time_utils import parse_timestamp, MAX_EPOCH_MS
+
+RECEIVED_AT = 1700000000.0
+
+def reading(timestamp, ph=7.0, system_id='system_1'):
+    return main_row({'timestamp': timestamp, 'pH_value': ph, 'system_id': system_id}, RECEIVED_AT)
+
+def fetch(sql, params=()):
+    with get_manager().reader() as conn:
+        return conn.execute(sql, params).fetchall()
+
+# --- Schema Migrations ---
+
+def create_baseline_db(path, rows):
+    """Creates a database with the original two-table schema (before any migration) holding rows."""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE main_tank_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            temperature_C REAL,
+            light_intensity_lux REAL,
+            water_level_cm REAL,
+            pH_value REAL,
+            uploaded INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE sampling_tank_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            EC_value REAL,
+            uploaded INTEGER DEFAULT 0
+        )
+    ''')
+    conn.executemany("INSERT INTO main_tank_logs (timestamp, pH_value, uploaded) VALUES (?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+def test_migrations_from_baseline_schema(db_path):
+    create_baseline_db(db_path, [
+        ('2023-11-14 22:13:20', 7.0, 1),
+        ('2023-11-14 22:13:20', 7.0, 0),   # stored twice before the unique index; one copy was uploaded
+        ('2023-11-14 22:14:20', 7.1, 0),
+        ('1e300', 7.2, 0),                 # finite but far outside any epoch
+        ('garbage', 7.3, 0),
+    ])
+    assert init_db(db_path)
+
+    assert fetch("PRAGMA user_version") == [(len(MIGRATIONS),)]
+    rows = fetch("SELECT timestamp, ts_ms, system_id, uploaded FROM main_tank_logs ORDER BY id")
+    valid_ms = int(parse_timestamp('2023-11-14 22:13:20') * 1000)
+    assert rows == [
+        ('2023-11-14 22:13:20', valid_ms, 'system_1', 1),
+        ('2023-11-14 22:14:20', valid_ms + 60000, 'system_1', 0),
+        ('1e300', None, 'system_1', 0),
+        ('garbage', None, 'system_1', 0),
+    ]
+    # The outbox counter is rebuilt from the rows that survived
+    assert pending_count('main_tank') == 3
+
+def test_migrations_are_idempotent(db_path):
+    create_baseline_db(db_path, [('2023-11-14 22:13:20', 7.0, 0)])
+    assert init_db(db_path)
+    assert init_db(db_path)
+    assert fetch("PRAGMA user_version") == [(len(MIGRATIONS),)]
+    assert fetch("SELECT COUNT(*) FROM main_tank_logs") == [(1,)]
+
+# --- Dedupe ---
+
+def test_insert_batch_ignores_stored_readings(db):
+    row = reading('2023-11-14 22:13:20')
+    uploads, stored = insert_batch({'main_tank': [row, row]})
+    assert stored == {'main_tank': [row]}
+    assert len(uploads['main_tank'][0]) == 1
+
+    uploads, stored = insert_batch({'main_tank': [row]})
+    assert stored == {} and uploads == {}
+    assert fetch("SELECT COUNT(*) FROM main_tank_logs") == [(1,)]
+
+def test_ingest_queue_drops_redelivered_reading(db):
+    queue = IngestQueue(flush_interval=0.01)
+    queue.start()
+    row = reading('2023-11-14 22:13:20')
+    assert queue.put('main_tank', row)
+    assert queue.put('main_tank', row)
+    queue.stop()
+
+    stats = queue.stats()
+    assert stats['enqueued'] == 1
+    assert stats['duplicates'] == 1
+    assert stats['written'] == 1
+
+# --- Group Commit ---
+
+def test_ingest_queue_commits_in_batches(db):
+    committed = []
+    queue = IngestQueue(on_commit=lambda tank, ids, rows: committed.append(len(rows)),
+                        batch_size=20, flush_interval=0.05)
+    # Queued before the writer starts, so the batch boundaries don't depend on timing
+    for i in range(50):
+        queue.put('main_tank', reading(f'2023-11-14 22:{i // 60:02d}:{i % 60:02d}'))
+    queue.start()
+    queue.stop()
+
+    stats = queue.stats()
+    assert stats['batches'] == 3
+    assert stats['written'] == 50
+    assert committed == [20, 20, 10]
+    assert fetch("SELECT COUNT(*) FROM main_tank_logs") == [(50,)]
+
+def test_ingest_writer_survives_unstorable_batch(db):
+    queue = IngestQueue(flush_interval=0.01)
+    bad = ('system_1', 'bad', 2 ** 70, None, None, None, 7.0)   # ts_ms beyond SQLite's int64
+    good = reading('2023-11-14 22:13:20')
+    queue.put('main_tank', bad)
+    queue.start()
+    time.sleep(0.1)
+    # Forgotten with its failed batch, so a redelivery is queued (and fails) again
+    queue.put('main_tank', bad)
+    time.sleep(0.1)
+    queue.put('main_tank', good)
+    queue.stop()
+
+    assert not queue._thread.is_alive()
+    stats = queue.stats()
+    assert stats['enqueued'] == 3
+    assert stats['failed'] == 2
+    assert stats['written'] == 1
+    assert fetch("SELECT ts_ms FROM main_tank_logs") == [(good[2],)]
+
+# --- Decoders ---
+
+def test_json_decoder_rejects_invalid_payloads():
+    decoder = TopicDecoder('main_tank', sqlite_handler.TANK_SENSORS['main_tank'])
+    for payload in (b'not json', b'[1, 2]', b'{"pH_value": 15}', b'{"pH_value": "x"}', b'{"system_id": 5}'):
+        with pytest.raises(DecodeError):
+            decoder.decode(payload, RECEIVED_AT)
+
+def test_json_decoder_replaces_out_of_range_timestamp():
+    decoder = TopicDecoder('main_tank', sqlite_handler.TANK_SENSORS['main_tank'])
+    row = decoder.decode(json.dumps({'timestamp': '1e300', 'pH_value': 7}).encode(), RECEIVED_AT)
+    assert row[2] == int(RECEIVED_AT * 1000)
+    row = decoder.decode(json.dumps({'timestamp': 1e300, 'pH_value': 7}).encode(), RECEIVED_AT)
+    assert row[2] == int(RECEIVED_AT * 1000)
+
+def test_binary_decoder_round_trip():
+    decoder = BinaryTopicDecoder('main_tank', sqlite_handler.TANK_SENSORS['main_tank'])
+    payload = encode_binary('main_tank', {'pH_value': 7.0}, ts_ms=1700000000000, system_id='system_2')
+    row = decoder.decode(payload, RECEIVED_AT)
+    assert row[0] == 'system_2' and row[2] == 1700000000000
+    assert row[3:] == (None, None, None, 7.0)
+
+def test_binary_decoder_rejects_invalid_payloads():
+    decoder = BinaryTopicDecoder('main_tank', sqlite_handler.TANK_SENSORS['main_tank'])
+    payloads = [
+        b'\x01\x00',                                              # too short
+        struct.pack('<BQffff', 2, 0, 20, 100, 10, 7),             # unknown version
+        struct.pack('<BQffff', 1, 0, 20, 100, 10, 15),            # pH out of range
+        struct.pack('<BQffff', 1, 2 ** 64 - 1, 20, 100, 10, 7),   # ts_ms beyond int64
+        struct.pack('<BQffff', 1, MAX_EPOCH_MS + 1, 20, 100, 10, 7),
+        struct.pack('<BQffff', 1, 0, 20, 100, 10, 7) + b'\xff',   # system id not UTF-8
+    ]
+    for payload in payloads:
+        with pytest.raises(DecodeError):
+            decoder.decode(payload, RECEIVED_AT)
+
+def test_rejected_messages_are_quarantined(db):
+    registry = DecoderRegistry()
+    registry.register('main_tank/data/bin', BinaryTopicDecoder('main_tank', sqlite_handler.TANK_SENSORS['main_tank']))
+    payload = struct.pack('<BQffff', 1, 2 ** 64 - 1, 20, 100, 10, 7)
+
+    queue = IngestQueue(flush_interval=0.01)
+    queue.start()
+    with pytest.raises(DecodeError) as error:
+        registry.decode('main_tank/data/bin', payload)
+    queue.put(QUARANTINE, quarantine_row('main_tank/data/bin', payload, str(error.value)))
+    queue.stop()
+
+    assert registry.stats()['rejected'] == {'main_tank/data/bin': 1}
+    assert fetch("SELECT topic, payload FROM quarantine") == [('main_tank/data/bin', payload)]
+    assert fetch("SELECT COUNT(*) FROM main_tank_logs") == [(0,)]
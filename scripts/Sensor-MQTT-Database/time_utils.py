@@ -0,0 +1,48 @@
+import math
+from datetime import datetime
+
+# Latest epoch time in seconds taken as a real timestamp (around the year 5100); a number above it is read
+# as milliseconds, and anything still above it after that is rejected. Also keeps ts_ms well inside SQLite's int64.
+MAX_EPOCH_SEC = 1e11
+MAX_EPOCH_MS = int(MAX_EPOCH_SEC * 1000)
+
+def parse_timestamp(value):
+    """
+    Converts an ESP32 timestamp into Unix epoch seconds (float), or None if it can't be parsed.
+    Accepts epoch numbers (seconds or milliseconds) and ISO-style strings such as
+    "2025-01-31 14:05:00" or "2025-01-31T14:05:00Z". Strings without a timezone are read as Pi local time.
+    Times before 1970 or after MAX_EPOCH_SEC count as unparseable.
+    """
+    if value is None:
+        return None
+
+    # Epoch numbers, either as numbers or digit strings
+    if isinstance(value, (int, float)):
+        try:
+            number = float(value)
+        except OverflowError:
+            return None
+    else:
+        text = str(value).strip()
+        try:
+            number = float(text)
+        except ValueError:
+            number = None
+        if number is None:
+            try:
+                # fromisoformat (Python 3.11+) understands both "T" and " " separators and a trailing "Z"
+                number = datetime.fromisoformat(text).timestamp()
+            except (ValueError, OverflowError, OSError):
+                return None
+            return number if 0 <= number <= MAX_EPOCH_SEC else None
+
+    # inf and NaN are no time at all
+    if not math.isfinite(number):
+        return None
+    # Anything past the year 5000 in seconds is really milliseconds
+    if number > MAX_EPOCH_SEC:
+        number /= 1000.0
+    # Still too large (or negative): garbage, not a time
+    if not (0 <= number <= MAX_EPOCH_SEC):
+        return None
+    return number
@@ -0,0 +1,127 @@
+import time
+from config import UPLOAD_POLICIES, SUMMARY_CLOSE_DELAY_SEC
+from sqlite_handler import TANK_SENSORS, ROW_KEY_COLUMNS
+from metrics import UPLOADS_SUPPRESSED
+
+# --- Cloud Upload Policy ---
+# Firestore bills per document written, and most readings repeat the previous one within sensor noise.
+# The filter decides per reading, as it is stored, whether it is worth a document (see UPLOAD_POLICIES
+# in config.py). Readings it skips stay in SQLite at full resolution with uploaded = SUPPRESSED, so
+# neither the live uploader nor the backlog sends them, and the archive keeps them like uploaded rows.
+
+ALL = 'all'
+DEADBAND = 'deadband'
+SUMMARY = 'summary'
+MODES = (ALL, DEADBAND, SUMMARY)
+
+class UploadFilter:
+    """
+    Upload decisions per tank and system. Called by insert_batch from the SQLite writer thread only,
+    so it keeps plain dictionaries without a lock.
+    """
+
+    # Constructor for UploadFilter class
+    def __init__(self, policies=UPLOAD_POLICIES, close_delay=SUMMARY_CLOSE_DELAY_SEC):
+        for tank, policy in policies.items():
+            if policy.get('mode', ALL) not in MODES:
+                raise ValueError(f"unknown upload policy mode for {tank}: {policy.get('mode')!r}")
+            if policy.get('mode') == SUMMARY and not policy.get('window_sec'):
+                raise ValueError(f"the summary policy for {tank} needs a window_sec")
+        self.policies = policies
+        self.close_delay = close_delay
+        # (tank, system_id) -> (ts_ms, sensor values) of the last reading that was uploaded
+        self._last_uploaded = {}
+        # (tank, system_id) -> start (epoch ms) of the summary window currently being filled
+        self._open_windows = {}
+
+    def mode(self, tank):
+        return self.policies.get(tank, {}).get('mode', ALL)
+
+    def select(self, tank, rows):
+        """
+        Returns (one upload flag per insert tuple, summary windows these rows closed).
+        A window is (tank, system_id, start ms, window_sec); insert_batch summarizes it from SQLite.
+        """
+        mode = self.mode(tank)
+        if mode == ALL:
+            return [True] * len(rows), []
+        if mode == DEADBAND:
+            upload = self._select_changed(tank, rows)
+            windows = []
+        else:
+            upload = [False] * len(rows)
+            windows = self._track_windows(tank, rows)
+        suppressed = upload.count(False)
+        if suppressed:
+            UPLOADS_SUPPRESSED.inc(tank, amount=suppressed)
+        return upload, windows
+
+    def _select_changed(self, tank, rows):
+        policy = self.policies[tank]
+        deadband = policy.get('deadband', {})
+        # Sensors without a dead-band count any change
+        limits = [deadband.get(name, 0.0) for name in TANK_SENSORS[tank]]
+        heartbeat_ms = policy['heartbeat_sec'] * 1000 if policy.get('heartbeat_sec') else None
+
+        upload = []
+        for row in rows:
+            key = (tank, row[0])
+            values = row[ROW_KEY_COLUMNS:]
+            last = self._last_uploaded.get(key)
+            changed = (
+                last is None
+                or (heartbeat_ms is not None and row[2] - last[0] >= heartbeat_ms)
+                or _moved(values, last[1], limits)
+            )
+            if changed:
+                self._last_uploaded[key] = (row[2], values)
+            upload.append(changed)
+        return upload
+
+    def _track_windows(self, tank, rows):
+        window_sec = self.policies[tank]['window_sec']
+        width = window_sec * 1000
+        closed = []
+        for row in rows:
+            key = (tank, row[0])
+            start = row[2] // width * width
+            current = self._open_windows.get(key)
+            if current is None or start > current:
+                # The first reading of a newer window closes the one before it
+                if current is not None:
+                    closed.append((tank, row[0], current, window_sec))
+                self._open_windows[key] = start
+            elif start < current:
+                # A late reading for a window that is already closed: summarize that window again
+                closed.append((tank, row[0], start, window_sec))
+        return closed
+
+    def due_windows(self, now=None):
+        """Closes and returns the windows that ended more than close_delay seconds ago without a newer reading."""
+        now_ms = (time.time() if now is None else now) * 1000
+        due = []
+        for (tank, system_id), start in list(self._open_windows.items()):
+            window_sec = self.policies[tank]['window_sec']
+            if start + (window_sec + self.close_delay) * 1000 <= now_ms:
+                due.append((tank, system_id, start, window_sec))
+                del self._open_windows[(tank, system_id)]
+        return due
+
+    def open_windows(self):
+        """Closes and returns every window still being filled (on shutdown; later readings re-summarize it)."""
+        windows = [
+            (tank, system_id, start, self.policies[tank]['window_sec'])
+            for (tank, system_id), start in self._open_windows.items()
+        ]
+        self._open_windows.clear()
+        return windows
+
+def _moved(values, previous, limits):
+    """True if any sensor moved by more than its limit; a sensor appearing or disappearing counts as a move."""
+    for value, old, limit in zip(values, previous, limits):
+        if value is None or old is None:
+            if value is not old:
+                return True
+        elif abs(value - old) > limit:
+            return True
+    return False